@@ -1 +1 @@
-__all__ = ['device', 'lldp', 'getinfo', 'graph']
+__all__ = ['device', 'lldp', 'getinfo', 'graph', 'benchmark', 'state', 'topology', 'collector', 'registry', 'checkpoint']
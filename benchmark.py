@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Benchmarks lldp.py discovery and getinfo.py collection against simulated SNMP agents.
+# Reports wall time, PDUs, per-device SNMP time percentiles and peak memory as JSON.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import Queue
+from os import getenv
+from time import time
+import getinfo
+import lldp
+import registry
+import snmp
+import state
+from snmp import simulator
+
+# Logging config
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+def serve(args, counters, ready):
+    devices = simulator.buildTopology(args.topology, args.size, args.address, args.port)
+    s = simulator.Simulator(devices, args.latency, args.jitter, args.loss, args.community, counters=counters)
+    s.bind()
+    ready.set()
+    s.serve()
+
+
+#
+# returns subclass of connection recording seconds spent in each SNMP operation per host.
+# None of the operations timed calls another, so no time is counted twice.
+#
+def timedConnection(connection, timings):
+    class TimedConnection(connection):
+        def __init__(self, host, *args, **kwargs):
+            self.timedHost = host
+            connection.__init__(self, host, *args, **kwargs)
+
+        def timed(self, method, *args):
+            start = time()
+            try:
+                return method(self, *args)
+            finally:
+                timings.setdefault(self.timedHost, []).append(time() - start)
+
+        def get(self, var):
+            return self.timed(connection.get, var)
+
+        def walk(self, var):
+            return self.timed(connection.walk, var)
+
+        def dictGet(self, indict):
+            return self.timed(connection.dictGet, indict)
+
+        # Table walks (iterTable, iterWalk, table) of both engines send their PDUs through bulk
+        def bulk(self, oids, repetitions):
+            return self.timed(connection.bulk, oids, repetitions)
+
+    return TimedConnection
+
+
+# Nearest rank percentiles of values.
+def percentiles(values, ranks=(50, 90, 99, 100)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return dict(("p%d" % r, values[max(0, int(round(r / 100.0 * len(values))) - 1)]) for r in ranks)
+
+
+#
+# Runs function, returns its result and a report of the phase.
+#
+def phase(name, counters, function, *args):
+    timings = {}
+    before = list(counters)
+    start = time()
+    result = function(timings, *args)
+    wall = time() - start
+    served = dict(zip(simulator.counterNames, [b - a for a, b in zip(before, list(counters))]))
+    report = {
+        'phase': name,
+        'wall': wall,
+        'devices': len(timings),
+        'pdus': served['received'],
+        'served': served,
+        'latency': percentiles([sum(x) for x in timings.values()]),
+        # Peak resident set size of this process so far, kilobytes on Linux
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    logger.info("%s: %s", name, report)
+    return result, report
+
+
+def discover(timings, root, oid, args, connection, store, devices=None):
+    return lldp.discover(root, oid, 2, args.community, args.workers, timedConnection(connection, timings),
+                         store=store, devices=devices)
+
+
+def collect(timings, hosts, oid, args, connection, store):
+    jobQ = Queue.Queue()
+    resultQ = Queue.Queue()
+    for hostname in hosts:
+        jobQ.put({'hostname': hostname, 'oid': oid, 'snmpVersion': 2, 'snmpCommunity': args.community,
+                  'connection': timedConnection(connection, timings), 'state': store})
+    for i in range(min(args.workers, len(hosts))):
+        w = getinfo.InfoWorker(jobQ, resultQ)
+        w.daemon = True
+        w.start()
+    jobQ.join()
+    return resultQ.qsize()
+
+if __name__ == "__main__":
+    defaultOidfile = getenv('OIDFILE', 'oid.json')
+    engines = {'netsnmp': snmp.Connection, 'async': snmp.AsyncConnection}
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("topology", choices=sorted(simulator.topologies),
+                        help="Generated topology")
+    parser.add_argument("size", type=int,
+                        help="Number of devices (k for fattree)")
+    parser.add_argument("-a", "--address", default='127.0.0.1',
+                        help="Address to serve simulated devices on (default: 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=20000,
+                        help="Port of the first simulated device (default: 20000)")
+    parser.add_argument("-c", "--community", default='public',
+                        help="SNMP community (default: public)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds to delay every response (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Up to this many seconds of random extra delay (default: 0)")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="Fraction of requests to drop (default: 0)")
+    parser.add_argument("-r", "--rate", type=float, default=0,
+                        help="Most SNMP requests to send per second, 0 for no limit (default: 0)")
+    parser.add_argument("--device-limit", type=int, default=0,
+                        help="Most SNMP requests in flight per device, 0 for no limit (default: 0)")
+    parser.add_argument("-w", "--workers", type=int, default=10,
+                        help="Number of devices to poll at once (default: 10)")
+    parser.add_argument("-e", "--engine", choices=sorted(engines), default='async',
+                        help="SNMP engine (default: async)")
+    parser.add_argument("-o", "--oidfile", default=defaultOidfile,
+                        help="JSON file containing SNMP OIDs (default: %s)" % defaultOidfile)
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Keep device state and run both phases a second time, "
+                        "like repeated runs with --statefile")
+    parser.add_argument("-s", "--single-pass", action="store_true",
+                        help="Collect device info while discovering (lldp.py -i) instead of in a second phase")
+    parser.add_argument("-l", "--logfile",
+                        help="Log file with phase reports (default is logging errors to STDERR)")
+    args = parser.parse_args()
+
+    if args.logfile:
+        fh = logging.FileHandler(args.logfile)
+        fh.setLevel(logging.INFO)
+        logger.addHandler(fh)
+    else:
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.ERROR)
+        logger.addHandler(ch)
+
+    oid = registry.load(args.oidfile)
+    snmp.throttle.configure(args.rate, perDevice=args.device_limit)
+
+    # The simulator gets a process of its own so it does not compete for our GIL
+    counters = multiprocessing.Array('d', len(simulator.counterNames), lock=False)
+    ready = multiprocessing.Event()
+    agents = multiprocessing.Process(target=serve, args=(args, counters, ready))
+    agents.daemon = True
+    agents.start()
+    ready.wait()
+
+    root = "%s:%d" % (args.address, args.port)
+    connection = engines[args.engine]
+    store = state.StateStore() if args.incremental else None
+    reports = []
+    for suffix in ['', ' (repeat)'] if args.incremental else ['']:
+        if args.single_pass:
+            (hosts, tree), report = phase('lldp+getinfo' + suffix, counters, discover, root, oid, args, connection,
+                                          store, {})
+            reports.append(report)
+            continue
+        (hosts, tree), report = phase('lldp' + suffix, counters, discover, root, oid, args, connection, store)
+        reports.append(report)
+        count, report = phase('getinfo' + suffix, counters, collect, hosts, oid, args, connection, store)
+        reports.append(report)
+    snmp.stopDispatcher()
+    agents.terminate()
+
+    print(json.dumps({'topology': args.topology, 'size': args.size, 'engine': args.engine,
+                      'workers': args.workers, 'rate': args.rate, 'latency': args.latency, 'loss': args.loss,
+                      'discovered': len(hosts), 'phases': reports},
+                     sort_keys=False, indent=4, separators=(',', ': ')))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Progress of long lldp.py crawls and getinfo.py runs, appended to a file as devices are done,
+# so a run that was interrupted can be resumed without polling those devices again.
+
+import json
+import logging
+import os
+import threading
+from time import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Checkpoint:
+    __doc__ = "Records appended to a file as JSON, one per line, and read back to resume a run"
+
+    # Starts filename over, unless resume, which keeps its records (see load).
+    # Every record is flushed as it is appended, and synced to disk at most every interval seconds.
+    def __init__(self, filename, resume=False, interval=5):
+        self.filename = filename
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.records = self.load() if resume else []
+        self.file = open(filename, 'a' if resume else 'w')
+        self.synced = time()
+
+    # returns records in filename, in the order they were appended. A record cut short by the
+    # interruption ends the list; it is dropped from the file too, so appending continues on a clean line.
+    def load(self):
+        records = []
+        try:
+            with open(self.filename, 'r+') as f:
+                offset = 0
+                for line in iter(f.readline, ''):
+                    try:
+                        if not line.endswith("\n"):
+                            raise ValueError("no end of line")
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Dropping incomplete record at the end of %s" % self.filename)
+                        f.truncate(offset)
+                        break
+                    offset += len(line)
+        except IOError:
+            logger.info("No checkpoint in %s yet, starting from the beginning" % self.filename)
+        logger.debug("Loaded %s records from %s", len(records), self.filename)
+        return records
+
+    def append(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if time() - self.synced >= self.interval:
+                os.fsync(self.file.fileno())
+                self.synced = time()
+
+    # Starts the file over
+    def clear(self):
+        with self.lock:
+            self.records = []
+            self.file.seek(0)
+            self.file.truncate()
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
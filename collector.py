@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# Distributed discovery and polling. A coordinator hands shards of the LLDP discovery frontier,
+# then of the device list, to any number of collectors connected over TCP, and merges their
+# partial results into one device map (getinfo.py output format) and topology.
+#
+# Protocol: one JSON object per line. The coordinator sends {"task": "lldp", "hosts": [[hostname,
+# address or null], ...]}, {"task": "info", "hosts": [hostname, ...]} or {"task": "exit"}, and the
+# collector answers a task with {"neighbours": {hostname: {"neighbours": [...], "addresses": {...}}}}
+# or {"devices": {hostname: {device info}}}. Shards of collectors that go away are handed out again.
+
+import logging
+import socket
+import sys
+import threading
+import multiprocessing
+import Queue
+from collections import deque
+from json import dumps, loads
+from argparse import ArgumentParser
+from os import getenv
+from time import sleep, time
+import getinfo
+import lldp
+import registry
+import snmp
+import topology
+
+# Logging config
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+# 'host:port' -> ('host', port)
+def parseAddress(address):
+    host, port = snmp.splitHost(address)
+    return host or '127.0.0.1', port or 16100
+
+
+def sendMessage(f, message):
+    f.write(dumps(message) + "\n")
+    f.flush()
+
+
+# returns next message read from f, or None at end of file.
+def readMessage(f):
+    line = f.readline()
+    if not line:
+        return None
+    return loads(line)
+
+
+class Coordinator:
+    __doc__ = "Hands out shards of LLDP discovery and device polling to collectors and merges their results"
+
+    # Discovers from roots (list of hostnames) if given, then polls every device found.
+    # Without roots, polls hosts (list of hostnames) only. A collector that does not answer a shard
+    # within timeout seconds is dropped, and the run fails when none has been connected for as long.
+    def __init__(self, roots=None, hosts=None, shardSize=20, timeout=300):
+        self.shardSize = shardSize
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        # Shards not handed out yet
+        self.queue = deque()
+        # Shards handed out and not answered yet
+        self.outstanding = 0
+        # Collectors connected, and since when none is
+        self.collectors = 0
+        self.idle = time()
+        # Hostnames in the order they were found, and address to poll them on (None: the name)
+        self.checked = []
+        self.addresses = {}
+        self.topology = topology.Topology()
+        self.devices = {}
+        with self.condition:
+            self.phase = 'lldp' if roots else 'info'
+            self.found([(x, None) for x in roots or hosts or []])
+            if self.phase == 'info':
+                self.queueInfo()
+
+    # Queues shards of task for hosts. Called with condition held.
+    def queueShards(self, task, hosts):
+        for i in range(0, len(hosts), self.shardSize):
+            self.queue.append({'task': task, 'hosts': hosts[i:i + self.shardSize]})
+        self.condition.notify_all()
+
+    # Records newly found (hostname, address) pairs. In discovery, their neighbours are asked for next.
+    def found(self, hosts):
+        new = []
+        for hostname, address in hosts:
+            if hostname and hostname not in self.addresses:
+                self.addresses[hostname] = address
+                self.checked.append(hostname)
+                self.topology.addDevice(hostname)
+                new.append([hostname, address])
+        if self.phase == 'lldp':
+            self.queueShards('lldp', new)
+
+    # Queues polling of every device found. Called with condition held.
+    def queueInfo(self):
+        self.phase = 'info'
+        self.queueShards('info', list(self.checked))
+
+    # returns next shard to hand out, waiting for one if others are still outstanding, or None when done.
+    def take(self):
+        with self.condition:
+            while not self.queue and self.outstanding:
+                self.condition.wait(1.0)
+            if not self.queue:
+                return None
+            self.outstanding += 1
+            return self.queue.popleft()
+
+    # Puts shard back for another collector.
+    def failed(self, shard):
+        with self.condition:
+            logger.warning("Handing out shard of %s %s hosts again", len(shard['hosts']), shard['task'])
+            self.outstanding -= 1
+            self.queue.appendleft(shard)
+            self.condition.notify_all()
+
+    # Merges the partial result of shard. Devices answered twice (a shard handed out again after
+    # its collector went away) keep the more complete answer.
+    def done(self, shard, result):
+        with self.condition:
+            self.outstanding -= 1
+            for hostname, entry in (result.get('neighbours') or {}).items():
+                d = self.topology.addDevice(hostname)
+                addresses = entry.get('addresses') or {}
+                names = [x for x in entry.get('neighbours') or [] if x]
+                for name in names:
+                    self.topology.addLink(d, self.topology.addDevice(name))
+                self.found([(x, addresses.get(x)) for x in names])
+            for hostname, info in (result.get('devices') or {}).items():
+                previous = self.devices.get(hostname)
+                if previous is None or len(info) >= len(previous):
+                    self.devices[hostname] = info
+            if self.phase == 'lldp' and not self.queue and not self.outstanding:
+                logger.info("Discovery found %s devices, polling them", len(self.checked))
+                self.queueInfo()
+            self.condition.notify_all()
+
+    # Serves one collector connection until there is no more work, or the collector goes away.
+    def handle(self, connection, peer):
+        logger.info("Collector %s:%s connected", *peer)
+        with self.condition:
+            self.collectors += 1
+        # Reads and writes that take longer raise socket.timeout, a socket.error
+        connection.settimeout(self.timeout)
+        f = connection.makefile('rw')
+        try:
+            while True:
+                shard = self.take()
+                if shard is None:
+                    sendMessage(f, {'task': 'exit'})
+                    break
+                try:
+                    sendMessage(f, shard)
+                    result = readMessage(f)
+                except (socket.error, ValueError) as e:
+                    logger.debug("Collector %s:%s failed: %s", peer[0], peer[1], e)
+                    result = None
+                if result is None:
+                    self.failed(shard)
+                    break
+                self.done(shard, result)
+        except socket.error:
+            pass
+        finally:
+            logger.info("Collector %s:%s done", *peer)
+            with self.condition:
+                self.collectors -= 1
+                if not self.collectors:
+                    self.idle = time()
+                self.condition.notify_all()
+            try:
+                f.close()
+            except socket.error:
+                pass
+            connection.close()
+
+    # Accepts collectors on listening socket server until all work is done. returns the devices
+    # polled, or None if work was left and no collector was connected for timeout seconds.
+    def serve(self, server):
+        def accept():
+            while True:
+                try:
+                    connection, peer = server.accept()
+                except socket.error:
+                    return
+                t = threading.Thread(target=self.handle, args=(connection, peer))
+                t.daemon = True
+                t.start()
+
+        acceptor = threading.Thread(target=accept)
+        acceptor.daemon = True
+        acceptor.start()
+        with self.condition:
+            while self.queue or self.outstanding:
+                if not self.collectors and time() - self.idle > self.timeout:
+                    logger.error("No collectors left with %s shards to poll, giving up",
+                                 len(self.queue) + self.outstanding)
+                    server.close()
+                    return None
+                self.condition.wait(1.0)
+        server.close()
+        return self.devices
+
+
+class Collector:
+    __doc__ = "Polls the shards a coordinator hands out, with pools of lldp.py and getinfo.py workers"
+
+    # Devices get budget seconds each to be polled for device info, as with getinfo.py -b, 0 for no limit.
+    def __init__(self, oid, snmpVersion=2, snmpCommunity='public', workers=10, connection=None,
+                 managementAddresses=False, budget=0):
+        self.job = {'oid': oid, 'snmpVersion': snmpVersion, 'snmpCommunity': snmpCommunity,
+                    'connection': connection, 'managementAddresses': managementAddresses, 'budget': budget}
+        self.jobs = {'lldp': Queue.Queue(), 'info': Queue.Queue()}
+        self.results = {'lldp': Queue.Queue(), 'info': Queue.Queue()}
+        for i in range(workers):
+            w = lldp.NeighbourWorker(self.jobs['lldp'], self.results['lldp'])
+            w.daemon = True
+            w.start()
+        # Workers stuck on a device, or dead, are replaced, so a shard is always answered
+        self.pool = getinfo.WorkerPool(self.jobs['info'], self.results['info'], workers)
+
+    # Polls hosts of shard, returns the answer to send back.
+    def poll(self, shard):
+        task = shard['task']
+        if task == 'lldp':
+            for host in shard['hosts']:
+                self.jobs[task].put(dict(self.job, hostname=host[0], address=host[1]))
+            self.jobs[task].join()
+        else:
+            for host in shard['hosts']:
+                self.pool.put(dict(self.job, hostname=host))
+            self.pool.join()
+
+        answer = {}
+        while not self.results[task].empty():
+            result = self.results[task].get()
+            if task == 'lldp':
+                hostname, neighbours, addresses = result
+                answer[hostname] = {'neighbours': (neighbours or {}).values(), 'addresses': addresses}
+            else:
+                answer.update(result)
+        return {'neighbours': answer} if task == 'lldp' else {'devices': answer}
+
+    # Works for the coordinator at address until told to exit. Waits up to wait seconds for it to listen.
+    def run(self, address, wait=30):
+        deadline = time() + wait
+        while True:
+            try:
+                connection = socket.create_connection(parseAddress(address))
+                break
+            except socket.error:
+                if time() > deadline:
+                    raise
+                sleep(0.5)
+        f = connection.makefile('rw')
+        try:
+            while True:
+                shard = readMessage(f)
+                if shard is None or shard.get('task') == 'exit':
+                    break
+                logger.debug("Polling %s %s hosts", len(shard['hosts']), shard['task'])
+                sendMessage(f, self.poll(shard))
+        finally:
+            f.close()
+            connection.close()
+
+
+def collect(address, oid, snmpVersion, snmpCommunity, workers, connection, managementAddresses, budget=0):
+    try:
+        Collector(oid, snmpVersion, snmpCommunity, workers, connection, managementAddresses, budget).run(address)
+    finally:
+        snmp.stopDispatcher()
+
+if __name__ == "__main__":
+    # Fallback values
+    defaultCommunity = getenv('SNMPCOMMUNITY', 'public')
+    defaultLogfile = getenv('LOGFILE', None)
+    defaultOidfile = getenv('OIDFILE', 'oid.json')
+    defaultWorkers = int(getenv('WORKERS', 10))
+    defaultEngine = getenv('SNMPENGINE', 'netsnmp')
+    defaultAddress = getenv('COORDINATOR', '127.0.0.1:16100')
+    defaultTimeout = int(getenv('SHARDTIMEOUT', 300))
+    defaultBudget = float(getenv('DEVICEBUDGET', 0))
+    snmpVersion = 2
+    engines = {'netsnmp': snmp.Connection, 'async': snmp.AsyncConnection}
+
+    # Command line option parsing and help text (-h)
+    usage = "%(prog)s [options] COMMAND [HOST ...]"
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument("command", choices=['coordinate', 'collect'],
+                        help="coordinate: hand out work to collectors and print merged getinfo.py output. "
+                        "collect: work for a coordinator", metavar="COMMAND")
+    parser.add_argument("host", nargs='*',
+                        help="Devices to start LLDP discovery from (coordinate)", metavar="HOST")
+    parser.add_argument("-a", "--address", default=defaultAddress,
+                        help="Address the coordinator listens on and collectors connect to (default: %s)"
+                        % defaultAddress)
+    parser.add_argument("-f", "--inputfile",
+                        help="Poll devices listed in file (lldp.py list output or whitespace separated) "
+                        "instead of discovering them (coordinate)")
+    parser.add_argument("-s", "--shard-size", type=int, default=20,
+                        help="Devices per shard handed to a collector (default: 20)")
+    parser.add_argument("-t", "--treefile",
+                        help="Also write LLDP tree of the discovered topology to this file (coordinate)")
+    parser.add_argument("-T", "--timeout", type=int, default=defaultTimeout,
+                        help="Seconds to wait for a collector to answer a shard, and for a collector to "
+                        "connect when none is (coordinate, default: %s)" % defaultTimeout)
+    parser.add_argument("--spawn", type=int, default=0,
+                        help="Start this many local collector processes (coordinate)")
+    parser.add_argument("-c", "--community", default=defaultCommunity,
+                        help="SNMP community (default: %s)" % defaultCommunity)
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Do not display or log errors")
+    parser.add_argument("-l", "--logfile", default=defaultLogfile,
+                        help="Log file (Default is logging to STDERR)")
+    parser.add_argument("-o", "--oidfile", default=defaultOidfile,
+                        help="JSON file containing SNMP OIDs (default: oid.json)")
+    parser.add_argument("-w", "--workers", type=int, default=defaultWorkers,
+                        help="Number of devices a collector polls at once (default: %s)" % defaultWorkers)
+    parser.add_argument("-e", "--engine", choices=sorted(engines), default=defaultEngine,
+                        help="SNMP engine, netsnmp sessions or shared async sockets (default: %s)" % defaultEngine)
+    parser.add_argument("-b", "--budget", type=float, default=defaultBudget,
+                        help="Most seconds a collector spends polling device info of a device, 0 for no limit. "
+                        "Devices not done in time are output as partial (default: %s)" % defaultBudget)
+    parser.add_argument("-m", "--management-address", action="store_true",
+                        help="Poll neighbours on the management address they advertise over LLDP "
+                        "instead of resolving their name")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("WORKERS must be at least 1")
+
+    # By default, log to stderr.
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.ERROR)
+    logger.addHandler(ch)
+    # If file name provided for logging, write detailed log.
+    if args.logfile:
+        fh = logging.FileHandler(args.logfile)
+        fh.setLevel(logging.DEBUG)
+        logger.addHandler(fh)
+    # If quiet mode, disable all logging.
+    if args.quiet:
+        logger.disabled = True
+
+    # Load OID data
+    oid = registry.load(args.oidfile)
+    collectorArgs = (oid, snmpVersion, args.community, args.workers, engines[args.engine], args.management_address,
+                     args.budget)
+
+    if args.command == 'collect':
+        collect(args.address, *collectorArgs)
+        sys.exit()
+
+    hosts = None
+    if args.inputfile:
+        try:
+            with open(args.inputfile) as f:
+                hosts = list(getinfo.readHosts(f))
+        except IOError:
+            logger.error("Could not read from file %s" % args.inputfile)
+            sys.exit(1)
+    elif not args.host:
+        logger.error("Give devices to discover from, or a file of devices to poll.")
+        sys.exit(1)
+
+    coordinator = Coordinator(args.host, hosts, args.shard_size, args.timeout)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(parseAddress(args.address))
+    server.listen(64)
+    # Port 0 binds any free port, so local collectors need the real one
+    address = "%s:%s" % server.getsockname()
+    for i in range(args.spawn):
+        p = multiprocessing.Process(target=collect, args=(address,) + collectorArgs)
+        p.daemon = True
+        p.start()
+
+    devices = coordinator.serve(server)
+    if devices is None:
+        sys.exit(1)
+    if args.treefile and args.host:
+        with open(args.treefile, 'w') as f:
+            f.write(dumps(coordinator.topology.tree(args.host[0]), sort_keys=False, indent=4,
+                          separators=(',', ': ')))
+
+    print(dumps(devices, sort_keys=False, indent=4, separators=(',', ': ')))
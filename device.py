@@ -1,38 +1,150 @@
 #!/usr/bin/env python
 import snmp
 import logging
+import registry
+from contextlib import contextmanager
+from time import time
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+# Interface table columns (keys in the 'if' section of oid.json) walked by Device.getInterfaces()
+interfaceColumns = {'name': 'ifname', 'desc': 'ifdesc', 'speed': 'ifspeed', 'alias': 'ifalias'}
+# LLDP remote table columns walked by Device.getNeighbourTable(), field: key in oid['lldp']
+neighbourColumns = {'chassis': 'remotechassis', 'port': 'remoteif', 'portdesc': 'remoteifdesc',
+                    'sysname': 'remotesysname', 'sysdesc': 'remotesysdesc'}
+
+
+#
+# returns the instance part of an OID returned by a walk on column (e.g. the ifIndex).
+#
+def oidIndex(tag, column):
+    tag = tag.strip('.')
+    column = column.strip('.')
+    if tag.startswith(column + '.'):
+        return tag[len(column) + 1:]
+    # Not under the column we asked for. Best guess is the last number.
+    return tag.split('.')[-1]
+
+
+#
+# Compares change indicators (see Device.getChangeIndicators) of two polls of a device.
+# returns True if LLDP and interface tables can not have changed in between.
+#
+def tablesUnchanged(previous, current):
+    if not previous or not current.get('lldpchange') or not current.get('uptime'):
+        return False
+    try:
+        # A reboot resets uptime, and the tables with it
+        if int(current['uptime']) < int(previous.get('uptime', 0)):
+            return False
+    except ValueError:
+        return False
+    return (current.get('lldpchange') == previous.get('lldpchange') and
+            current.get('ifchange') == previous.get('ifchange'))
+
+
 class Device:
     __doc__ = "Networked device"
-    info = {}
 
     def __init__(self, hostname):
         self.hostname = hostname
+        self.info = {}
+        # Change indicators read by the last incremental poll
+        self.indicators = None
+        # ifIndex: {'name', 'desc', 'speed', 'alias'}, filled by getInterfaces()
+        self.interfaces = None
+        # interface name: ifIndex, filled by getInterfaceIndex()
+        self.ifNameIndex = None
+        # ifIndex: [lower layer ifIndexes], filled by getInterfaceStack()
+        self.ifStack = None
+        # LLDP remote table OID: neighbour name, filled by getNeighbours()
+        self.neighbours = None
+        # Polling phase we are in, see phase()
+        self.currentPhase = None
+        # Time (as time.time()) to stop asking the device anything, or None
+        self.deadline = None
 
-    def snmpConfig(self, oid, version=2, community="public", test=False):
-        self.snmp = snmp.Connection(host=self.hostname, version=version, community=community)
+    #
+    # Times a polling phase (resolve, probe, indicators, standard, vendor, lldp, interfaces) into
+    # snmp.metrics.stats, and counts SNMP requests made meanwhile under the phase name.
+    # Phases started within another phase count as part of that one.
+    #
+    @contextmanager
+    def phase(self, name):
+        if self.currentPhase:
+            yield
+            return
+        connection = getattr(self, 'snmp', None)
+        self.currentPhase = name
+        if connection:
+            connection.group = name
+        start = time()
+        try:
+            yield
+        finally:
+            snmp.metrics.stats.phase(name, time() - start)
+            self.currentPhase = None
+            if connection:
+                connection.group = None
+
+    # oid is a registry.Registry, or the nested dict of oid.json to compile one from.
+    # connection is the class to talk SNMP through, netsnmp based snmp.Connection by default.
+    def snmpConfig(self, oid, version=2, community="public", test=False, connection=None):
+        connection = connection or snmp.Connection
+        with self.phase('resolve'):
+            self.snmp = connection(host=self.hostname, version=version, community=community)
+        self.snmp.deadline = self.deadline
         self.oid = oid
+        self.registry = registry.compiled(oid)
         if test:
-            return self.snmpTest()
+            with self.phase('probe'):
+                return self.snmpTest()
 
+    # True if polling ran out of time (see deadline), so what was collected may be incomplete.
+    def expired(self):
+        return getattr(self, 'snmp', None) is not None and self.snmp.expired()
+
+    # True if a table walk ended on a timeout or error, so the tables collected may be cut short.
+    def truncated(self):
+        return getattr(self, 'snmp', None) is not None and self.snmp.walkFailed
+
+    # Probes the device. Devices that do not answer at all are given up on for a while
+    # (see snmp.HostTracker), so later connections to them fail fast instead of waiting for timeouts.
     def snmpTest(self, oid=".1.3.6.1.2.1.1.5.0"):
         result = self.snmp.get(oid)
         if not result:
-            logger.warning("Cannot get OID %s on host %s" % oid, self.hostname)
+            logger.warning("Cannot get OID %s on host %s" % (oid, self.hostname))
+            self.snmp.probeFailed()
         return result
 
+    #
+    # returns index tuple of an OID returned by a walk on oid[group][field], e.g. the ifIndex.
+    #
+    def instance(self, tag, group, field):
+        index = self.registry.index(tag, group, field)
+        if index is None:
+            column = self.oid[group][field]
+            if tag.strip('.').startswith(column.strip('.') + '.'):
+                index = tuple(oidIndex(tag, column).split('.'))
+            else:
+                # Not under the field we asked for, like a symbolic tag. Keep the whole tag, so
+                # callers indexing from the end (the LocalPortNum at [-2]) still find their part.
+                index = tuple(tag.strip('.').split('.'))
+        return index
+
     #
     # returns real interface name (LLDP OIDs use only numbers while the device might use letters).
     #
     def getInterfaceName(self, interface):
         snmp = self.snmp
         oid = self.oid
-        # <interface names OID><interface number> is what we're looking for
-        name = snmp.get(oid['if']['ifname'] + str(interface))
+        if self.interfaces is not None:
+            name = self.interfaces.get(str(interface), {}).get('name')
+        else:
+            # <interface names OID><interface number> is what we're looking for
+            name = snmp.get(oid['if']['ifname'] + str(interface))
         if name:
             interface = name
         logger.info("Returning interface name %s", interface)
@@ -44,15 +156,48 @@ class Device:
     def getInterfaceDesc(self, interface):
         snmp = self.snmp
         oid = self.oid
-        # <interface descriptions OID><interface number> is what we're looking for
-        desc = snmp.get(oid['if']['ifdesc'] + str(interface))
+        if self.interfaces is not None:
+            desc = self.interfaces.get(str(interface), {}).get('desc')
+        else:
+            # <interface descriptions OID><interface number> is what we're looking for
+            desc = snmp.get(oid['if']['ifdesc'] + str(interface))
         logger.info("Returning interface description %s", desc)
         return desc
 
+    #
+    # returns dict of interface name: ifIndex, built once from the interface table.
+    #
+    def getInterfaceIndex(self):
+        if self.ifNameIndex is None:
+            if self.interfaces is None:
+                self.getInterfaces()
+            self.ifNameIndex = {}
+            for ifindex, interface in (self.interfaces or {}).items():
+                if interface.get('name'):
+                    self.ifNameIndex[interface['name']] = ifindex
+        return self.ifNameIndex
+
     #
     # returns interface ID
     #
-    # def getInterfaceByName(self, interfacename):
+    def getInterfaceByName(self, interfacename):
+        return self.getInterfaceIndex().get(interfacename)
+
+    #
+    # Walks ifStackTable once, returns dict of ifIndex: [lower layer ifIndexes].
+    # Devices without ifStackTable get an empty dict.
+    #
+    def getInterfaceStack(self):
+        if self.ifStack is None:
+            oid = self.oid
+            self.ifStack = {}
+            with self.phase('interfaces'):
+                for index, value in self.snmp.iterWalk(oid['if']['ifstack']):
+                    # Index is <higher layer>.<lower layer>, 0 meaning none.
+                    higher, lower = index.split('.')[-2:]
+                    if higher != '0' and lower != '0':
+                        self.ifStack.setdefault(higher, []).append(lower)
+        return self.ifStack
 
     #
     # given subinterface name as input, finds and returns parent interface ID.
@@ -61,17 +206,20 @@ class Device:
         parentname = subname.split('.')[0]
         logger.debug("Searching for interface name %s", parentname)
 
-        originalinterface = interface
-        while True:
-            interface = int(interface) - 1
-            name = self.getInterfaceName(interface)
-            if name == parentname:
-                logger.debug("Found name %s on interface number %s", name, interface)
-                return interface
-            if parentname not in name:
-                logger.debug("Encountered name %s. Giving up.", name)
-                # Give up
-                return originalinterface
+        # Follow the interface stack downwards first, it knows the real relationship.
+        for lower in self.getInterfaceStack().get(str(interface), []):
+            if self.getInterfaceName(lower) == parentname:
+                logger.debug("Found name %s on lower layer interface %s", parentname, lower)
+                return lower
+
+        # Then look the parent up by name.
+        parent = self.getInterfaceByName(parentname)
+        if parent:
+            logger.debug("Found name %s on interface number %s", parentname, parent)
+            return parent
+
+        logger.debug("No interface named %s. Giving up.", parentname)
+        return interface
 
     #
     # returns interface speed
@@ -84,29 +232,89 @@ class Device:
         if format.upper() not in divide:
             format = 'M'
 
+        if self.interfaces is not None:
+            speed = self.interfaces.get(str(interface), {}).get('speed')
+        else:
             # <interface speeds OID><interface number> is what we're looking for
             speed = snmp.get(oid['if']['ifspeed'] + str(interface))
-            if speed:
-                    speedInBits = int(speed)
-            speed = speedInBits / divide[format.upper()]
-            logger.info("Returning interface speed %s", speed)
-            return speed
+        if speed:
+            speed = int(speed) / divide[format.upper()]
+        logger.info("Returning interface speed %s", speed)
+        return speed
+
+    #
+    # Walks name, description, speed and alias columns of the interface tables once
+    # and returns dict of ifIndex: {'name', 'desc', 'speed', 'alias'}, or None.
+    # The result is kept in self.interfaces, after which the getInterface* methods
+    # answer from memory instead of doing one SNMP get per interface.
+    #
+    def getInterfaces(self):
+        oid = self.oid
+        interfaces = {}
+        with self.phase('interfaces'):
+            # ifTable and ifXTable are both indexed by ifIndex, so all columns are walked together.
+            # Rows are taken as responses arrive, the walk itself never holds more than a PDU of them.
+            columns = dict((field, oid['if'][key]) for field, key in interfaceColumns.items())
+            for ifindex, field, value in self.snmp.iterTable(columns):
+                interfaces.setdefault(ifindex, {})[field] = value
+        if not interfaces:
+            logger.debug("%s: walk of interface tables returned nothing", self.hostname)
+            return None
+        logger.debug("%s: collected %s interfaces", self.hostname, len(interfaces))
+        self.interfaces = interfaces
+        return interfaces
 
     #
     # Collects LLDP neighbours from SMTP information, returns dict of oid:neighbour pairs.
     #
     def getNeighbours(self):
-        oid = self.oid
-        lldp = self.snmp.walk(oid['lldp']['remotesysname'])
+        column = self.oid['lldp']['remotesysname']
+        lldp = {}
+        with self.phase('lldp'):
+            for index, name in self.snmp.iterWalk(column):
+                # Keyed by full OID, as snmp.Connection.walk returns them
+                lldp['%s.%s' % (column.rstrip('.'), index)] = name
         if not lldp:
             return None
         logger.debug(lldp)
+        self.neighbours = lldp
         return lldp
 
+    #
+    # Walks all columns of the LLDP remote table at once. returns dict of remote table index
+    # (TimeMark.LocalPortNum.Index): {'chassis', 'port', 'portdesc', 'sysname', 'sysdesc'}, or None.
+    #
+    def getNeighbourTable(self):
+        oid = self.oid
+        with self.phase('lldp'):
+            return self.snmp.table(dict((field, oid['lldp'][key]) for field, key in neighbourColumns.items()))
+
+    #
+    # Collects IPv4 management addresses neighbours advertise over LLDP.
+    # returns dict of LLDP remote table index (TimeMark.LocalPortNum.Index, as in the
+    # OIDs returned by getNeighbours): address, or None.
+    #
+    def getNeighbourAddresses(self):
+        oid = self.oid
+        addresses = {}
+        rows = 0
+        with self.phase('lldp'):
+            for index, value in self.snmp.iterWalk(oid['lldp']['remotemanaddr']):
+                rows += 1
+                # Index is TimeMark.LocalPortNum.Index.AddrSubtype.AddrLength.Addr
+                index = index.split('.')
+                if len(index) == 9 and index[3] == '1' and index[4] == '4':
+                    addresses['.'.join(index[:3])] = '.'.join(index[5:])
+        if not rows:
+            return None
+        logger.debug(addresses)
+        return addresses
+
     #
     # Returns list of dicts with interface number, name, speed and neighbour.
+    # With bulk (default), interface data is walked once per device and joined locally.
     #
-    def getNeighbourInterfaceInfo(self, neighbours=None):
+    def getNeighbourInterfaceInfo(self, neighbours=None, bulk=True):
         iflist = []
         if not isinstance(neighbours, dict):
             # neighbours is not a dict. Let's get us something to work with.
@@ -115,41 +323,82 @@ class Device:
         if not neighbours:
             return None
 
-        for n in neighbours.keys():
-            # Take the OID's second to last dot separated number. That's our local interface.
-            ifnumber = n.split('.')[-2]
-            logger.debug("From OID %s interface is %s", n, ifnumber)
-            ifname = self.getInterfaceName(ifnumber)
-            if '.' in str(ifname):
-                # Do we have a subinterface?
-                ifnumber = self.getParentInterface(ifnumber, ifname)
-            ifspeed = self.getInterfaceSpeed(ifnumber)
+        if self.interfaces is None and bulk:
+            # One walk per column instead of several gets per neighbour.
+            # If the walks fail we fall back to getting interfaces one by one.
+            self.getInterfaces()
 
-            logger.info("%s interface %s has neighbour %s, speed %s", self.hostname, ifname, neighbours[n], ifspeed)
-            iflist.append({'number': ifnumber, 'name': ifname, 'speed': ifspeed, 'neighbour': neighbours[n]})
+        with self.phase('interfaces'):
+            for n in neighbours.keys():
+                # Index is TimeMark.LocalPortNum.Index. LocalPortNum is our local interface.
+                ifnumber = str(self.instance(n, 'lldp', 'remotesysname')[-2])
+                logger.debug("From OID %s interface is %s", n, ifnumber)
+                ifname = self.getInterfaceName(ifnumber)
+                if '.' in str(ifname):
+                    # Do we have a subinterface?
+                    ifnumber = self.getParentInterface(ifnumber, ifname)
+                ifspeed = self.getInterfaceSpeed(ifnumber)
+
+                logger.info("%s interface %s has neighbour %s, speed %s", self.hostname, ifname, neighbours[n],
+                            ifspeed)
+                iflist.append({'number': ifnumber, 'name': ifname, 'speed': ifspeed, 'neighbour': neighbours[n]})
 
         return iflist
 
-    def getDeviceInfo(self):
+    #
+    # returns sysUpTime and last change times of the LLDP remote table and interface table, in one get.
+    #
+    def getChangeIndicators(self):
+        oid = self.oid
+        with self.phase('indicators'):
+            self.indicators = self.snmp.dictGet({'uptime': oid['standard']['uptime'],
+                                                 'lldpchange': oid['lldp']['lastchange'],
+                                                 'ifchange': oid['if']['iflastchange']})
+        logger.debug("%s: change indicators %s", self.hostname, self.indicators)
+        return self.indicators
+
+    #
+    # Collects standard, vendor specific and neighbour interface info.
+    # When incremental, change indicators are read first. If they match those stored in
+    # previous ({'indicators': ..., 'info': ...} from an earlier poll), the neighbour interface
+    # info of previous is reused instead of walking the LLDP and interface tables again.
+    #
+    def getDeviceInfo(self, previous=None, incremental=False):
         snmp = self.snmp
         oid = self.oid
+        unchanged = False
+        if incremental:
+            indicators = self.getChangeIndicators()
+            if previous and tablesUnchanged(previous.get('indicators'), indicators):
+                logger.info("%s: tables unchanged since last poll", self.hostname)
+                unchanged = True
+
         # Let's start collecting info
         deviceFamily = None
 
         # First we poll standard OIDs
-        deviceinfo = snmp.populateDict(oid['standard'])
-        if 'sysdesc' in deviceinfo:
+        with self.phase('standard'):
+            deviceinfo = snmp.populateDict(oid['standard'])
+        if 'sysobjectid' in deviceinfo:
+            # Vendors are known by the enterprise prefix of sysObjectID
+            deviceFamily = self.registry.vendor(deviceinfo['sysobjectid'])
+        if not deviceFamily and 'sysdesc' in deviceinfo:
             # Split into words (space separated), take the first one and lowercase it
             deviceFamily = deviceinfo['sysdesc'].split(' ')[0].lower()
+        if deviceFamily:
             logger.info("Found device family %s", deviceFamily)
 
         # If we have a device family identified, let's look for a matching set of OIDs
         if deviceFamily in oid['device']:
-            familyinfo = snmp.populateDict(oid['device'][deviceFamily])
+            with self.phase('vendor'):
+                familyinfo = snmp.populateDict(oid['device'][deviceFamily])
             # Add the information to the deviceinfo dict
             deviceinfo.update(familyinfo)
 
         self.deviceFamily = deviceFamily
-        deviceinfo['if'] = self.getNeighbourInterfaceInfo()
+        if unchanged:
+            deviceinfo['if'] = previous['info'].get('if')
+        else:
+            deviceinfo['if'] = self.getNeighbourInterfaceInfo()
         self.info.update(deviceinfo)
         return deviceinfo
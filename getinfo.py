@@ -3,22 +3,81 @@ import logging
 import sys
 import json
 import threading
+import multiprocessing
 import Queue
 import argparse
 from os import getenv
-from time import time
+from time import sleep, time
+import checkpoint
 import device
+import registry
+import snmp
+import state
 
 # Logging config
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 
+#
+# returns time (as time.time()) the device of job is to be done by: job['budget'] seconds from now,
+# but no later than job['deadline'] of the whole run. None if neither is set.
+#
+def dueTime(job):
+    due = job.get('deadline')
+    if job.get('budget'):
+        due = min(due or float('inf'), time() + job['budget'])
+    return due
+
+
+#
+# Polls the device in job, on job['address'] if given, until due (see dueTime). returns (device info,
+# device.Device polled or None if its time was up before it started). Devices that are not done by
+# then get what was collected so far, marked partial.
+#
+def pollDevice(job, due):
+    c = {"sysname": job['hostname']}
+    if due is not None and time() > due:
+        c['partial'] = True
+        return c, None
+    d = device.Device(job.get('address') or job['hostname'])
+    d.deadline = due
+    try:
+        reachable = d.snmpConfig(job['oid'], job['snmpVersion'], job['snmpCommunity'], test=True,
+                                 connection=job.get('connection'))
+    except Exception:
+        reachable = False
+    if reachable:
+        # With a state store, devices whose tables did not change get their previous interface info back
+        store = job.get('state')
+        previous = store.get(job['hostname'], 'info') if store else None
+        deviceinfo = d.getDeviceInfo(previous, incremental=store is not None)
+        # Tables cut short are not kept, or later runs would take them as they are until they change
+        if store and not d.expired() and not d.truncated():
+            store.put(job['hostname'], 'info', {'indicators': d.indicators, 'info': deviceinfo})
+        c.update(deviceinfo)
+    if d.expired():
+        logger.warning("Ran out of time polling %s" % job['hostname'])
+        c['partial'] = True
+    return c, d
+
+
 class InfoWorker(threading.Thread):
     def __init__(self, jobQueue, outputQueue):
         threading.Thread.__init__(self)
         self.jobQueue = jobQueue
         self.outputQueue = outputQueue
+        self.lock = threading.Lock()
+        # Job being polled and the time it is due, None while waiting for one
+        self.job = None
+        self.due = None
+        # Set by WorkerPool when it gave up on us. The job is answered for, we just go away.
+        self.abandoned = False
+
+    # returns device info of the device in job. Devices whose time is up before they are done
+    # (see dueTime) get what was collected so far, marked partial.
+    def poll(self, job, due):
+        return pollDevice(job, due)[0]
 
     def run(self):
         while True:
@@ -26,17 +85,267 @@ class InfoWorker(threading.Thread):
                 job = self.jobQueue.get()
             except Queue.Empty:
                 break
-            c = {"sysname": job['hostname']}
-            d = device.Device(job['hostname'])
+            due = dueTime(job)
+            with self.lock:
+                self.job, self.due = job, due
             try:
-                reachable = d.snmpConfig(job['oid'], job['snmpVersion'], job['snmpCommunity'], test=True)
-            except:
-                reachable = False
-            if reachable:
-                c.update(d.getDeviceInfo())
+                c = self.poll(job, due)
+            except Exception as e:
+                logger.error("Polling %s failed: %s" % (job['hostname'], e))
+                c = {"sysname": job['hostname'], 'partial': True}
+            with self.lock:
+                if self.abandoned:
+                    return
+                self.job = self.due = None
             self.outputQueue.put({job['hostname']: c})
             self.jobQueue.task_done()
 
+
+class WorkerPool:
+    __doc__ = "InfoWorker threads on a job queue, replacing those that die or stay too long on a device"
+
+    # Workers get grace seconds past the time their device is due (see dueTime) to give up on it
+    # themselves. After that, or if a worker dies, the device is output as partial without it
+    # and a new worker takes its place. By default grace is the longest a request can take.
+    def __init__(self, jobQueue, outputQueue, workers, grace=None, interval=0.5):
+        self.jobQueue = jobQueue
+        self.outputQueue = outputQueue
+        if grace is None:
+            grace = snmp.tracker.maxTimeout * (snmp.tracker.retries + 1)
+        self.grace = grace
+        self.interval = interval
+        self.workers = [self.startWorker() for i in range(workers)]
+        supervisor = threading.Thread(target=self.supervise)
+        supervisor.daemon = True
+        supervisor.start()
+
+    # Waits for a free place on the job queue. Unlike Queue.put, lets Ctrl-C through.
+    def put(self, job):
+        while True:
+            try:
+                return self.jobQueue.put(job, timeout=self.interval)
+            except Queue.Full:
+                pass
+
+    # Waits for all jobs to be done. Unlike Queue.join, lets Ctrl-C through.
+    def join(self):
+        with self.jobQueue.all_tasks_done:
+            while self.jobQueue.unfinished_tasks:
+                self.jobQueue.all_tasks_done.wait(self.interval)
+
+    def startWorker(self):
+        w = InfoWorker(self.jobQueue, self.outputQueue)
+        w.daemon = True
+        w.start()
+        return w
+
+    def supervise(self):
+        while True:
+            sleep(self.interval)
+            now = time()
+            for i, w in enumerate(self.workers):
+                with w.lock:
+                    job = w.job
+                    overdue = job is not None and w.due is not None and now > w.due + self.grace
+                    if w.is_alive() and not overdue:
+                        continue
+                    w.abandoned = True
+                if job:
+                    logger.error("Gave up on %s, output as partial" % job['hostname'])
+                    self.outputQueue.put({job['hostname']: {"sysname": job['hostname'], 'partial': True}})
+                    self.jobQueue.task_done()
+                else:
+                    logger.error("Worker died, starting another one")
+                self.workers[i] = self.startWorker()
+
+
+class ResultWriter(threading.Thread):
+    def __init__(self, outputQueue, outfile=None, progress=None, devices=None):
+        threading.Thread.__init__(self)
+        self.outputQueue = outputQueue
+        self.outfile = outfile
+        self.progress = progress
+        self.devices = devices
+
+    # Writes results as one JSON object per line to outfile until it gets None. Results are also
+    # appended to progress (a checkpoint.Checkpoint) and collected into devices, if given.
+    def run(self):
+        while True:
+            result = self.outputQueue.get()
+            if result is None:
+                break
+            if self.progress:
+                self.progress.append(result)
+            if self.devices is not None:
+                self.devices.update(result)
+            if self.outfile:
+                self.outfile.write(json.dumps(result) + "\n")
+                self.outfile.flush()
+
+
+class ShardProcess(multiprocessing.Process):
+    def __init__(self, hostQueue, resultQueue, job, workers, shards):
+        multiprocessing.Process.__init__(self)
+        self.hostQueue = hostQueue
+        self.resultQueue = resultQueue
+        self.job = job
+        self.workers = workers
+        self.shards = shards
+
+    # Polls hostnames from hostQueue, until None, with workers InfoWorker threads.
+    # Results go on resultQueue as they come, followed by ('done', {hostname: state} of the hosts polled,
+    # snapshot of snmp.metrics.stats, name of this process).
+    def run(self):
+        # Every process gets its share of the request rate. Devices are polled by one process only,
+        # so per device limits hold as they are. Devices of a subnet are spread over all processes by
+        # hostname, so each gets its share of the per subnet limit too, at least one request.
+        t = snmp.throttle
+        perSubnet = max(1, t.perSubnet // self.shards) if t.perSubnet else 0
+        t.configure(t.rate / self.shards, perDevice=t.perDevice, perSubnet=perSubnet, subnetBits=t.subnetBits)
+        jobQ = Queue.Queue(maxsize=self.workers * 2)
+        pool = WorkerPool(jobQ, self.resultQueue, self.workers)
+
+        polled = []
+        for hostname in iter(self.hostQueue.get, None):
+            polled.append(hostname)
+            pool.put(dict(self.job, hostname=hostname))
+        pool.join()
+        snmp.stopDispatcher()
+        logHostSummary()
+        # Cached results are written by every process, the parent has none of them
+        snmp.cache.results.flush()
+
+        # Our copy of the state store (if any) was forked from the parent's. Send back what changed.
+        store = self.job.get('state')
+        states = {}
+        if store:
+            states = dict((x, store.devices[x]) for x in polled if x in store.devices)
+        self.resultQueue.put(('done', states, snmp.metrics.stats.snapshot(), self.name))
+
+
+#
+# Polls hosts (any iterable of hostnames) in processes worker processes of workers threads each.
+# Hosts are sharded by hostname, so a device is always polled by the same process.
+# job holds the job fields other than hostname. Results are put on outputQueue as they come,
+# device state goes back into job['state'] if there is a store, metrics into snmp.metrics.stats.
+#
+def pollShards(hosts, processes, workers, job, outputQueue):
+    resultQueue = multiprocessing.Queue()
+    hostQueues = []
+    shards = []
+    for i in range(processes):
+        hostQueues.append(multiprocessing.Queue(maxsize=workers * 2))
+        p = ShardProcess(hostQueues[i], resultQueue, job, workers, processes)
+        p.daemon = True
+        p.start()
+        shards.append(p)
+
+    # Hands hostname (or None for the end) to shard i. returns False if the process died.
+    def handOut(i, hostname):
+        while True:
+            try:
+                hostQueues[i].put(hostname, timeout=1)
+                return True
+            except Queue.Full:
+                if not shards[i].is_alive():
+                    return False
+
+    def handle(result, running):
+        if isinstance(result, tuple):
+            running.discard(result[3])
+            for hostname, sections in result[1].items():
+                if 'info' in sections:
+                    job['state'].put(hostname, 'info', sections['info'])
+            snmp.metrics.stats.merge(result[2])
+        else:
+            outputQueue.put(result)
+
+    # Results of a process are all on resultQueue by the time it exits, so a process found dead
+    # that has not said it is done after they are read never will.
+    def collect():
+        running = set(p.name for p in shards)
+        while running:
+            try:
+                handle(resultQueue.get(timeout=1), running)
+                continue
+            except Queue.Empty:
+                pass
+            dead = [p for p in shards if p.name in running and not p.is_alive()]
+            if not dead:
+                continue
+            try:
+                while True:
+                    handle(resultQueue.get_nowait(), running)
+            except Queue.Empty:
+                pass
+            for p in dead:
+                if p.name in running:
+                    logger.error("Shard process %s died with exit code %s, its devices are left out"
+                                 % (p.name, p.exitcode))
+                    running.discard(p.name)
+
+    collector = threading.Thread(target=collect)
+    collector.daemon = True
+    collector.start()
+    for hostname in hosts:
+        i = hash(hostname) % processes
+        if not handOut(i, hostname):
+            logger.debug("Not polling %s, shard process %s died" % (hostname, shards[i].name))
+    for i in range(processes):
+        handOut(i, None)
+    while collector.is_alive():
+        collector.join(1)
+
+
+#
+# Yields hostnames from lines of text, either lldp.py list output or whitespace separated names.
+#
+def readHosts(lines):
+    for line in lines:
+        for word in line.split():
+            hostname = word.strip('[],"\'')
+            if hostname:
+                yield hostname
+
+
+#
+# returns dict of hostname: device info of the devices done in checkpoint records (results as output
+# with -n), leaving out devices output as partial.
+#
+def resumedDevices(records):
+    devices = {}
+    for record in records:
+        if isinstance(record, dict):
+            devices.update(record)
+    return dict((x, c) for x, c in devices.items() if isinstance(c, dict) and not c.get('partial'))
+
+
+#
+# Logs hosts that answered slowly or not at all (see snmp.HostTracker).
+#
+def logHostSummary():
+    summary = snmp.tracker.summary()
+    for host, srtt in sorted(summary['slow'].items(), key=lambda x: -x[1]):
+        logger.warning("Slow host %s: %.3fs smoothed round trip time" % (host, srtt))
+    if summary['dead']:
+        logger.error("%s hosts did not answer: %s" % (len(summary['dead']), " ".join(summary['dead'])))
+
+
+#
+# Writes SNMP metrics (see snmp.metrics) to jsonfile and prometheusfile, if given,
+# and the time spent per polling phase to stderr if profile.
+#
+def writeMetrics(jsonfile=None, prometheusfile=None, profile=False):
+    stats = snmp.metrics.stats
+    if jsonfile:
+        with open(jsonfile, 'w') as f:
+            json.dump(stats.snapshot(), f, indent=4, separators=(',', ': '))
+    if prometheusfile:
+        with open(prometheusfile, 'w') as f:
+            f.write(stats.prometheus())
+    if profile:
+        sys.stderr.write("\n".join(stats.profile()) + "\n")
+
 if __name__ == "__main__":
     # Benchmarking performance
     startTime = time()
@@ -45,8 +354,25 @@ if __name__ == "__main__":
     defaultCommunity = getenv('SNMPCOMMUNITY', 'public')
     defaultLogfile = getenv('LOGFILE', None)
     defaultOidfile = getenv('OIDFILE', 'oid.json')
-    defaultWorkers = getenv('WORKERS', 100)
+    defaultWorkers = int(getenv('WORKERS', 100))
+    defaultProcesses = int(getenv('PROCESSES', 1))
+    defaultEngine = getenv('SNMPENGINE', 'netsnmp')
+    defaultStatefile = getenv('STATEFILE', None)
+    defaultRate = float(getenv('SNMPRATE', 0))
+    defaultDeviceLimit = int(getenv('DEVICELIMIT', 0))
+    defaultSubnetLimit = int(getenv('SUBNETLIMIT', 0))
+    defaultCache = getenv('SNMPCACHE', None)
+    defaultBudget = float(getenv('DEVICEBUDGET', 0))
+    defaultDeadline = float(getenv('DEADLINE', 0))
+    defaultCacheTtl = getenv('CACHETTL', '300')
+    defaultCheckpoint = getenv('CHECKPOINT', None)
+    defaultUser = getenv('SNMPUSER', None)
+    defaultAuthProtocol = getenv('SNMPAUTHPROTOCOL', 'SHA')
+    defaultAuthPassword = getenv('SNMPAUTHPASSWORD', None)
+    defaultPrivProtocol = getenv('SNMPPRIVPROTOCOL', 'AES')
+    defaultPrivPassword = getenv('SNMPPRIVPASSWORD', None)
     snmpVersion = 2
+    engines = {'netsnmp': snmp.Connection, 'async': snmp.AsyncConnection}
 
     # Command line option parsing and help text (-h)
     parser = argparse.ArgumentParser()
@@ -54,6 +380,17 @@ if __name__ == "__main__":
                         help="File to read list of devices from (defaults to reading from stdin)")
     parser.add_argument("-c", "--community", default=defaultCommunity,
                         help="SNMP community (default: %s)" % defaultCommunity)
+    parser.add_argument("-u", "--user", default=defaultUser,
+                        help="SNMPv3 user. Polls with SNMPv3 (netsnmp engine only) instead of the community, "
+                        "authPriv with both passwords")
+    parser.add_argument("--auth-protocol", choices=snmp.usm.authProtocols, default=defaultAuthProtocol,
+                        help="SNMPv3 authentication protocol (default: %s)" % defaultAuthProtocol)
+    parser.add_argument("--auth-password", default=defaultAuthPassword,
+                        help="SNMPv3 authentication password")
+    parser.add_argument("--priv-protocol", choices=['AES', 'DES'], default=defaultPrivProtocol,
+                        help="SNMPv3 privacy protocol (default: %s)" % defaultPrivProtocol)
+    parser.add_argument("--priv-password", default=defaultPrivPassword,
+                        help="SNMPv3 privacy password")
     parser.add_argument("-q", "--quiet", action="store_true",
                         help="Do not display or log errors")
     parser.add_argument("-l", "--logfile", default=defaultLogfile,
@@ -62,9 +399,66 @@ if __name__ == "__main__":
                         help="Increase verbosity when using logfile.")
     parser.add_argument("-o", "--oidfile", default=defaultOidfile,
                         help="JSON file containing SNMP OIDs (default: %s)" % defaultOidfile)
-    parser.add_argument("-w", "--workers", default=defaultWorkers,
+    parser.add_argument("-w", "--workers", type=int, default=defaultWorkers,
                         help="Number of threads to spawn (default: %s)" % defaultWorkers)
+    parser.add_argument("-p", "--processes", type=int, default=defaultProcesses,
+                        help="Number of processes to shard devices over, each with WORKERS threads "
+                        "(default: %s)" % defaultProcesses)
+    parser.add_argument("-e", "--engine", choices=sorted(engines), default=defaultEngine,
+                        help="SNMP engine, netsnmp sessions or shared async sockets (default: %s)" % defaultEngine)
+    parser.add_argument("-r", "--rate", type=float, default=defaultRate,
+                        help="Most SNMP requests to send per second, 0 for no limit (default: %s)" % defaultRate)
+    parser.add_argument("--device-limit", type=int, default=defaultDeviceLimit,
+                        help="Most SNMP requests in flight per device, 0 for no limit (default: %s)"
+                        % defaultDeviceLimit)
+    parser.add_argument("--subnet-limit", type=int, default=defaultSubnetLimit,
+                        help="Most SNMP requests in flight per /24 subnet, 0 for no limit (default: %s)"
+                        % defaultSubnetLimit)
+    parser.add_argument("-b", "--budget", type=float, default=defaultBudget,
+                        help="Most seconds to spend on a device, 0 for no limit. Devices taking longer are "
+                        "output with what was collected so far, marked partial (default: %s)" % defaultBudget)
+    parser.add_argument("-d", "--deadline", type=float, default=defaultDeadline,
+                        help="Most seconds for the whole run, 0 for no limit. Devices not done by then are "
+                        "output marked partial (default: %s)" % defaultDeadline)
+    parser.add_argument("-s", "--statefile", default=defaultStatefile,
+                        help="File to keep device state in between runs. Devices whose LLDP and interface "
+                        "tables did not change since the last run are not walked again.")
+    parser.add_argument("--cache", default=defaultCache,
+                        help="SQLite file to cache SNMP results in, shared by lldp.py and getinfo.py runs")
+    parser.add_argument("--cache-ttl", default=defaultCacheTtl,
+                        help="Seconds to keep cached results, optionally per OID group like "
+                        "'300,indicators=60,vendor=86400' (default: %s)" % defaultCacheTtl)
+    parser.add_argument("--metrics",
+                        help="Write SNMP request counters and histograms per host and OID group to this JSON file")
+    parser.add_argument("--prometheus",
+                        help="Write the same metrics to this file in Prometheus text format")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print time spent per polling phase to stderr at the end")
+    parser.add_argument("-n", "--ndjson", action="store_true",
+                        help="Read devices line by line and write one JSON object per device and line "
+                        "as soon as it is polled")
+    parser.add_argument("--checkpoint", default=defaultCheckpoint,
+                        help="File to append every device polled to, to resume the run from if it is "
+                        "interrupted")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the run in the checkpoint file instead of starting over. Devices "
+                        "done already are output as they were and not polled again.")
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("WORKERS must be at least 1")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs a --checkpoint file")
+    # SNMPv3 user, or the community of version 2c
+    community = args.community
+    if args.user:
+        if args.engine != 'netsnmp':
+            parser.error("SNMPv3 needs the netsnmp engine")
+        snmpVersion = 3
+        try:
+            community = snmp.usm.User(args.user, args.auth_password, args.priv_password,
+                                      args.auth_protocol, args.priv_protocol)
+        except ValueError as e:
+            parser.error(str(e))
     # In the logging module, following levels are defined:
     # Critical: 50, Error: 40, Warn: 30, Info: 20, Debug: 10
     # args.verbose holds the number of '-v' specified.
@@ -93,10 +487,68 @@ if __name__ == "__main__":
     inputtext = None
     jobQ = Queue.Queue()
     resultQ = Queue.Queue()
+    store = state.StateStore(args.statefile) if args.statefile else None
+    progress = checkpoint.Checkpoint(args.checkpoint, args.resume) if args.checkpoint else None
+    # Devices done before the run we resume was interrupted
+    resumed = resumedDevices(progress.records) if progress else {}
+    if resumed:
+        logger.info("Resuming run with %s devices done" % len(resumed))
+
+    snmp.throttle.configure(args.rate, perDevice=args.device_limit, perSubnet=args.subnet_limit)
+    snmp.cache.results.configure(args.cache, *snmp.cache.parseTtls(args.cache_ttl))
 
     # Load OID data
-    with open(args.oidfile) as oidlist:
-        oid = json.load(oidlist)
+    oid = registry.load(args.oidfile)
+    # Everything in a job but the hostname
+    job = {'oid': oid, 'snmpVersion': snmpVersion, 'snmpCommunity': community,
+           'connection': engines[args.engine], 'state': store, 'budget': args.budget,
+           'deadline': startTime + args.deadline if args.deadline else None}
+
+    if args.ndjson:
+        # Streaming: devices are read into a bounded queue as workers take them, and written out
+        # as soon as they are done, so memory use does not depend on the number of devices.
+        mainLoopStartTime = time()
+        for hostname, c in resumed.items():
+            sys.stdout.write(json.dumps({hostname: c}) + "\n")
+        writer = ResultWriter(resultQ, sys.stdout, progress)
+        writer.daemon = True
+        writer.start()
+
+        inputfile = sys.stdin
+        if args.inputfile:
+            try:
+                inputfile = open(args.inputfile)
+            except IOError:
+                logger.error("Could not read from file %s" % args.inputfile)
+        if inputfile is sys.stdin and sys.stdin.isatty():
+            logger.debug("Detected TTY at STDIN.")
+            logger.error("Reading list of devices from STDIN. Press ^D when done, or ^C to quit.")
+
+        hosts = (x for x in readHosts(inputfile) if x not in resumed)
+        if args.processes > 1:
+            pollShards(hosts, args.processes, args.workers, job, resultQ)
+        else:
+            jobQ = Queue.Queue(maxsize=args.workers * 2)
+            pool = WorkerPool(jobQ, resultQ, args.workers)
+            for hostname in hosts:
+                pool.put(dict(job, hostname=hostname))
+            pool.join()
+
+        # Wait for the writer
+        resultQ.put(None)
+        writer.join()
+        snmp.stopDispatcher()
+
+        logger.info("Time spent in main loop: %s" % (time() - mainLoopStartTime))
+        logHostSummary()
+        writeMetrics(args.metrics, args.prometheus, args.profile)
+        if store:
+            store.save()
+        snmp.cache.results.flush()
+        if progress:
+            progress.close()
+        logger.info("Time spent in program: %s" % (time() - startTime))
+        sys.exit()
 
     if args.inputfile:
         try:
@@ -119,28 +571,38 @@ if __name__ == "__main__":
         inputlist = inputtext.split()
 
     mainLoopStartTime = time()
+    devices.update(resumed)
+    inputlist = [x for x in inputlist if x not in resumed]
+    writer = ResultWriter(resultQ, progress=progress, devices=devices)
+    writer.daemon = True
+    writer.start()
 
-    # Populate job queue
-    for hostname in inputlist:
-        jobQ.put({'hostname': hostname, 'oid': oid, 'snmpVersion': snmpVersion, 'snmpCommunity': args.community})
+    if args.processes > 1:
+        pollShards(inputlist, args.processes, min(args.workers, len(inputlist)), job, resultQ)
+    else:
+        # Populate job queue
+        for hostname in inputlist:
+            jobQ.put(dict(job, hostname=hostname))
 
-    # Start threads
-    for i in range(min(args.workers, len(inputlist))):
-        w = InfoWorker(jobQ, resultQ)
-        w.daemon = True
-        w.start()
+        # Start threads
+        pool = WorkerPool(jobQ, resultQ, min(args.workers, len(inputlist)))
 
-    # Wait for workers to complete
-    jobQ.join()
+        # Wait for workers to complete
+        pool.join()
 
-    # Build a list out of output queue
-    try:
-        while True:
-            devices.update(resultQ.get_nowait())
-    except Queue.Empty:
-        pass
+    # Wait for the writer to collect all results
+    resultQ.put(None)
+    writer.join()
+    snmp.stopDispatcher()
 
     logger.info("Time spent in main loop: %s" % (time() - mainLoopStartTime))
+    logHostSummary()
+    writeMetrics(args.metrics, args.prometheus, args.profile)
+    if store:
+        store.save()
+    snmp.cache.results.flush()
+    if progress:
+        progress.close()
 
     print(json.dumps(devices, sort_keys=False, indent=4, separators=(',', ': ')))
     logger.info("Time spent in program: %s" % (time() - startTime))
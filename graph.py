@@ -7,15 +7,12 @@ import argparse
 from os import getenv
 import logging
 import pydot
+import topology
 
 # Logging config
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-# Globals
-checked = []
-graph = pydot.Dot(graph_type='graph', ranksep='1')
-
 
 def get_object_from_file(filename):
     '''
@@ -60,37 +57,29 @@ def get_object_from_stdin():
     return j
 
 
-def build_graph(devicelist, root):
-    global checked
-    global graph
-
+def build_graph(devicelist, roots, topo=None):
+    '''
+    Draws every link between devices reachable from roots (one or more device names) once.
+    topo is a topology.Topology of devicelist, loaded here if not given.
+    Returns pydot graph, or None.
+    '''
     if not devicelist:
         logger.error("Device list empty.")
         return None
 
-    if root in checked:
-        logger.warning("%s already checked. Skipping." % root)
-        return None
-
-    checked.append(root)
-    device = devicelist.get(root)
-
-    if not device:
-        logger.error("No data on %s" % root)
-        return None
+    topo = topo or topology.Topology.fromDeviceInfo(devicelist)
+    for root in roots:
+        if root not in devicelist:
+            logger.error("No data on %s" % root)
 
-    logger.info("Checking %s" % device.get('sysname'))
-
-    if device.get('if') is not None:
-        for interface in device.get('if'):
-            logger.info("Device %s has neighbour %s" % (device.get('sysname'), interface.get('neighbour')))
-            if interface.get('neighbour') not in checked:
-                logger.info("Adding relationship to graph")
-                edge = pydot.Edge(device.get('sysname'), interface.get('neighbour'), minlen='1.5')
-                if interface.get('speed', 10) > 100:
-                    edge.set_style('bold')
-                graph.add_edge(edge)
-                build_graph(devicelist, interface.get('neighbour'))
+    graph = pydot.Dot(graph_type='graph', ranksep='1')
+    for device, neighbour, speed in topo.links(roots):
+        logger.info("Device %s has neighbour %s" % (device, neighbour))
+        edge = pydot.Edge(device, neighbour, minlen='1.5')
+        if speed > 100:
+            edge.set_style('bold')
+        graph.add_edge(edge)
+    return graph
 
 if __name__ == "__main__":
     # Fallback values
@@ -100,8 +89,8 @@ if __name__ == "__main__":
 
     # Parse command line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("root",
-                        help="Device to put as root of the graph", metavar="ROOT")
+    parser.add_argument("root", nargs='+',
+                        help="Device(s) to put as root of the graph", metavar="ROOT")
     parser.add_argument("-i", "-f", "--infofile", default=defaultInfofile,
                         help="File to read info about devices from (default: %s or stdin)" % defaultInfofile)
     parser.add_argument("-o", "--outfile", default=defaultOutfile,
@@ -144,6 +133,8 @@ if __name__ == "__main__":
         logger.error("No JSON found in %s or in stdin. Giving up." % args.infofile)
         sys.exit()
 
-    build_graph(devicelist, args.root)
+    graph = build_graph(devicelist, args.root)
+    if graph is None:
+        sys.exit()
 
     graph.write_png(args.outfile)
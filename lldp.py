@@ -3,92 +3,344 @@
 # Compile net-snmp with python bindings
 
 import logging
-from json import dumps, load
+import threading
+import Queue
+from json import dumps
 from argparse import ArgumentParser
 from os import getenv
+import checkpoint
 import device
-
-# Fallback values
-defaultCommunity = getenv('SNMPCOMMUNITY', 'public')
-defaultLogfile = getenv('LOGFILE', None)
-defaultOidfile = getenv('OIDFILE', 'oid.json')
-snmpVersion = 2
-
-# Command line option parsing and help text (-h)
-usage = "%(prog)s [options] COMMAND HOST"
-parser = ArgumentParser(usage=usage)
-parser.add_argument("command",
-                    help="list or tree (default: list)", metavar="COMMAND")
-parser.add_argument("host",
-                    help="hostname or IP address", metavar="HOST")
-parser.add_argument("-c", "--community", default=defaultCommunity,
-                    help="SNMP community (default: %s)" % defaultCommunity)
-parser.add_argument("-q", "--quiet", action="store_true",
-                    help="Do not display or log errors")
-parser.add_argument("-l", "--logfile", default=defaultLogfile,
-                    help="Log file (Default is logging to STDERR)")
-parser.add_argument("-o", "--oidfile", default=defaultOidfile,
-                    help="JSON file containing SNMP OIDs (default: oid.json)")
-args = parser.parse_args()
-
-# List of devices we've already checked.
-checked = []
+import getinfo
+import registry
+import snmp
+import state
+import topology
 
 # Logging config
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
-# By default, log to stderr.
-ch = logging.StreamHandler()
-ch.setLevel(logging.ERROR)
-logger.addHandler(ch)
-# If file name provided for logging, write detailed log.
-if args.logfile:
-    fh = logging.FileHandler(args.logfile)
-    fh.setLevel(logging.DEBUG)
-    logger.addHandler(fh)
-# If quiet mode, disable all logging.
-if args.quiet:
-    logger.disabled = True
-
-
-def gettree(host, trunk="id", branches="children"):
+
+
+class NeighbourWorker(threading.Thread):
+    def __init__(self, jobQueue, outputQueue):
+        threading.Thread.__init__(self)
+        self.jobQueue = jobQueue
+        self.outputQueue = outputQueue
+
+    # returns neighbours (see Device.getNeighbours) of the device in job and the
+    # management addresses they advertise (see Device.getNeighbourAddresses), if asked for.
+    def poll(self, job):
+        # Talk to the advertised management address if we have one, saves resolving the name.
+        d = device.Device(job.get('address') or job['hostname'])
+        d.snmpConfig(job['oid'], job['snmpVersion'], job['snmpCommunity'], connection=job['connection'])
+
+        store = job.get('state')
+        if store:
+            previous = store.get(job['hostname'], 'lldp')
+            d.getChangeIndicators()
+            if (previous and device.tablesUnchanged(previous['indicators'], d.indicators) and
+                    (previous['addresses'] is not None or not job['managementAddresses'])):
+                logger.debug("LLDP table of %s did not change since the last run", job['hostname'])
+                return previous['neighbours'], previous['addresses']
+
+        neighbours = d.getNeighbours()
+        advertised = None
+        if job['managementAddresses']:
+            advertised = (neighbours and d.getNeighbourAddresses()) or {}
+        # Tables cut short are not kept, or later runs would take them as they are until they change
+        if store and not d.truncated():
+            store.put(job['hostname'], 'lldp', {'indicators': d.indicators, 'neighbours': neighbours,
+                                                'addresses': advertised})
+        return neighbours, advertised
+
+    # returns dict of neighbour name: management address, from neighbours and the addresses
+    # advertised by LLDP remote table index.
+    @staticmethod
+    def addresses(job, neighbours, advertised):
+        addresses = {}
+        if neighbours and advertised:
+            for n in neighbours:
+                index = device.oidIndex(n, job['oid']['lldp']['remotesysname'])
+                if index in advertised:
+                    addresses[neighbours[n]] = advertised[index]
+        return addresses
+
+    # returns (hostname, neighbours, {neighbour name: management address}) of the device in job.
+    def work(self, job):
+        neighbours = None
+        addresses = {}
+        try:
+            neighbours, advertised = self.poll(job)
+            addresses = self.addresses(job, neighbours, advertised)
+        except Exception as e:
+            logger.debug("Could not get neighbours of %s: %s", job['hostname'], e)
+        return job['hostname'], neighbours, addresses
+
+    # Works on jobs until it gets None.
+    def run(self):
+        while True:
+            job = self.jobQueue.get()
+            if job is None:
+                break
+            self.outputQueue.put(self.work(job))
+            self.jobQueue.task_done()
+
+
+class InventoryWorker(NeighbourWorker):
+    # Collects device info of the device in job as getinfo.py does (see getinfo.pollDevice), which
+    # walks its LLDP neighbours on the way. returns (hostname, neighbours, {neighbour name:
+    # management address}, device info).
+    def work(self, job):
+        neighbours = None
+        addresses = {}
+        try:
+            info, d = getinfo.pollDevice(job, getinfo.dueTime(job))
+            if d is not None:
+                neighbours = d.neighbours
+                if neighbours is None and info.get('if'):
+                    # Unchanged since the last run. Neighbours are those of the previous info, but the
+                    # addresses they advertise are keyed by LLDP index, so with those they are walked.
+                    if job['managementAddresses'] and not d.expired():
+                        neighbours = d.getNeighbours()
+                    if not neighbours:
+                        neighbours = dict((str(i), x['neighbour']) for i, x in enumerate(info['if']))
+                if neighbours and job['managementAddresses'] and not d.expired():
+                    addresses = self.addresses(job, neighbours, d.getNeighbourAddresses())
+        except Exception as e:
+            logger.debug("Could not get info of %s: %s", job['hostname'], e)
+            info = {'sysname': job['hostname'], 'partial': True}
+        return job['hostname'], neighbours, addresses, info
+
+
+def discover(host, oid, snmpVersion=2, snmpCommunity='public', workers=10, connection=None,
+             managementAddresses=False, store=None, trunk="id", branches="children", devices=None,
+             progress=None):
     '''
-    returns None if SNMP failed, or a dict with device info and neighbours.
+    Breadth-first LLDP discovery starting at host, polling up to workers devices at once.
+    With managementAddresses, neighbours are polled on the address they advertise over LLDP.
+    With a state.StateStore, devices whose LLDP table did not change since the last run are not walked.
+    With a devices dict, the full device info of every device found is collected into it in the same
+    pass, as getinfo.py would output it, instead of only its neighbours.
+    With a checkpoint.Checkpoint, the result of every device polled is appended to it. Results it
+    holds already, from an interrupted crawl from the same host, are taken as they are, and the crawl
+    goes on with the devices they found that were not polled yet.
+    returns list of hostnames in the order they were found, and tree of dicts with neighbours.
+    Raises ValueError if workers is less than 1.
     '''
-    # List of devices we've already checked.
-    global checked
-    c = {trunk: host}
-
-    try:
-        d = device.Device(host)
-        d.snmpConfig(oid, snmpVersion, args.community)
-    except:
-        return c
-
-    neighbours = d.getNeighbours()
-    if not neighbours:
-        return c
-
-    children = []
-
-    # Have we already checked this device? Loop prevention.
-    for x in neighbours.values():
-        if x and (x not in checked):
-            logger.debug("%s has neighbour %s", host, x)
-            # Recurse!
-            checked.append(x)
-            children.append(gettree(x))
-    if children:
-        c[branches] = children
-    return c
+    if workers < 1:
+        raise ValueError("Need at least one worker, not %s" % workers)
+    # Devices we've already seen. Loop prevention.
+    checked = [host]
+    seen = set(checked)
+    # Devices polled, and management addresses of those found
+    done = set()
+    advertised = {}
+    topo = topology.Topology()
+    topo.addDevice(host)
+    jobQ = Queue.Queue()
+    resultQ = Queue.Queue()
+
+    # returns hostnames first seen as neighbours of the device in result.
+    def add(result):
+        host, neighbours, addresses = result[:3]
+        done.add(host)
+        if devices is not None:
+            devices[host] = result[3]
+        found = []
+        if not neighbours:
+            return found
+
+        d = topo.addDevice(host)
+        for x in neighbours.values():
+            if not x:
+                continue
+            topo.addLink(d, topo.addDevice(x))
+            if x not in seen:
+                logger.debug("%s has neighbour %s", host, x)
+                seen.add(x)
+                checked.append(x)
+                advertised[x] = addresses.get(x)
+                found.append(x)
+        return found
+
+    def poll(x):
+        jobQ.put({'hostname': x, 'address': advertised.get(x), 'oid': oid, 'snmpVersion': snmpVersion,
+                  'snmpCommunity': snmpCommunity, 'connection': connection,
+                  'managementAddresses': managementAddresses, 'state': store})
+
+    if progress:
+        crawl = {'discover': host, 'inventory': devices is not None}
+        records = progress.records
+        if records and records[0] != crawl:
+            logger.error("Checkpoint %s is of another crawl (%s), starting over" % (progress.filename, records[0]))
+            progress.clear()
+            records = []
+        if not records:
+            progress.append(crawl)
+        for result in records[1:]:
+            add(result)
+        if records:
+            logger.info("Resuming crawl with %s of %s devices polled" % (len(done), len(checked)))
+
+    for i in range(workers):
+        w = (NeighbourWorker if devices is None else InventoryWorker)(jobQ, resultQ)
+        w.daemon = True
+        w.start()
+
+    pending = 0
+    for x in checked:
+        if x not in done:
+            poll(x)
+            pending += 1
+    while pending:
+        # Waiting with a timeout lets Ctrl-C through
+        try:
+            result = resultQ.get(timeout=1)
+        except Queue.Empty:
+            continue
+        pending -= 1
+        if progress:
+            progress.append(result)
+        for x in add(result):
+            poll(x)
+            pending += 1
+
+    # Let the workers go
+    for i in range(workers):
+        jobQ.put(None)
+    return checked, topo.tree(checked[0], trunk, branches)
 
 if __name__ == "__main__":
+    # Fallback values
+    defaultCommunity = getenv('SNMPCOMMUNITY', 'public')
+    defaultLogfile = getenv('LOGFILE', None)
+    defaultOidfile = getenv('OIDFILE', 'oid.json')
+    defaultWorkers = int(getenv('WORKERS', 10))
+    defaultEngine = getenv('SNMPENGINE', 'netsnmp')
+    defaultStatefile = getenv('STATEFILE', None)
+    defaultRate = float(getenv('SNMPRATE', 0))
+    defaultDeviceLimit = int(getenv('DEVICELIMIT', 0))
+    defaultSubnetLimit = int(getenv('SUBNETLIMIT', 0))
+    defaultCache = getenv('SNMPCACHE', None)
+    defaultCacheTtl = getenv('CACHETTL', '300')
+    defaultCheckpoint = getenv('CHECKPOINT', None)
+    defaultUser = getenv('SNMPUSER', None)
+    defaultAuthProtocol = getenv('SNMPAUTHPROTOCOL', 'SHA')
+    defaultAuthPassword = getenv('SNMPAUTHPASSWORD', None)
+    defaultPrivProtocol = getenv('SNMPPRIVPROTOCOL', 'AES')
+    defaultPrivPassword = getenv('SNMPPRIVPASSWORD', None)
+    snmpVersion = 2
+    engines = {'netsnmp': snmp.Connection, 'async': snmp.AsyncConnection}
+
+    # Command line option parsing and help text (-h)
+    usage = "%(prog)s [options] COMMAND HOST"
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument("command",
+                        help="list or tree (default: list)", metavar="COMMAND")
+    parser.add_argument("host",
+                        help="hostname or IP address", metavar="HOST")
+    parser.add_argument("-c", "--community", default=defaultCommunity,
+                        help="SNMP community (default: %s)" % defaultCommunity)
+    parser.add_argument("-u", "--user", default=defaultUser,
+                        help="SNMPv3 user. Polls with SNMPv3 (netsnmp engine only) instead of the community, "
+                        "authPriv with both passwords")
+    parser.add_argument("--auth-protocol", choices=snmp.usm.authProtocols, default=defaultAuthProtocol,
+                        help="SNMPv3 authentication protocol (default: %s)" % defaultAuthProtocol)
+    parser.add_argument("--auth-password", default=defaultAuthPassword,
+                        help="SNMPv3 authentication password")
+    parser.add_argument("--priv-protocol", choices=['AES', 'DES'], default=defaultPrivProtocol,
+                        help="SNMPv3 privacy protocol (default: %s)" % defaultPrivProtocol)
+    parser.add_argument("--priv-password", default=defaultPrivPassword,
+                        help="SNMPv3 privacy password")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Do not display or log errors")
+    parser.add_argument("-l", "--logfile", default=defaultLogfile,
+                        help="Log file (Default is logging to STDERR)")
+    parser.add_argument("-o", "--oidfile", default=defaultOidfile,
+                        help="JSON file containing SNMP OIDs (default: oid.json)")
+    parser.add_argument("-w", "--workers", type=int, default=defaultWorkers,
+                        help="Number of devices to poll at once (default: %s)" % defaultWorkers)
+    parser.add_argument("-e", "--engine", choices=sorted(engines), default=defaultEngine,
+                        help="SNMP engine, netsnmp sessions or shared async sockets (default: %s)" % defaultEngine)
+    parser.add_argument("-m", "--management-address", action="store_true",
+                        help="Poll neighbours on the management address they advertise over LLDP "
+                        "instead of resolving their name")
+    parser.add_argument("-r", "--rate", type=float, default=defaultRate,
+                        help="Most SNMP requests to send per second, 0 for no limit (default: %s)" % defaultRate)
+    parser.add_argument("--device-limit", type=int, default=defaultDeviceLimit,
+                        help="Most SNMP requests in flight per device, 0 for no limit (default: %s)"
+                        % defaultDeviceLimit)
+    parser.add_argument("--subnet-limit", type=int, default=defaultSubnetLimit,
+                        help="Most SNMP requests in flight per /24 subnet, 0 for no limit (default: %s)"
+                        % defaultSubnetLimit)
+    parser.add_argument("-s", "--statefile", default=defaultStatefile,
+                        help="File to keep device state in between runs. Devices whose LLDP table "
+                        "did not change since the last run are not walked again.")
+    parser.add_argument("--cache", default=defaultCache,
+                        help="SQLite file to cache SNMP results in, shared by lldp.py and getinfo.py runs")
+    parser.add_argument("--cache-ttl", default=defaultCacheTtl,
+                        help="Seconds to keep cached results, optionally per OID group like "
+                        "'300,indicators=60,vendor=86400' (default: %s)" % defaultCacheTtl)
+    parser.add_argument("-i", "--inventory",
+                        help="Collect device info of every device found in the same pass, and write it "
+                        "to this file in getinfo.py output format")
+    parser.add_argument("--checkpoint", default=defaultCheckpoint,
+                        help="File to append the result of every device polled to, to resume the crawl "
+                        "from if it is interrupted")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the crawl in the checkpoint file instead of starting over. "
+                        "Devices polled already are not polled again.")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("WORKERS must be at least 1")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs a --checkpoint file")
+    # SNMPv3 user, or the community of version 2c
+    community = args.community
+    if args.user:
+        if args.engine != 'netsnmp':
+            parser.error("SNMPv3 needs the netsnmp engine")
+        snmpVersion = 3
+        try:
+            community = snmp.usm.User(args.user, args.auth_password, args.priv_password,
+                                      args.auth_protocol, args.priv_protocol)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # By default, log to stderr.
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.ERROR)
+    logger.addHandler(ch)
+    # If file name provided for logging, write detailed log.
+    if args.logfile:
+        fh = logging.FileHandler(args.logfile)
+        fh.setLevel(logging.DEBUG)
+        logger.addHandler(fh)
+    # If quiet mode, disable all logging.
+    if args.quiet:
+        logger.disabled = True
+
+    snmp.throttle.configure(args.rate, perDevice=args.device_limit, perSubnet=args.subnet_limit)
+    snmp.cache.results.configure(args.cache, *snmp.cache.parseTtls(args.cache_ttl))
+
     # Load OID data
-    with open(args.oidfile) as oidlist:
-        oid = load(oidlist)
+    oid = registry.load(args.oidfile)
 
-    checked.append(args.host)
-    t = gettree(args.host)
+    store = state.StateStore(args.statefile) if args.statefile else None
+    devices = {} if args.inventory else None
+    progress = checkpoint.Checkpoint(args.checkpoint, args.resume) if args.checkpoint else None
+    checked, t = discover(args.host, oid, snmpVersion, community, args.workers,
+                          engines[args.engine], args.management_address, store, devices=devices,
+                          progress=progress)
+    snmp.stopDispatcher()
+    if progress:
+        progress.close()
+    if args.inventory:
+        with open(args.inventory, 'w') as f:
+            f.write(dumps(devices, sort_keys=False, indent=4, separators=(',', ': ')))
+    if store:
+        store.save()
+    snmp.cache.results.flush()
 
     if "tree" not in args.command:
         t = checked
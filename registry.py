@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# oid.json compiled once: OIDs as integer tuples, a prefix trie mapping OIDs returned by
+# walks back to (field, index), and vendor lookup by sysObjectID enterprise prefix.
+# The compiled form is cached next to oid.json, so startup does not compile it again.
+
+import json
+import logging
+import marshal
+import os
+from snmp import ber
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Bumped whenever the compiled form changes, so old caches are ignored
+cacheVersion = 1
+
+# Trie node key holding the path of the field an OID belongs to
+leaf = -1
+
+# oid.json section of sysObjectID prefixes by vendor, not OIDs to poll
+vendorSection = 'sysobjectid'
+
+
+# returns integer tuple of a numeric OID, or None if it is not one (e.g. a MIB name).
+def parseOid(oid):
+    try:
+        return ber.parseOid(oid)
+    except (ValueError, TypeError):
+        return None
+
+
+def insert(trie, oid, value):
+    node = trie
+    for x in oid:
+        node = node.setdefault(x, {})
+    node[leaf] = value
+
+
+# returns (value, rest of oid) of the longest prefix of oid in trie, or None.
+def longestPrefix(trie, oid):
+    node = trie
+    found = None
+    for i, x in enumerate(oid):
+        if leaf in node:
+            found = (node[leaf], oid[i:])
+        node = node.get(x)
+        if node is None:
+            return found
+    if leaf in node:
+        found = (node[leaf], ())
+    return found
+
+
+#
+# Compiles nested dict of oid.json, returns dict of path: OID tuple, the prefix trie of those
+# OIDs and the trie of vendor sysObjectID prefixes. Paths are tuples of keys, like ('if', 'ifname')
+# or ('device', 'juniper', 'model').
+#
+def compileOids(strings):
+    oids = {}
+    trie = {}
+    vendors = {}
+
+    def add(path, node):
+        for key, value in node.items():
+            if isinstance(value, dict):
+                add(path + (key,), value)
+                continue
+            oid = parseOid(value)
+            if oid is None:
+                logger.warning("OID %s of %s is not numeric, skipping it", value, '.'.join(path + (key,)))
+                continue
+            oids[path + (key,)] = oid
+            insert(trie, oid, path + (key,))
+
+    for section, node in strings.items():
+        if section == vendorSection:
+            for vendor, prefix in node.items():
+                oid = parseOid(prefix)
+                if oid:
+                    insert(vendors, oid, vendor)
+        elif isinstance(node, dict):
+            add((section,), node)
+    return oids, trie, vendors
+
+
+class Registry:
+    __doc__ = "Compiled oid.json. Indexes like the nested dict of OID strings it was compiled from."
+
+    def __init__(self, strings, compiled=None):
+        self.strings = strings
+        self.oids, self.trie, self.vendors = compiled or compileOids(strings)
+
+    def __getitem__(self, key):
+        return self.strings[key]
+
+    def __contains__(self, key):
+        return key in self.strings
+
+    def get(self, key, default=None):
+        return self.strings.get(key, default)
+
+    #
+    # returns (path of the field, index tuple) of an OID returned by SNMP, e.g.
+    # '.1.3.6.1.2.1.31.1.1.1.1.5' -> (('if', 'ifname'), (5,)), or None if no field is a prefix of it.
+    #
+    def lookup(self, oid):
+        if not isinstance(oid, tuple):
+            oid = parseOid(oid)
+            if oid is None:
+                return None
+        return longestPrefix(self.trie, oid)
+
+    # returns index tuple of an OID returned by a walk on the field at path, or None if it is not under it.
+    def index(self, oid, *path):
+        found = self.lookup(oid)
+        if found and found[0] == path:
+            return found[1]
+        return None
+
+    # returns vendor (key of the 'device' section) whose sysObjectID prefix matches sysobjectid, or None.
+    def vendor(self, sysobjectid):
+        oid = parseOid(sysobjectid)
+        found = oid and longestPrefix(self.vendors, oid)
+        return found[0] if found else None
+
+
+#
+# returns Registry of oid.json file filename. The compiled form is kept in cachefile
+# (filename + '.cache' by default) and used as long as filename does not change.
+#
+def load(filename, cachefile=None):
+    cachefile = cachefile or filename + '.cache'
+    stat = os.stat(filename)
+    source = [filename, stat.st_mtime, stat.st_size]
+    try:
+        with open(cachefile, 'rb') as f:
+            cache = marshal.load(f)
+        if cache.get('version') == cacheVersion and cache.get('source') == source:
+            logger.debug("Using compiled OIDs from %s", cachefile)
+            return Registry(cache['strings'], (cache['oids'], cache['trie'], cache['vendors']))
+    except (IOError, EOFError, ValueError, TypeError, AttributeError):
+        pass
+
+    with open(filename) as f:
+        strings = json.load(f)
+    registry = Registry(strings)
+    cache = {'version': cacheVersion, 'source': source, 'strings': strings, 'oids': registry.oids,
+             'trie': registry.trie, 'vendors': registry.vendors}
+    try:
+        temporary = cachefile + '.tmp'
+        with open(temporary, 'wb') as f:
+            marshal.dump(cache, f)
+        os.rename(temporary, cachefile)
+    except (IOError, OSError) as e:
+        logger.debug("Could not cache compiled OIDs in %s: %s", cachefile, e)
+    return registry
+
+# Registries compiled by compiled(), by id of the dict they were compiled from
+registries = {}
+
+
+# returns Registry of oid, which is either one already or a nested dict as loaded from oid.json.
+def compiled(oid):
+    if isinstance(oid, Registry):
+        return oid
+    registry = registries.get(id(oid))
+    if registry is None or registry.strings is not oid:
+        registry = registries[id(oid)] = Registry(oid)
+    return registry
@@ -1,2 +1,3 @@
-__all__ = ['snmp']
+__all__ = ['snmp', 'ber', 'engine', 'simulator', 'metrics', 'cache', 'usm']
 from snmp import *
+from engine import AsyncConnection, Dispatcher, getDispatcher, stopDispatcher
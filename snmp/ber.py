@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Minimal BER encoding and decoding of SNMPv1/v2c messages.
+# Only what engine.py and friends need: no MIBs, no SET, no traps.
+
+# Universal types
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+SEQUENCE = 0x30
+# Application types
+IPADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+OPAQUE = 0x44
+COUNTER64 = 0x46
+# Varbind exceptions (v2c)
+NOSUCHOBJECT = 0x80
+NOSUCHINSTANCE = 0x81
+ENDOFMIBVIEW = 0x82
+# PDU types
+GET = 0xa0
+GETNEXT = 0xa1
+RESPONSE = 0xa2
+SET = 0xa3
+GETBULK = 0xa5
+REPORT = 0xa8
+
+# PDU error status values
+NOERROR = 0
+TOOBIG = 1
+NOSUCHNAME = 2
+GENERR = 5
+
+# Message version field values
+versions = {1: 0, 2: 1}
+
+unsignedTypes = (COUNTER32, GAUGE32, TIMETICKS, COUNTER64)
+exceptionTypes = (NOSUCHOBJECT, NOSUCHINSTANCE, ENDOFMIBVIEW)
+
+
+class DecodeError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+#
+# '.1.3.6.1.' -> (1, 3, 6, 1). Raises ValueError on anything that is not a numeric OID.
+#
+def parseOid(oid):
+    parts = [x for x in str(oid).strip().split('.') if x != '']
+    if len(parts) < 2:
+        raise ValueError("Not a numeric OID: %s" % oid)
+    return tuple(int(x) for x in parts)
+
+
+#
+# (1, 3, 6, 1) -> '.1.3.6.1'
+#
+def formatOid(oid):
+    return '.' + '.'.join(str(x) for x in oid)
+
+
+def encodeLength(length):
+    if length < 0x80:
+        return bytearray([length])
+    octets = bytearray()
+    while length:
+        octets.insert(0, length & 0xff)
+        length >>= 8
+    return bytearray([0x80 | len(octets)]) + octets
+
+
+def encodeTLV(tag, payload):
+    return bytearray([tag]) + encodeLength(len(payload)) + payload
+
+
+def encodeInteger(value, tag=INTEGER):
+    octets = bytearray()
+    while True:
+        octets.insert(0, value & 0xff)
+        value >>= 8
+        # Stop once the remaining bits are only sign extension of what we have
+        if (value == 0 and not octets[0] & 0x80) or (value == -1 and octets[0] & 0x80):
+            break
+    return encodeTLV(tag, octets)
+
+
+def encodeUnsigned(value, tag):
+    octets = bytearray()
+    while True:
+        octets.insert(0, value & 0xff)
+        value >>= 8
+        if not value:
+            break
+    if octets[0] & 0x80:
+        octets.insert(0, 0)
+    return encodeTLV(tag, octets)
+
+
+def encodeOid(oid):
+    octets = bytearray([oid[0] * 40 + oid[1]])
+    for sub in oid[2:]:
+        chunk = bytearray([sub & 0x7f])
+        sub >>= 7
+        while sub:
+            chunk.insert(0, 0x80 | (sub & 0x7f))
+            sub >>= 7
+        octets += chunk
+    return encodeTLV(OBJECT_IDENTIFIER, octets)
+
+
+def encodeOctets(value, tag=OCTET_STRING):
+    if not isinstance(value, (bytes, bytearray)):
+        value = value.encode('utf-8')
+    return encodeTLV(tag, bytearray(value))
+
+
+def encodeValue(tag, value):
+    if tag == INTEGER:
+        return encodeInteger(int(value))
+    if tag in unsignedTypes:
+        return encodeUnsigned(int(value), tag)
+    if tag == OBJECT_IDENTIFIER:
+        return encodeOid(parseOid(value) if not isinstance(value, tuple) else value)
+    if tag == IPADDRESS:
+        return encodeTLV(tag, bytearray(int(x) for x in value.split('.')))
+    if tag in (OCTET_STRING, OPAQUE):
+        return encodeOctets(value, tag)
+    # NULL and the v2c exceptions carry no value
+    return encodeTLV(tag, bytearray())
+
+
+def encodeVarbind(oid, tag, value):
+    return encodeTLV(SEQUENCE, encodeOid(oid) + encodeValue(tag, value))
+
+
+#
+# Builds a whole SNMP message. varbinds is a list of (oid tuple, type, value).
+# For GETBULK, errorStatus and errorIndex carry non-repeaters and max-repetitions.
+#
+def encodeMessage(version, community, pduType, requestId, varbinds, errorStatus=0, errorIndex=0):
+    encoded = bytearray()
+    for oid, tag, value in varbinds:
+        encoded += encodeVarbind(oid, tag, value)
+    pdu = encodeTLV(pduType, encodeInteger(requestId) + encodeInteger(errorStatus) +
+                    encodeInteger(errorIndex) + encodeTLV(SEQUENCE, encoded))
+    return bytes(encodeTLV(SEQUENCE, encodeInteger(versions.get(version, version)) +
+                           encodeOctets(community) + pdu))
+
+
+#
+# returns (tag, start of value, end of value) of the TLV at pos.
+#
+def decodeTLV(data, pos, end=None):
+    if end is None:
+        end = len(data)
+    if pos + 2 > end:
+        raise DecodeError("Truncated TLV at offset %s" % pos)
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        count = length & 0x7f
+        if not count or pos + count > end:
+            raise DecodeError("Bad length at offset %s" % pos)
+        length = 0
+        for octet in data[pos:pos + count]:
+            length = (length << 8) | octet
+        pos += count
+    if pos + length > end:
+        raise DecodeError("Value overruns message at offset %s" % pos)
+    return tag, pos, pos + length
+
+
+def decodeInteger(data, start, end, signed=True):
+    value = 0
+    for octet in data[start:end]:
+        value = (value << 8) | octet
+    if signed and end > start and data[start] & 0x80:
+        value -= 1 << (8 * (end - start))
+    return value
+
+
+def decodeOid(data, start, end):
+    if start == end:
+        raise DecodeError("Empty OID")
+    first = data[start]
+    oid = [min(first // 40, 2), first - 40 * min(first // 40, 2)]
+    sub = 0
+    for octet in data[start + 1:end]:
+        sub = (sub << 7) | (octet & 0x7f)
+        if not octet & 0x80:
+            oid.append(sub)
+            sub = 0
+    return tuple(oid)
+
+
+def decodeValue(data, tag, start, end):
+    if tag == INTEGER:
+        return decodeInteger(data, start, end)
+    if tag in unsignedTypes:
+        return decodeInteger(data, start, end, signed=False)
+    if tag == OBJECT_IDENTIFIER:
+        return decodeOid(data, start, end)
+    if tag == IPADDRESS:
+        return '.'.join(str(x) for x in data[start:end])
+    if tag in (OCTET_STRING, OPAQUE):
+        return bytes(data[start:end])
+    return None
+
+
+#
+# Parses a whole SNMP message.
+# returns (version, community, PDU type, request ID, error status, error index, varbinds)
+# with varbinds as list of (oid tuple, type, value).
+#
+def decodeMessage(data):
+    data = bytearray(data)
+    try:
+        tag, pos, end = decodeTLV(data, 0)
+        if tag != SEQUENCE:
+            raise DecodeError("Message is not a sequence")
+        tag, start, pos = decodeTLV(data, pos, end)
+        version = decodeInteger(data, start, pos)
+        tag, start, pos = decodeTLV(data, pos, end)
+        community = bytes(data[start:pos])
+        pduType, pos, end = decodeTLV(data, pos, end)
+        header = []
+        for i in range(3):
+            tag, start, pos = decodeTLV(data, pos, end)
+            header.append(decodeInteger(data, start, pos))
+        tag, pos, end = decodeTLV(data, pos, end)
+        varbinds = []
+        while pos < end:
+            tag, start, pos = decodeTLV(data, pos, end)
+            tag, oidStart, oidEnd = decodeTLV(data, start, pos)
+            valueTag, valueStart, valueEnd = decodeTLV(data, oidEnd, pos)
+            varbinds.append((decodeOid(data, oidStart, oidEnd), valueTag,
+                             decodeValue(data, valueTag, valueStart, valueEnd)))
+    except (IndexError, ValueError) as e:
+        raise DecodeError("Malformed message: %s" % e)
+    return (version, community, pduType, header[0], header[1], header[2], varbinds)
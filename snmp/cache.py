@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# SNMP results kept on disk (SQLite) between runs, by host and request, for a TTL per OID group.
+# A discovery run with lldp.py warms the cache for a getinfo.py run on the devices it found,
+# and runs repeated within the TTL send nothing at all.
+
+import logging
+import marshal
+import sqlite3
+import threading
+from time import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+schema = '''CREATE TABLE IF NOT EXISTS results (
+    host TEXT NOT NULL,
+    request TEXT NOT NULL,
+    grp TEXT,
+    expires REAL NOT NULL,
+    value BLOB,
+    PRIMARY KEY (host, request))'''
+
+
+# Parses TTLs like "300" or "300,indicators=60,vendor=86400": default seconds, then seconds per OID group.
+# returns default TTL (ttl if not given) and dict of group: TTL.
+def parseTtls(text, ttl=300):
+    ttls = {}
+    for part in str(text).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            group, seconds = part.split('=', 1)
+            ttls[group.strip()] = float(seconds)
+        else:
+            ttl = float(part)
+    return ttl, ttls
+
+
+class ResultCache:
+    __doc__ = "SNMP results by host and request, kept in a SQLite file for a TTL per OID group"
+
+    def __init__(self, filename=None, ttl=300, ttls=None):
+        self.lock = threading.Lock()
+        self.configure(filename, ttl, ttls)
+
+    # Uses filename, loading what did not expire yet. No filename disables the cache.
+    # Results of OID groups (see device.Device.phase) in ttls are kept that many seconds, others ttl seconds.
+    def configure(self, filename=None, ttl=300, ttls=None):
+        with self.lock:
+            self.filename = filename
+            self.ttl = ttl
+            self.ttls = ttls or {}
+            # (host, request): (expires, marshalled value)
+            self.entries = {}
+            # Entries not written to the file yet
+            self.pending = {}
+        if filename:
+            self.load()
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=30)
+        db.execute(schema)
+        return db
+
+    def load(self):
+        now = time()
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    db.execute("DELETE FROM results WHERE expires <= ?", (now,))
+                rows = db.execute("SELECT host, request, expires, value FROM results").fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logger.error("Could not read cache %s, starting empty: %s" % (self.filename, e))
+            return
+        with self.lock:
+            for host, request, expires, value in rows:
+                self.entries[(host, request)] = (expires, str(value))
+        logger.debug("Loaded %s cached results from %s", len(rows), self.filename)
+
+    def enabled(self):
+        return bool(self.filename)
+
+    def ttlFor(self, group):
+        return self.ttls.get(group or 'other', self.ttl)
+
+    # returns (True, value) if request to host was answered within its TTL, else (False, None).
+    # Every hit is a copy, so callers may change what they get.
+    def get(self, host, request):
+        if not self.filename:
+            return False, None
+        with self.lock:
+            entry = self.entries.get((host, request))
+        if entry is None or entry[0] <= time():
+            return False, None
+        return True, marshal.loads(entry[1])
+
+    def put(self, host, group, request, value):
+        if not self.filename:
+            return
+        ttl = self.ttlFor(group)
+        if ttl <= 0:
+            return
+        entry = (time() + ttl, marshal.dumps(value))
+        with self.lock:
+            self.entries[(host, request)] = entry
+            self.pending[(host, request)] = (group,) + entry
+
+    # Writes results cached since the last flush to the file. Processes sharing the file
+    # each write their own, SQLite serializes them.
+    def flush(self):
+        if not self.filename:
+            return
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        rows = [(host, request, group, expires, sqlite3.Binary(value))
+                for (host, request), (group, expires, value) in pending.items()]
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO results (host, request, grp, expires, value) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logger.error("Could not write cache %s: %s" % (self.filename, e))
+            return
+        logger.debug("Wrote %s cached results to %s", len(rows), self.filename)
+
+# Shared by all connections, disabled until configured with a file
+results = ResultCache()
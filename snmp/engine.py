@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# Event driven SNMP engine.
+# One Dispatcher thread multiplexes the requests of any number of AsyncConnection
+# instances over a few UDP sockets and matches responses to requests by request ID,
+# so thousands of devices can be polled without a netsnmp session or thread each.
+
+import logging
+import random
+import select
+import socket
+import threading
+from heapq import heappush, heappop
+from time import time
+import ber
+import metrics
+from snmp import Connection, HostDown, ResolveError, resolver, splitHost, throttle, tracker
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Shared Dispatcher, created on first use by getDispatcher()
+dispatcher = None
+dispatcherLock = threading.Lock()
+
+
+class Request:
+    __doc__ = "Outstanding SNMP request, completed by the Dispatcher with a response or an error"
+
+    def __init__(self, requestId, address, message, timeout, retries, callback):
+        self.requestId = requestId
+        self.address = address
+        self.message = message
+        self.timeout = timeout
+        self.retries = retries
+        self.callback = callback
+        self.deadline = None
+        self.sent = 0
+        self.sentAt = None
+        # Bytes of the response
+        self.received = 0
+        # Holds a request slot of the throttle
+        self.admitted = False
+
+
+class Dispatcher(threading.Thread):
+    __doc__ = "Sends SNMP requests over a few shared UDP sockets and completes them on response or timeout"
+
+    def __init__(self, sockets=4, interval=0.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.sockets = []
+        for i in range(sockets):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(0)
+            self.sockets.append(s)
+        self.pending = {}
+        self.deadlines = []
+        # Requests held back by snmp.throttle, oldest first
+        self.waiting = []
+        self.lock = threading.Lock()
+        self.nextId = random.randint(1, 0x3fffffff)
+        # Set by stop()
+        self.stopping = threading.Event()
+
+    # returns a request ID not used by any outstanding request.
+    def newRequestId(self):
+        with self.lock:
+            while True:
+                self.nextId = (self.nextId % 0x7fffffff) + 1
+                if self.nextId not in self.pending:
+                    return self.nextId
+
+    # Registers request and sends its first copy, or queues it if snmp.throttle says wait.
+    def send(self, request):
+        with self.lock:
+            self.pending[request.requestId] = request
+        if throttle.tryAcquire(request.address):
+            request.admitted = True
+            self.transmit(request)
+        else:
+            with self.lock:
+                self.waiting.append(request)
+
+    # Sends queued requests snmp.throttle allows now. Runs in the dispatcher thread.
+    def admit(self):
+        with self.lock:
+            waiting, self.waiting = self.waiting, []
+        held = []
+        for i, request in enumerate(waiting):
+            if throttle.delay() > 0:
+                held += waiting[i:]
+                break
+            if throttle.tryAcquire(request.address):
+                request.admitted = True
+                self.transmit(request)
+            else:
+                held.append(request)
+        if held:
+            with self.lock:
+                self.waiting = held + self.waiting
+
+    def transmit(self, request):
+        if request.sent:
+            throttle.spend()
+        else:
+            request.sentAt = time()
+        request.sent += 1
+        request.deadline = time() + request.timeout
+        with self.lock:
+            heappush(self.deadlines, (request.deadline, request.requestId))
+        s = self.sockets[request.requestId % len(self.sockets)]
+        try:
+            s.sendto(request.message, request.address)
+        except socket.error as e:
+            logger.debug("Sending to %s failed: %s", request.address, e)
+            self.complete(request.requestId, None, str(e))
+
+    # Removes request from the outstanding ones and runs its callback.
+    def complete(self, requestId, response, error=None):
+        with self.lock:
+            request = self.pending.pop(requestId, None)
+        if request is None:
+            return
+        if request.admitted:
+            # Before the callback, which may well send the next request to the same device
+            throttle.release(request.address)
+        try:
+            request.callback(response, error)
+        except Exception:
+            logger.exception("Callback for request %s to %s failed", requestId, request.address)
+
+    def receive(self, s):
+        try:
+            data, address = s.recvfrom(65535)
+        except socket.error:
+            return
+        try:
+            response = ber.decodeMessage(data)
+        except ber.DecodeError as e:
+            logger.debug("Discarding undecodable message from %s: %s", address, e)
+            return
+        requestId = response[3]
+        with self.lock:
+            request = self.pending.get(requestId)
+        if request is None or request.address != address:
+            logger.debug("Discarding unexpected response %s from %s", requestId, address)
+            return
+        request.received = len(data)
+        self.complete(requestId, response)
+
+    # Retries or fails requests whose deadline has passed.
+    def expire(self):
+        now = time()
+        expired = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, requestId = heappop(self.deadlines)
+                request = self.pending.get(requestId)
+                # Skip requests already answered or retried since this deadline was set
+                if request is not None and request.deadline == deadline:
+                    expired.append(request)
+        for request in expired:
+            if request.sent <= request.retries:
+                logger.debug("Request %s to %s timed out, retrying", request.requestId, request.address)
+                self.transmit(request)
+            else:
+                logger.debug("Request %s to %s timed out", request.requestId, request.address)
+                self.complete(request.requestId, None, 'timeout')
+
+    def run(self):
+        while not self.stopping.is_set():
+            with self.lock:
+                wait = self.interval
+                if self.deadlines:
+                    wait = max(0, min(wait, self.deadlines[0][0] - time()))
+                waiting = bool(self.waiting)
+            if waiting:
+                wait = min(wait, max(throttle.delay(), 0.005))
+            readable = select.select(self.sockets, [], [], wait)[0]
+            for s in readable:
+                self.receive(s)
+            self.expire()
+            if waiting:
+                self.admit()
+
+    # Stops the dispatcher thread and closes its sockets. Requests still outstanding fail with 'stopped'.
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        with self.lock:
+            outstanding = list(self.pending)
+            self.waiting = []
+        for requestId in outstanding:
+            self.complete(requestId, None, 'stopped')
+        for s in self.sockets:
+            s.close()
+
+
+# returns the shared Dispatcher, starting it if needed.
+def getDispatcher():
+    global dispatcher
+    with dispatcherLock:
+        if dispatcher is None:
+            dispatcher = Dispatcher()
+            dispatcher.start()
+    return dispatcher
+
+
+# Stops the shared Dispatcher if it was started. Programs call it before they exit, so the thread
+# is not still running while the interpreter shuts down.
+def stopDispatcher():
+    global dispatcher
+    with dispatcherLock:
+        if dispatcher is not None:
+            dispatcher.stop()
+            dispatcher = None
+
+
+#
+# Value of a decoded varbind as the string netsnmp would have returned, or None.
+#
+def varbindValue(tag, value):
+    if value is None or tag in ber.exceptionTypes:
+        return None
+    if tag == ber.OBJECT_IDENTIFIER:
+        return ber.formatOid(value)
+    return str(value)
+
+
+class AsyncConnection(Connection):
+    __doc__ = "SNMP connection to a single host, sending requests through the shared Dispatcher"
+
+    # Configuring SNMP session towards a single host.
+    # Timeout and retries not given are decided per request by snmp.tracker from the host's round trip times.
+    # Raises HostDown if host recently stopped answering.
+    def __init__(self, host, version=2, community='public', port=161, timeout=None, retries=None,
+                 maxRepetitions=20, dispatcher=None):
+        logger.debug("Creating snmp.AsyncConnection instance for host %s" % host)
+        if version not in ber.versions:
+            raise ValueError("The async engine speaks SNMP version 1 and 2c only, not %s" % version)
+        self.host = host
+        # OID group (polling phase) requests are counted under in metrics.stats
+        self.group = None
+        if tracker.dead(host):
+            raise HostDown("Host %s is not answering" % host)
+        # Make sure host is resolvable. A port given as host:port wins over the port argument.
+        name, hostport = splitHost(host)
+        try:
+            address = resolver.resolve(name)
+        except ResolveError:
+            logger.warning("Cannot resolve host %s" % host)
+            raise
+
+        self.address = (address, hostport or port)
+        self.version = version
+        self.community = community
+        self.timeout = timeout
+        self.retries = retries
+        self.maxRepetitions = maxRepetitions
+        self.dispatcher = dispatcher or getDispatcher()
+        # Requests sent and not completed yet, see wait()
+        self.outstanding = 0
+        self.outstandingLock = threading.Lock()
+
+    # Sends a single PDU. callback gets the decoded response (see ber.decodeMessage) and an error.
+    # Round trip times of requests answered without resending, and timeouts, go to snmp.tracker.
+    def request(self, pduType, oids, callback, nonRepeaters=0, maxRepetitions=0):
+        host = self.host
+        if tracker.dead(host):
+            logger.debug("Not asking %s, it is not answering", host)
+            return callback(None, 'down')
+        if self.expired():
+            logger.debug("Not asking %s, its time is up", host)
+            return callback(None, 'deadline')
+        timeout = self.timeout if self.timeout is not None else tracker.timeout(host)
+        retries = self.retries if self.retries is not None else tracker.retriesFor(host)
+        requestId = self.dispatcher.newRequestId()
+        message = ber.encodeMessage(self.version, self.community, pduType, requestId,
+                                    [(x, ber.NULL, None) for x in oids], nonRepeaters, maxRepetitions)
+
+        def done(response, error):
+            with self.outstandingLock:
+                self.outstanding -= 1
+            if response:
+                seconds = time() - request.sentAt
+                tracker.success(host, seconds if request.sent == 1 else None)
+            else:
+                seconds = None
+                if error == 'timeout':
+                    tracker.failure(host)
+            metrics.stats.request(host, self.group, request.sent, seconds, len(message) * request.sent,
+                                  request.received)
+            callback(response, error)
+
+        request = Request(requestId, self.address, message, timeout, retries, done)
+        with self.outstandingLock:
+            self.outstanding += 1
+        self.dispatcher.send(request)
+
+    #
+    # Runs one of the *Async methods and waits for its result. Every request times out within the
+    # longest timeout times the tries, so if that long passes with none of ours left and no result,
+    # a callback failed on the way and none is coming. returns None then, as for a timeout.
+    #
+    def wait(self, method, *args):
+        done = threading.Event()
+        result = []
+
+        def callback(value):
+            result.append(value)
+            done.set()
+
+        method(*(args + (callback,)))
+        bound = tracker.maxTimeout * (tracker.retries + 1)
+        while not done.wait(bound):
+            if not self.outstanding or not self.dispatcher.is_alive():
+                logger.error("Gave up waiting for an answer from %s", self.host)
+                return None
+        return result[0]
+
+    # SNMP get on a single OID. callback gets value or None.
+    def getAsync(self, var, callback):
+        try:
+            oid = ber.parseOid(var)
+        except ValueError:
+            logger.debug("SNMP get on OID %s failed with ValueError.", var)
+            return callback(None)
+
+        def done(response, error):
+            value = None
+            if response and not response[4] and response[6]:
+                value = varbindValue(*response[6][0][1:])
+            if value:
+                logger.debug("Got value %s", value)
+            else:
+                logger.debug("SNMP get on OID %s failed.", var)
+            callback(value)
+
+        self.request(ber.GET, [oid], done)
+
+    # SNMP walk on an OID. callback gets dict of {OID: value} pairs or None.
+    # Uses GETBULK on version 2, GETNEXT on version 1.
+    def walkAsync(self, var, callback):
+        try:
+            base = ber.parseOid(var)
+        except ValueError:
+            logger.debug("SNMP walk on OID %s failed with ValueError.", var)
+            return callback(None)
+        result = {}
+
+        def finish():
+            if not result:
+                logger.debug("SNMP walk on OID %s failed.", var)
+            metrics.stats.walk(self.host, self.group, len(result))
+            callback(result or None)
+
+        def step(oid):
+            if self.version == 1:
+                self.request(ber.GETNEXT, [oid], done)
+            else:
+                self.request(ber.GETBULK, [oid], done, 0, self.maxRepetitions)
+
+        def done(response, error):
+            if not response or response[4] or not response[6]:
+                return finish()
+            last = None
+            for oid, tag, value in response[6]:
+                # Stop at the end of the subtree, the end of the MIB, or if the agent goes backwards
+                if tag == ber.ENDOFMIBVIEW or oid[:len(base)] != base or oid <= (last or base):
+                    return finish()
+                value = varbindValue(tag, value)
+                if value:
+                    result[ber.formatOid(oid)] = value
+                last = oid
+            step(last)
+
+        step(base)
+
+    # Sends one GETBULK PDU (GETNEXT on version 1) for the OIDs after oids (tuples), like Connection.bulk.
+    # callback gets a tuple of PDU error status and list of (OID tuple, value, True if endOfMibView).
+    def bulkAsync(self, oids, repetitions, callback):
+        def done(response, error):
+            if not response:
+                return callback((ber.GENERR, []))
+            if response[4]:
+                return callback((response[4], []))
+            callback((ber.NOERROR, [(oid, varbindValue(tag, value), tag == ber.ENDOFMIBVIEW)
+                                    for oid, tag, value in response[6]]))
+
+        if self.version == 1:
+            self.request(ber.GETNEXT, oids, done)
+        else:
+            self.request(ber.GETBULK, oids, done, 0, repetitions)
+
+    # Gets OIDs of keys (in indict) with a single GET PDU. callback gets a tuple of
+    # PDU error status, key of the OID the error is about (or None) and dict of values.
+    def getChunkAsync(self, keys, indict, callback):
+        sent = []
+        oids = []
+        for key in keys:
+            try:
+                oids.append(ber.parseOid(indict[key]))
+            except ValueError:
+                logger.debug("%s: OID %s failed with ValueError.", key, indict[key])
+                continue
+            sent.append(key)
+        if not oids:
+            return callback((ber.NOERROR, None, {}))
+
+        def done(response, error):
+            if not response:
+                return callback((ber.GENERR, None, {}))
+            errorStatus, errorIndex = response[4:6]
+            values = {}
+            if not errorStatus:
+                for key, varbind in zip(sent, response[6]):
+                    value = varbindValue(*varbind[1:])
+                    if value:
+                        values[key] = value
+            errorKey = sent[errorIndex - 1] if 0 < errorIndex <= len(sent) else None
+            callback((errorStatus, errorKey, values))
+
+        self.request(ber.GET, oids, done)
+
+    # Gets all OIDs in indict in one PDU. callback gets dict with values of those that answered.
+    def dictGetAsync(self, indict, callback):
+        self.getChunkAsync(list(indict), indict, lambda result: callback(result[2]))
+
+    def getChunk(self, keys, indict):
+        return self.wait(self.getChunkAsync, keys, indict) or (ber.GENERR, None, {})
+
+    def get(self, var):
+        return self.cached('get', var, self.wait, self.getAsync, var)
+
+    def walk(self, var):
+        return self.cached('walk', var, self.wait, self.walkAsync, var)
+
+    def bulk(self, oids, repetitions):
+        return self.wait(self.bulkAsync, oids, repetitions) or (ber.GENERR, [])
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# SNMP performance counters: requests, PDUs, bytes, timeouts and walks per host and OID group,
+# latency and walk length histograms per OID group, and time spent per polling phase.
+# Exported as JSON (snapshot, mergeable between processes) or Prometheus text format.
+
+import threading
+
+# Upper bounds of histogram buckets, seconds per request and rows per walk
+latencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+walkBuckets = (1, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+counterNames = ('requests', 'pdus', 'timeouts', 'bytesout', 'bytesin', 'seconds', 'walks', 'rows', 'cached')
+
+# Counter name: (Prometheus metric, help text)
+prometheusCounters = {
+    'requests': ('snmp_requests_total', "SNMP requests"),
+    'pdus': ('snmp_pdus_total', "SNMP PDUs sent, resends included"),
+    'timeouts': ('snmp_timeouts_total', "SNMP requests that got no answer"),
+    'bytesout': ('snmp_sent_bytes_total', "Bytes of SNMP messages sent (async engine only)"),
+    'bytesin': ('snmp_received_bytes_total', "Bytes of SNMP messages received (async engine only)"),
+    'seconds': ('snmp_request_seconds_total', "Seconds spent waiting for SNMP answers"),
+    'walks': ('snmp_walks_total', "SNMP walks"),
+    'rows': ('snmp_walk_rows_total', "Rows returned by SNMP walks"),
+    'cached': ('snmp_cache_hits_total', "SNMP requests answered from the result cache"),
+}
+
+
+def newHistogram(buckets):
+    return {'buckets': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0}
+
+
+def observe(histogram, buckets, value):
+    i = 0
+    while i < len(buckets) and value > buckets[i]:
+        i += 1
+    histogram['buckets'][i] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+
+class Metrics:
+    __doc__ = "SNMP request counters by host and OID group, with latency and walk length histograms"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # host: {group: {counter: value}}
+            self.hosts = {}
+            # group: histogram
+            self.latency = {}
+            self.walkRows = {}
+            # phase: [seconds, count]
+            self.phases = {}
+
+    def counters(self, host, group):
+        groups = self.hosts.setdefault(host, {})
+        if group not in groups:
+            groups[group] = dict((x, 0) for x in counterNames)
+        return groups[group]
+
+    # Records a request to host. pdus counts resends, seconds is None if it got no answer.
+    def request(self, host, group, pdus=1, seconds=None, bytesout=0, bytesin=0):
+        group = group or 'other'
+        with self.lock:
+            c = self.counters(host, group)
+            c['requests'] += 1
+            c['pdus'] += pdus
+            c['bytesout'] += bytesout
+            c['bytesin'] += bytesin
+            if seconds is None:
+                c['timeouts'] += 1
+            else:
+                c['seconds'] += seconds
+                observe(self.latency.setdefault(group, newHistogram(latencyBuckets)), latencyBuckets, seconds)
+
+    # Records a walk on host that returned rows rows.
+    def walk(self, host, group, rows):
+        group = group or 'other'
+        with self.lock:
+            c = self.counters(host, group)
+            c['walks'] += 1
+            c['rows'] += rows
+            observe(self.walkRows.setdefault(group, newHistogram(walkBuckets)), walkBuckets, rows)
+
+    # Records a request to host answered from the result cache (see snmp.cache).
+    def hit(self, host, group):
+        group = group or 'other'
+        with self.lock:
+            self.counters(host, group)['cached'] += 1
+
+    # Records seconds spent in a polling phase of a device (see device.Device.phase).
+    def phase(self, name, seconds):
+        with self.lock:
+            entry = self.phases.setdefault(name, [0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    # returns everything recorded as a dict that serializes to JSON.
+    def snapshot(self):
+        with self.lock:
+            totals = dict((x, 0) for x in counterNames)
+            for groups in self.hosts.values():
+                for c in groups.values():
+                    for x in counterNames:
+                        totals[x] += c[x]
+            return {
+                'totals': totals,
+                'hosts': dict((h, dict((g, dict(c)) for g, c in groups.items())) for h, groups in self.hosts.items()),
+                'latency': dict((g, {'buckets': list(x['buckets']), 'sum': x['sum'], 'count': x['count']})
+                                for g, x in self.latency.items()),
+                'walkrows': dict((g, {'buckets': list(x['buckets']), 'sum': x['sum'], 'count': x['count']})
+                                 for g, x in self.walkRows.items()),
+                'phases': dict((p, {'seconds': x[0], 'count': x[1]}) for p, x in self.phases.items()),
+            }
+
+    # Adds a snapshot, e.g. from another process, to what we have recorded.
+    def merge(self, snapshot):
+        with self.lock:
+            for host, groups in snapshot.get('hosts', {}).items():
+                for group, counters in groups.items():
+                    c = self.counters(host, group)
+                    for x in counterNames:
+                        c[x] += counters.get(x, 0)
+            for key, histograms, buckets in (('latency', self.latency, latencyBuckets),
+                                             ('walkrows', self.walkRows, walkBuckets)):
+                for group, x in snapshot.get(key, {}).items():
+                    h = histograms.setdefault(group, newHistogram(buckets))
+                    h['buckets'] = [a + b for a, b in zip(h['buckets'], x['buckets'])]
+                    h['sum'] += x['sum']
+                    h['count'] += x['count']
+            for name, x in snapshot.get('phases', {}).items():
+                entry = self.phases.setdefault(name, [0, 0])
+                entry[0] += x['seconds']
+                entry[1] += x['count']
+
+    # returns everything recorded in Prometheus text exposition format.
+    def prometheus(self):
+        s = self.snapshot()
+        lines = []
+        for x in counterNames:
+            metric, text = prometheusCounters[x]
+            lines += ["# HELP %s %s" % (metric, text), "# TYPE %s counter" % metric]
+            for host, groups in sorted(s['hosts'].items()):
+                for group, c in sorted(groups.items()):
+                    lines.append('%s{host="%s",group="%s"} %s' % (metric, escape(host), escape(group), c[x]))
+        for metric, text, key, buckets in (
+                ('snmp_request_duration_seconds', "SNMP request latency", 'latency', latencyBuckets),
+                ('snmp_walk_rows', "Rows per SNMP walk", 'walkrows', walkBuckets)):
+            lines += ["# HELP %s %s" % (metric, text), "# TYPE %s histogram" % metric]
+            for group, h in sorted(s[key].items()):
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], h['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket{group="%s",le="%s"} %s' % (metric, escape(group), bound, cumulative))
+                lines.append('%s_sum{group="%s"} %s' % (metric, escape(group), h['sum']))
+                lines.append('%s_count{group="%s"} %s' % (metric, escape(group), h['count']))
+        lines += ["# HELP snmp_phase_seconds_total Seconds spent per device polling phase",
+                  "# TYPE snmp_phase_seconds_total counter"]
+        for name, x in sorted(s['phases'].items()):
+            lines.append('snmp_phase_seconds_total{phase="%s"} %s' % (escape(name), x['seconds']))
+        lines += ["# HELP snmp_phases_total Device polling phases run", "# TYPE snmp_phases_total counter"]
+        for name, x in sorted(s['phases'].items()):
+            lines.append('snmp_phases_total{phase="%s"} %s' % (escape(name), x['count']))
+        return "\n".join(lines) + "\n"
+
+    # returns lines of text breaking down time per polling phase, most expensive first.
+    def profile(self):
+        s = self.snapshot()
+        lines = ["%-12s %10s %8s %10s" % ('phase', 'seconds', 'count', 'mean')]
+        for name, x in sorted(s['phases'].items(), key=lambda p: -p[1]['seconds']):
+            lines.append("%-12s %10.3f %8d %10.4f" % (name, x['seconds'], x['count'],
+                                                      x['seconds'] / x['count'] if x['count'] else 0))
+        t = s['totals']
+        lines.append("%s requests, %s PDUs, %s timeouts, %s walks of %s rows, %s cached" %
+                     (t['requests'], t['pdus'], t['timeouts'], t['walks'], t['rows'], t['cached']))
+        return lines
+
+
+# Label value escaping of the Prometheus text format
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Shared by all connections
+stats = Metrics()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# SNMP agent simulator, for measuring lldp.py and getinfo.py without a live network.
+# Serves recorded (snmpwalk -On output) or generated MIB data for any number of virtual
+# devices, each on its own UDP port, with optional latency and packet loss.
+# Speaks SNMP version 1 and 2c: GET, GETNEXT and GETBULK.
+
+import argparse
+import json
+import logging
+import random
+import re
+import resource
+import select
+import socket
+import sys
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop
+from math import ceil
+from time import time
+import ber
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Order of counters kept by Simulator
+counterNames = ('received', 'sent', 'dropped', 'bytesin', 'bytesout')
+
+# snmpwalk type names
+walkTypes = {'STRING': ber.OCTET_STRING, 'Hex-STRING': ber.OCTET_STRING, 'INTEGER': ber.INTEGER,
+             'Gauge32': ber.GAUGE32, 'Counter32': ber.COUNTER32, 'Counter64': ber.COUNTER64,
+             'Timeticks': ber.TIMETICKS, 'OID': ber.OBJECT_IDENTIFIER, 'IpAddress': ber.IPADDRESS}
+
+# Generated device contents. Juniper and ProCurve, like oid.json.
+vendors = {
+    'juniper': {
+        'sysdesc': "Juniper Networks, Inc. ex4200-48t internet router, kernel JUNOS 12.3R6.6",
+        'objectid': (1, 3, 6, 1, 4, 1, 2636, 1, 1, 1, 2, 31),
+        'ifname': "ge-0/0/%d",
+        'scalars': [((1, 3, 6, 1, 4, 1, 2636, 3, 1, 2, 0), ber.OCTET_STRING, "Juniper EX4200-48T Switch"),
+                    ((1, 3, 6, 1, 4, 1, 2636, 3, 1, 3, 0), ber.OCTET_STRING, "BP02108%05d"),
+                    ((1, 3, 6, 1, 4, 1, 2636, 3, 1, 4, 0), ber.OCTET_STRING, "REV 10")],
+    },
+    'procurve': {
+        'sysdesc': "ProCurve J9148A 2910al-48G-PoE Switch, revision W.14.49, ROM W.14.04",
+        'objectid': (1, 3, 6, 1, 4, 1, 11, 2, 3, 7, 11, 88),
+        'ifname': "%d",
+        'scalars': [((1, 0, 8802, 1, 1, 2, 1, 5, 4795, 1, 2, 4, 0), ber.OCTET_STRING, "W.14.49"),
+                    ((1, 0, 8802, 1, 1, 2, 1, 5, 4795, 1, 2, 5, 0), ber.OCTET_STRING, "SG%08d"),
+                    ((1, 0, 8802, 1, 1, 2, 1, 5, 4795, 1, 2, 7, 0), ber.OCTET_STRING, "J9148A")],
+    },
+}
+
+
+class VirtualDevice:
+    __doc__ = "MIB contents of one simulated agent"
+
+    def __init__(self, varbinds):
+        rows = sorted(varbinds)
+        self.oids = [x[0] for x in rows]
+        self.values = [x[1:] for x in rows]
+
+    def get(self, oid):
+        i = bisect_left(self.oids, oid)
+        if i < len(self.oids) and self.oids[i] == oid:
+            return (oid,) + self.values[i]
+        return (oid, ber.NOSUCHINSTANCE, None)
+
+    def getnext(self, oid):
+        i = bisect_right(self.oids, oid)
+        if i < len(self.oids):
+            return (self.oids[i],) + self.values[i]
+        return (oid, ber.ENDOFMIBVIEW, None)
+
+
+#
+# Reads snmpwalk -On output, returns list of (oid tuple, type, value).
+#
+def loadWalk(filename):
+    varbinds = []
+    with open(filename) as f:
+        for line in f:
+            match = re.match(r'^(\.?[0-9.]+) = (?:([\w-]+): )?(.*)$', line.rstrip('\n'))
+            if not match:
+                # Continuation of a multi-line string
+                if varbinds and varbinds[-1][1] == ber.OCTET_STRING:
+                    oid, tag, value = varbinds.pop()
+                    varbinds.append((oid, tag, value + '\n' + line.rstrip('\n')))
+                continue
+            oid, kind, value = match.groups()
+            tag = walkTypes.get(kind, ber.OCTET_STRING)
+            if kind == 'Hex-STRING':
+                value = ''.join(chr(int(x, 16)) for x in value.split())
+            elif tag in (ber.INTEGER, ber.TIMETICKS) and '(' in value:
+                # up(1), (12345) 1:02:03.45
+                value = re.search(r'\((-?\d+)\)', value).group(1)
+            elif tag == ber.OCTET_STRING and value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            varbinds.append((ber.parseOid(oid), tag, value))
+    return varbinds
+
+
+#
+# Generates system group, vendor scalars, interface tables and LLDP remote table of a switch
+# whose ports 1..n connect to neighbours (list of names, as reported in LLDP).
+#
+def deviceWalk(name, neighbours, number=0, ports=48, vendor='juniper'):
+    v = vendors[vendor]
+    ports = max(ports, len(neighbours))
+    varbinds = [((1, 3, 6, 1, 2, 1, 1, 1, 0), ber.OCTET_STRING, v['sysdesc']),
+                ((1, 3, 6, 1, 2, 1, 1, 2, 0), ber.OBJECT_IDENTIFIER, v['objectid']),
+                ((1, 3, 6, 1, 2, 1, 1, 3, 0), ber.TIMETICKS, 100000 + number),
+                ((1, 3, 6, 1, 2, 1, 1, 4, 0), ber.OCTET_STRING, "noc@example.net"),
+                ((1, 3, 6, 1, 2, 1, 1, 5, 0), ber.OCTET_STRING, name),
+                ((1, 3, 6, 1, 2, 1, 1, 6, 0), ber.OCTET_STRING, "Rack %d" % (number // 40)),
+                ((1, 3, 6, 1, 2, 1, 2, 1, 0), ber.INTEGER, ports),
+                # ifTableLastChange and lldpStatsRemTablesLastChangeTime
+                ((1, 3, 6, 1, 2, 1, 31, 1, 5, 0), ber.TIMETICKS, 400),
+                ((1, 0, 8802, 1, 1, 2, 1, 2, 1, 0), ber.TIMETICKS, 500)]
+    for oid, tag, value in v['scalars']:
+        varbinds.append((oid, tag, value % number if '%' in value else value))
+    for i in range(1, ports + 1):
+        ifname = v['ifname'] % (i - 1 if vendor == 'juniper' else i)
+        varbinds += [((1, 3, 6, 1, 2, 1, 2, 2, 1, 2, i), ber.OCTET_STRING, ifname),
+                     ((1, 3, 6, 1, 2, 1, 2, 2, 1, 5, i), ber.GAUGE32, 1000000000),
+                     ((1, 3, 6, 1, 2, 1, 31, 1, 1, 1, 1, i), ber.OCTET_STRING, ifname),
+                     ((1, 3, 6, 1, 2, 1, 31, 1, 1, 1, 18, i), ber.OCTET_STRING, "")]
+    for i, neighbour in enumerate(neighbours):
+        # lldpRemEntry index is TimeMark.LocalPortNum.Index
+        index = (0, i + 1, 1)
+        lldp = (1, 0, 8802, 1, 1, 2, 1, 4, 1, 1)
+        varbinds += [(lldp + (5,) + index, ber.OCTET_STRING, "chassis-%s" % neighbour),
+                     (lldp + (7,) + index, ber.OCTET_STRING, "port-%d" % (i + 1)),
+                     (lldp + (8,) + index, ber.OCTET_STRING, "uplink to %s" % name),
+                     (lldp + (9,) + index, ber.OCTET_STRING, neighbour),
+                     (lldp + (10,) + index, ber.OCTET_STRING, v['sysdesc'])]
+    return varbinds
+
+
+#
+# Topologies. Each returns list of neighbour lists, indexed by device number.
+#
+def ring(size):
+    return [[(i - 1) % size, (i + 1) % size] if size > 2 else [j for j in range(size) if j != i]
+            for i in range(size)]
+
+
+# k-ary fat tree: (k/2)^2 core switches, k pods of k/2 aggregation and k/2 edge switches.
+def fatTree(k):
+    half = k // 2
+    core = half * half
+    links = [[] for i in range(core + k * k)]
+    for pod in range(k):
+        first = core + pod * k
+        for a in range(half):
+            agg = first + a
+            for c in range(half):
+                links[agg].append(a * half + c)
+                links[a * half + c].append(agg)
+            for e in range(half):
+                edge = first + half + e
+                links[agg].append(edge)
+                links[edge].append(agg)
+    return links
+
+
+# Campus: two cores, distribution pairs each serving up to 40 dual-homed access switches.
+def campus(size):
+    size = max(size, 4)
+    links = [[1], [0]]
+    remaining = size - 2
+    pairs = max(1, int(ceil((remaining - 2) / 42.0)))
+    distribution = range(2, 2 + 2 * pairs)
+    for d in distribution:
+        links.append([0, 1])
+        links[0].append(d)
+        links[1].append(d)
+    for a in range(2 + 2 * pairs, size):
+        pair = (a % pairs) * 2 + 2
+        links.append([pair, pair + 1])
+        links[pair].append(a)
+        links[pair + 1].append(a)
+    return links
+
+topologies = {'ring': ring, 'fattree': fatTree, 'campus': campus}
+
+
+#
+# returns list of (host:port, VirtualDevice) of a generated topology, served from port onwards.
+#
+def buildTopology(topology, size, address='127.0.0.1', port=20000, ports=48):
+    links = topologies[topology](size)
+    names = ["%s:%d" % (address, port + i) for i in range(len(links))]
+    devices = []
+    for i, neighbours in enumerate(links):
+        vendor = 'juniper' if i % 2 == 0 else 'procurve'
+        walk = deviceWalk(names[i], [names[n] for n in neighbours], i, ports, vendor)
+        devices.append((names[i], VirtualDevice(walk)))
+    return devices
+
+
+class Simulator:
+    __doc__ = "Serves VirtualDevices, each on its own UDP port"
+
+    # devices is list of (host:port, VirtualDevice). counters can be any list-like of
+    # len(counterNames) numbers, for example a multiprocessing.Array to read from another process.
+    def __init__(self, devices, latency=0.0, jitter=0.0, loss=0.0, community='public', maxSize=1472,
+                 counters=None):
+        self.devices = devices
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.community = community.encode('utf-8') if not isinstance(community, bytes) else community
+        self.maxSize = maxSize
+        self.counters = counters if counters is not None else [0] * len(counterNames)
+        self.sockets = {}
+        self.delayed = []
+
+    def summary(self):
+        return dict(zip(counterNames, self.counters))
+
+    def bind(self):
+        # Thousands of devices need thousands of sockets
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = len(self.devices) + 64
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            if hard == resource.RLIM_INFINITY or hard >= wanted:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            else:
+                logger.warning("Open file limit %s is too low for %s devices", hard, len(self.devices))
+        for name, device in self.devices:
+            host, port = name.rsplit(':', 1)
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            s.bind((host, int(port)))
+            s.setblocking(0)
+            self.sockets[s.fileno()] = (s, device)
+
+    # Drops varbinds off the end until the response fits in maxSize.
+    def fit(self, varbinds):
+        size = 64 + len(self.community)
+        for i, varbind in enumerate(varbinds):
+            size += len(ber.encodeVarbind(*varbind))
+            if size > self.maxSize:
+                return varbinds[:i]
+        return varbinds
+
+    # returns response message to data, or None if there should be none.
+    def respond(self, device, data):
+        try:
+            version, community, pduType, requestId, nonRepeaters, maxRepetitions, varbinds = ber.decodeMessage(data)
+        except ber.DecodeError:
+            return None
+        if community != self.community:
+            return None
+        oids = [x[0] for x in varbinds]
+        errorStatus = errorIndex = 0
+
+        if pduType == ber.GET:
+            out = [device.get(oid) for oid in oids]
+        elif pduType == ber.GETNEXT:
+            out = [device.getnext(oid) for oid in oids]
+        elif pduType == ber.GETBULK and version > 0:
+            out = [device.getnext(oid) for oid in oids[:nonRepeaters]]
+            cursors = oids[nonRepeaters:]
+            for r in range(maxRepetitions):
+                row = [device.getnext(oid) for oid in cursors]
+                out += row
+                cursors = [x[0] for x in row]
+                if all(x[1] == ber.ENDOFMIBVIEW for x in row) or len(out) * 20 > self.maxSize:
+                    break
+            out = self.fit(out)
+        else:
+            return None
+
+        if version == 0:
+            # Version 1 has no exception values, the whole PDU fails
+            for i, varbind in enumerate(out):
+                if varbind[1] in ber.exceptionTypes:
+                    errorStatus, errorIndex = ber.NOSUCHNAME, i + 1
+                    out = varbinds
+                    break
+        response = ber.encodeMessage(version, community, ber.RESPONSE, requestId, out, errorStatus, errorIndex)
+        if len(response) > self.maxSize:
+            response = ber.encodeMessage(version, community, ber.RESPONSE, requestId, varbinds, ber.TOOBIG, 0)
+        return response
+
+    def handle(self, s, device):
+        try:
+            data, address = s.recvfrom(65535)
+        except socket.error:
+            return
+        self.counters[0] += 1
+        self.counters[3] += len(data)
+        if self.loss and random.random() < self.loss:
+            self.counters[2] += 1
+            return
+        response = self.respond(device, data)
+        if response is None:
+            return
+        if self.latency or self.jitter:
+            heappush(self.delayed, (time() + self.latency + random.uniform(0, self.jitter), s.fileno(),
+                                    response, address))
+        else:
+            self.send(s, response, address)
+
+    def send(self, s, response, address):
+        try:
+            s.sendto(response, address)
+        except socket.error as e:
+            logger.debug("Sending to %s failed: %s", address, e)
+            return
+        self.counters[1] += 1
+        self.counters[4] += len(response)
+
+    def serve(self, duration=None):
+        if not self.sockets:
+            self.bind()
+        poller = select.poll()
+        for fd in self.sockets:
+            poller.register(fd, select.POLLIN)
+        end = time() + duration if duration else None
+        while end is None or time() < end:
+            wait = 50
+            if self.delayed:
+                wait = max(0, min(wait, int((self.delayed[0][0] - time()) * 1000)))
+            for fd, event in poller.poll(wait):
+                self.handle(*self.sockets[fd])
+            now = time()
+            while self.delayed and self.delayed[0][0] <= now:
+                due, fd, response, address = heappop(self.delayed)
+                self.send(self.sockets[fd][0], response, address)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve simulated SNMP agents on localhost. "
+                                     "Prints the list of served hosts as JSON, root device first.")
+    parser.add_argument("topology", choices=sorted(topologies),
+                        help="Generated topology")
+    parser.add_argument("size", type=int,
+                        help="Number of devices (k for fattree)")
+    parser.add_argument("-a", "--address", default='127.0.0.1',
+                        help="Address to serve on (default: 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=20000,
+                        help="Port of the first device (default: 20000)")
+    parser.add_argument("-w", "--walk", action="append", default=[],
+                        help="snmpwalk -On output file to serve as additional device, can be repeated")
+    parser.add_argument("-c", "--community", default='public',
+                        help="SNMP community (default: public)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds to delay every response (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Up to this many seconds of random extra delay (default: 0)")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="Fraction of requests to drop (default: 0)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    devices = buildTopology(args.topology, args.size, args.address, args.port)
+    for filename in args.walk:
+        devices.append(("%s:%d" % (args.address, args.port + len(devices)), VirtualDevice(loadWalk(filename))))
+
+    simulator = Simulator(devices, args.latency, args.jitter, args.loss, args.community)
+    simulator.bind()
+    print(json.dumps([name for name, device in devices]))
+    sys.stdout.flush()
+    try:
+        simulator.serve()
+    except KeyboardInterrupt:
+        logger.warning("Served %s", simulator.summary())
@@ -4,7 +4,15 @@
 
 import netsnmp
 import logging
-from socket import gethostbyname, gaierror
+import threading
+from collections import OrderedDict
+from socket import gethostbyname, gaierror, inet_aton, inet_ntoa
+import struct
+from time import time
+import ber
+import cache
+import metrics
+import usm
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -18,30 +26,539 @@ class ResolveError(Exception):
         return repr(self.value)
 
 
+class HostDown(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+#
+# 'host:port' -> ('host', port). Anything else (including IPv6 addresses) -> (host, None).
+#
+def splitHost(host):
+    if host.count(':') == 1:
+        name, port = host.split(':')
+        if port.isdigit():
+            return name, int(port)
+    return host, None
+
+
+class Resolver:
+    __doc__ = "Hostname resolution cache shared between threads, remembering failures as well"
+
+    def __init__(self, ttl=300, negativeTtl=60, maxEntries=100000):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.maxEntries = maxEntries
+        # name: (address or None, expiry time)
+        self.entries = {}
+        # name: Event, for lookups in progress
+        self.lookups = {}
+        self.lock = threading.Lock()
+
+    # returns IPv4 address of name. Raises ResolveError if it does not resolve.
+    def resolve(self, name):
+        while True:
+            with self.lock:
+                entry = self.entries.get(name)
+                if entry and entry[1] > time():
+                    address = entry[0]
+                    break
+                lookup = self.lookups.get(name)
+                if lookup is None:
+                    # Nobody is resolving name yet, we will.
+                    self.lookups[name] = threading.Event()
+            if lookup is not None:
+                # Someone else is resolving name. Wait for the result instead of asking again.
+                lookup.wait()
+                continue
+
+            address = None
+            try:
+                address = gethostbyname(name)
+            except gaierror:
+                pass
+            finally:
+                with self.lock:
+                    if len(self.entries) >= self.maxEntries:
+                        self.expire()
+                    self.entries[name] = (address, time() + (self.ttl if address else self.negativeTtl))
+                    self.lookups.pop(name).set()
+            break
+
+        if not address:
+            raise ResolveError("Couldn't resolve hostname %s" % name)
+        return address
+
+    # Drops expired entries, or all of them if none have expired. Called with lock held.
+    def expire(self):
+        now = time()
+        for name in [x for x, entry in self.entries.items() if entry[1] <= now]:
+            del self.entries[name]
+        if len(self.entries) >= self.maxEntries:
+            self.entries.clear()
+
+# Shared by all connections
+resolver = Resolver()
+
+# netsnmp session ErrorNum of a request that got no answer (SNMPERR_TIMEOUT)
+timeoutError = -24
+
+
+class HostTracker:
+    __doc__ = "Round trip time estimates and failures per host, deciding timeouts and retries"
+
+    # Smoothed round trip time and its variance are kept as in TCP (RFC 6298).
+    # Hosts never heard from get a timeout based on the estimate over all hosts.
+    def __init__(self, initialTimeout=1.0, minTimeout=0.1, maxTimeout=5.0, retries=1,
+                 slowRtt=0.5, deadAfter=3, deadTtl=300):
+        self.initialTimeout = initialTimeout
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.retries = retries
+        self.slowRtt = slowRtt
+        self.deadAfter = deadAfter
+        self.deadTtl = deadTtl
+        # host: {'srtt', 'rttvar', 'samples', 'failures' (in a row), 'timeouts', 'backoff', 'dead' (until)}
+        self.hosts = {}
+        # Estimate over all hosts, [srtt, rttvar] or None
+        self.overall = None
+        self.lock = threading.Lock()
+
+    def host(self, host):
+        entry = self.hosts.get(host)
+        if entry is None:
+            entry = self.hosts[host] = {'srtt': None, 'rttvar': None, 'samples': 0, 'failures': 0,
+                                        'timeouts': 0, 'backoff': 1, 'dead': 0}
+        return entry
+
+    @staticmethod
+    def smooth(estimate, rtt):
+        if estimate[0] is None:
+            return [rtt, rtt / 2]
+        srtt, rttvar = estimate
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+        srtt = 0.875 * srtt + 0.125 * rtt
+        return [srtt, rttvar]
+
+    # returns seconds to wait for an answer from host.
+    def timeout(self, host):
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry and entry['srtt'] is not None:
+                timeout = (entry['srtt'] + 4 * entry['rttvar']) * entry['backoff']
+            elif self.overall:
+                # Allow a new host twice what the others need
+                timeout = 2 * (self.overall[0] + 4 * self.overall[1]) * (entry['backoff'] if entry else 1)
+            else:
+                timeout = self.initialTimeout * (entry['backoff'] if entry else 1)
+        return min(self.maxTimeout, max(self.minTimeout, timeout))
+
+    # returns number of times to resend a request to host. Hosts failing already get none.
+    def retriesFor(self, host):
+        with self.lock:
+            entry = self.hosts.get(host)
+            return 0 if entry and entry['failures'] else self.retries
+
+    # Records a round trip time, in seconds, of a request answered without resending.
+    def success(self, host, rtt=None):
+        with self.lock:
+            entry = self.host(host)
+            entry['failures'] = 0
+            entry['backoff'] = 1
+            entry['dead'] = 0
+            if rtt is not None:
+                entry['srtt'], entry['rttvar'] = self.smooth([entry['srtt'], entry['rttvar']], rtt)
+                entry['samples'] += 1
+                self.overall = self.smooth(self.overall or [None, None], rtt)
+
+    # Records a request to host that got no answer. Backs off, and gives up on the host after deadAfter in a row.
+    def failure(self, host):
+        with self.lock:
+            entry = self.host(host)
+            entry['failures'] += 1
+            entry['timeouts'] += 1
+            entry['backoff'] = min(entry['backoff'] * 2, 8)
+            if entry['failures'] >= self.deadAfter:
+                entry['dead'] = time() + self.deadTtl
+
+    # Gives up on host for deadTtl seconds, e.g. because it did not answer a probe.
+    def markDead(self, host):
+        with self.lock:
+            self.host(host)['dead'] = time() + self.deadTtl
+
+    # True if the last request to host got no answer.
+    def failing(self, host):
+        with self.lock:
+            entry = self.hosts.get(host)
+            return bool(entry) and entry['failures'] > 0
+
+    def dead(self, host):
+        with self.lock:
+            entry = self.hosts.get(host)
+            return bool(entry) and entry['dead'] > time()
+
+    # returns dict of slow hosts (host: smoothed round trip time) and sorted list of dead hosts.
+    def summary(self):
+        now = time()
+        with self.lock:
+            slow = dict((host, entry['srtt']) for host, entry in self.hosts.items()
+                        if entry['srtt'] is not None and entry['srtt'] > self.slowRtt)
+            dead = sorted(host for host, entry in self.hosts.items() if entry['dead'] > now)
+        return {'slow': slow, 'dead': dead}
+
+# Shared by all connections
+tracker = HostTracker()
+
+
+class Throttle:
+    __doc__ = "Token bucket limiting SNMP requests per second, and caps on requests in flight per device and subnet"
+
+    def __init__(self, rate=0, burst=None, perDevice=0, perSubnet=0, subnetBits=24):
+        self.condition = threading.Condition()
+        # device address or subnet: requests in flight
+        self.devices = {}
+        self.subnets = {}
+        self.configure(rate, burst, perDevice, perSubnet, subnetBits)
+
+    # rate is requests per second over all devices, with bursts of up to burst requests
+    # (a tenth of a second worth by default). perDevice and perSubnet cap requests in flight. 0 is no limit.
+    def configure(self, rate=0, burst=None, perDevice=0, perSubnet=0, subnetBits=24):
+        with self.condition:
+            self.rate = rate
+            self.burst = burst or max(1.0, rate / 10.0)
+            self.tokens = self.burst
+            self.stamp = time()
+            self.perDevice = perDevice
+            self.perSubnet = perSubnet
+            self.subnetBits = subnetBits
+            self.subnetMask = (0xffffffff << (32 - subnetBits)) & 0xffffffff
+            self.limited = bool(rate or perDevice or perSubnet)
+            self.condition.notify_all()
+
+    # returns (device, subnet) keys of address, either 'ip[:port]' or an (ip, port) tuple.
+    def keys(self, address):
+        if isinstance(address, tuple):
+            ip = address[0]
+            address = "%s:%s" % address
+        else:
+            ip = splitHost(address)[0]
+        try:
+            network = struct.unpack('!L', inet_aton(ip))[0] & self.subnetMask
+        except Exception:
+            return address, ip
+        return address, inet_ntoa(struct.pack('!L', network))
+
+    def refill(self):
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # Takes a token and a request slot for address if there are. returns 0 if it did,
+    # else seconds until a token is due (None if waiting for a slot). Called with condition held.
+    def take(self, address):
+        device, subnet = self.keys(address)
+        if self.perDevice and self.devices.get(device, 0) >= self.perDevice:
+            return None
+        if self.perSubnet and self.subnets.get(subnet, 0) >= self.perSubnet:
+            return None
+        if self.rate:
+            self.refill()
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.devices[device] = self.devices.get(device, 0) + 1
+        self.subnets[subnet] = self.subnets.get(subnet, 0) + 1
+        return 0
+
+    # Non-blocking acquire. returns True if a request to address may be sent now.
+    def tryAcquire(self, address):
+        if not self.limited:
+            return True
+        with self.condition:
+            return self.take(address) == 0
+
+    # Waits until a request to address may be sent.
+    def acquire(self, address):
+        if not self.limited:
+            return
+        with self.condition:
+            while True:
+                wait = self.take(address)
+                if wait == 0:
+                    return
+                # Slots are freed by release(), which wakes us up. Check now and then anyway.
+                self.condition.wait(wait or 1.0)
+
+    # Frees the request slot taken for address.
+    def release(self, address):
+        if not self.limited:
+            return
+        device, subnet = self.keys(address)
+        with self.condition:
+            for counts, key in ((self.devices, device), (self.subnets, subnet)):
+                if counts.get(key, 0) > 1:
+                    counts[key] -= 1
+                else:
+                    counts.pop(key, None)
+            self.condition.notify_all()
+
+    # Accounts for n requests sent without acquire(), e.g. resends and PDUs of a netsnmp walk.
+    def spend(self, n=1):
+        if not self.rate or n <= 0:
+            return
+        with self.condition:
+            self.refill()
+            self.tokens -= n
+
+    # returns seconds until the next token is due, 0 if one is available.
+    def delay(self):
+        if not self.rate:
+            return 0
+        with self.condition:
+            self.refill()
+            return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+# Shared by all connections, unlimited until configured
+throttle = Throttle()
+
+
+class SessionPool:
+    __doc__ = "Open netsnmp sessions by (host, version, community or SNMPv3 user), closing least recently used ones"
+
+    def __init__(self, maxSessions=1000):
+        self.maxSessions = maxSessions
+        # key: (session, lock, (timeout, retries)), most recently used last
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    # returns session towards host, a lock to hold while using it and its (timeout, retries).
+    # netsnmp fixes timeout (seconds) and retries when opening a session, so a session whose
+    # timeout is off by more than half, or with other retries, is replaced.
+    # With version 3, community is a usm.User, and engine what usm.engines knows of host, if anything.
+    # Sessions return numeric OIDs, which walks are read by (see Connection.varbindOid).
+    def get(self, host, version, community, timeout=1.0, retries=0, engine=None):
+        key = (host, version, community.key if version == 3 else community)
+        with self.lock:
+            entry = self.sessions.pop(key, None)
+            if entry is None or entry[2][1] != retries or abs(entry[2][0] - timeout) > timeout / 2:
+                logger.debug("Opening netsnmp session to %s, timeout %.3fs, %s retries", host, timeout, retries)
+                if version == 3:
+                    params = community.sessionParams(engine)
+                else:
+                    params = {'Community': community}
+                entry = (netsnmp.Session(DestHost=host, Version=version, Timeout=int(timeout * 1000000),
+                                         Retries=retries, UseNumeric=1, **params),
+                         threading.Lock(), (timeout, retries))
+            self.sessions[key] = entry
+            while len(self.sessions) > self.maxSessions:
+                self.sessions.popitem(last=False)
+        return entry
+
+    # Closes the session towards host, so the next get opens a new one.
+    def drop(self, host, version, community):
+        with self.lock:
+            self.sessions.pop((host, version, community.key if version == 3 else community), None)
+
+# Shared by all connections
+sessions = SessionPool()
+
+
+# returns key of a table walk on columns (dict of name: column OID) in cache.results.
+def tableKey(columns):
+    return ' '.join('%s=%s' % x for x in sorted(columns.items()))
+
+
+class TableWalk:
+    __doc__ = "Columns of a table walked in lock-step: the OID each column got to"
+
+    # columns is dict of name: column OID. Raises ValueError if an OID is not numeric.
+    def __init__(self, columns):
+        self.bases = dict((name, ber.parseOid(oid)) for name, oid in columns.items())
+        # name: last OID returned for the column, for columns not at their end yet
+        self.next = dict(self.bases)
+        # Names of columns ended by an OID that could not be read (see Connection.varbindOid)
+        self.unreadable = set()
+
+    # returns names of the columns to ask for next, in the order to put them in the PDU.
+    def pending(self):
+        return sorted(self.next)
+
+    # Takes varbinds (OID tuple, value, True if endOfMibView) of a response to a request for
+    # the columns names, repetitions of all columns one after the other as GETBULK returns them.
+    # A column ends when the agent leaves it, goes backwards, or has nothing more, or on an OID of None.
+    # returns list of (index, name, value) in the response, index being the OID after the column as string.
+    def add(self, names, varbinds):
+        if not varbinds:
+            self.next = {}
+        found = []
+        for i, (oid, value, end) in enumerate(varbinds):
+            name = names[i % len(names)]
+            if name not in self.next:
+                continue
+            base = self.bases[name]
+            if oid is None and not end:
+                self.unreadable.add(name)
+            if end or oid is None or oid[:len(base)] != base or oid <= self.next[name]:
+                del self.next[name]
+                continue
+            self.next[name] = oid
+            if value:
+                found.append(('.'.join(str(x) for x in oid[len(base):]), name, value))
+        return found
+
+
 class Connection:
     __doc__ = "SNMP connection to a single host, containing common data like authentication"
+    # Most OIDs to put in one GET PDU. Agents answering tooBig get smaller PDUs.
+    maxVarbinds = 32
+    # Rows per column to ask for in one GETBULK PDU. Agents answering tooBig get fewer.
+    maxRepetitions = 20
+    # Time (as time.time()) after which no more requests are sent, or None
+    deadline = None
+    # True once a table walk ended on an error, so what it returned may be cut short
+    walkFailed = False
 
-    # Configuring SNMP session towards a single host.
+    # Configuring SNMP session towards a single host. With version 3, community is a usm.User.
+    # The engine of the host is discovered once (see usm.EngineCache), and sessions are opened with
+    # it and keys localized to it, instead of netsnmp discovering it and deriving keys every time.
+    # Raises HostDown if host recently stopped answering (see HostTracker).
     def __init__(self, host, version=2, community='public'):
         logger.debug("Creating snmp.Connection instance for host %s" % host)
-        # Make sure host is resolvable
+        self.host = host
+        # OID group (polling phase) requests are counted under in metrics.stats
+        self.group = None
+        if tracker.dead(host):
+            raise HostDown("Host %s is not answering" % host)
+        # Make sure host is resolvable, and spare netsnmp resolving it again.
+        name, port = splitHost(host)
         try:
-            gethostbyname(host)
-        except gaierror:
+            address = resolver.resolve(name)
+        except ResolveError:
             logger.warning("Cannot resolve host %s" % host)
-            raise ResolveError("Couldn't resolve hostname %s" % host)
+            raise
+        if port:
+            address = "%s:%s" % (address, port)
+
+        self.address = address
+        self.version = version
+        self.community = community
+        self.engine = usm.engines.get(address, self.discoverEngine) if version == 3 else None
+        self.session, self.lock, self.sessionParams = sessions.get(address, version, community,
+                                                                   tracker.timeout(host), tracker.retriesFor(host),
+                                                                   self.engine)
+
+    # Asks the agent at address for its engine ID, boots and time (see usm.discover), throttled and
+    # timed like other requests. returns (engine ID, boots, engine time), or None if it did not answer.
+    def discoverEngine(self, address):
+        host = self.host
+        name, port = splitHost(address)
+        timeout, retries = tracker.timeout(host), tracker.retriesFor(host)
+        logger.debug("Discovering SNMPv3 engine of %s", host)
+        throttle.acquire(address)
+        try:
+            start = time()
+            engine = usm.discover((name, int(port or 161)), timeout, retries)
+            rtt = time() - start
+        finally:
+            throttle.release(address)
+        if engine is None:
+            tracker.failure(host)
+            metrics.stats.request(host, self.group, retries + 1)
+        else:
+            tracker.success(host, rtt if rtt <= timeout else None)
+            metrics.stats.request(host, self.group, 1, rtt)
+        return engine
+
+    # Runs netsnmp session method (by name) with args and varlist, feeding its round trip time or timeout
+    # to the tracker. Round trip time is only sampled from single PDU requests (not walks) that were not resent.
+    # returns None without sending anything if host is not answering.
+    def request(self, method, varlist, walk=False, args=()):
+        host = self.host
+        if tracker.dead(host):
+            logger.debug("Not asking %s, it is not answering", host)
+            self.error = (timeoutError, 0)
+            return None
+        if self.expired():
+            logger.debug("Not asking %s, its time is up", host)
+            self.error = (timeoutError, 0)
+            return None
+        params = (tracker.timeout(host), tracker.retriesFor(host))
+        if params[1] != self.sessionParams[1] or abs(self.sessionParams[0] - params[0]) > params[0] / 2:
+            self.session, self.lock, self.sessionParams = sessions.get(self.address, self.version, self.community,
+                                                                       *(params + (self.engine,)))
+        # The method is looked up on the session chosen above, and the call, its lock and its
+        # error all come from that one session, even if the connection switches sessions meanwhile.
+        session, lock, sessionParams = self.session, self.lock, self.sessionParams
+        throttle.acquire(self.address)
+        try:
+            with lock:
+                start = time()
+                result = getattr(session, method)(*(args + (varlist,)))
+                rtt = time() - start
+                # (ErrorNum, ErrorInd), read while no other thread can use the session
+                self.error = (session.ErrorNum, session.ErrorInd)
+        finally:
+            throttle.release(self.address)
+        pdus = 1
+        if walk:
+            # A walk is a GETNEXT per row
+            pdus += len(varlist)
+            throttle.spend(len(varlist))
+            metrics.stats.walk(host, self.group, len(varlist))
+        if self.error[0] == timeoutError:
+            tracker.failure(host)
+            metrics.stats.request(host, self.group, pdus)
+        elif self.error[0] < 0 and self.engine:
+            # netsnmp errors, like an unknown engine ID when the device was replaced. The next
+            # connection discovers the engine again and opens a new session.
+            logger.debug("SNMPv3 request to %s failed (%s), forgetting its engine", host, self.error[0])
+            usm.engines.forget(self.address)
+            sessions.drop(self.address, self.version, self.community)
+            metrics.stats.request(host, self.group, pdus)
+        else:
+            tracker.success(host, rtt if not walk and rtt <= sessionParams[0] else None)
+            metrics.stats.request(host, self.group, pdus, rtt)
+        return result
+
+    # True if the deadline passed. Requests then fail without being sent.
+    def expired(self):
+        return self.deadline is not None and time() > self.deadline
 
-        self.session = netsnmp.Session(DestHost=host, Version=version, Community=community, Retries=0)
+    # Called when a probe of host got no value. If host did not answer at all, it is given up on
+    # for a while, so connections to it fail fast.
+    def probeFailed(self):
+        if tracker.failing(self.host):
+            tracker.markDead(self.host)
+
+    # returns what fetch(*args) returns, or what it returned for the same request (method and key)
+    # to host within the TTL of the OID group, if cache.results has it. Requests that went
+    # unanswered are not cached.
+    def cached(self, method, key, fetch, *args):
+        request = method + ' ' + key
+        hit, value = cache.results.get(self.host, request)
+        if hit:
+            metrics.stats.hit(self.host, self.group)
+            return value
+        value = fetch(*args)
+        if not tracker.failing(self.host) and not self.expired():
+            cache.results.put(self.host, self.group, request, value)
+        return value
 
     # SNMP get on a single OID. Returns value or None.
     def get(self, var):
+        return self.cached('get', var, self.sessionGet, var)
+
+    def sessionGet(self, var):
         try:
             varlist = netsnmp.VarList(var)
         except TypeError:
             logger.debug("SNMP get on OID %s failed with TypeError.", var)
             return None
 
-        self.session.get(varlist)
+        self.request('get', varlist)
         if varlist[0].val:
             logger.debug("Got value %s", varlist[0].val)
             return varlist[0].val
@@ -51,40 +568,173 @@ class Connection:
 
     # SNMP walk on an OID. Returns dict of {OID: value} pairs or None.
     def walk(self, var):
+        return self.cached('walk', var, self.sessionWalk, var)
+
+    def sessionWalk(self, var):
         try:
             varlist = netsnmp.VarList(var)
         except TypeError:
             logger.debug("SNMP get on OID %s failed with TypeError.", var)
             return None
 
-        result = self.session.walk(varlist)
+        result = self.request('walk', varlist, walk=True)
         if result:
-            return {x.tag: x.val for x in varlist if x.val}
+            # Keyed by full OID like AsyncConnection.walk, the session splits off the last numbers as iid
+            return {'.' + x.tag.strip('.') + ('.' + str(x.iid) if x.iid else ''): x.val for x in varlist if x.val}
 
         logger.debug("SNMP walk on OID %s failed.", var)
         return None
 
-    # Optimization attempt. Assemble a VarList of desired OIDs, run a single session,
-    # then reassemble values into dict to return.
-    def dictGet(self, indict):
-        outdict = {}
+    #
+    # Walks columns (dict of name: column OID) of a table in lock-step, asking for the next
+    # maxRepetitions rows of every column not at its end yet in one GETBULK PDU (GETNEXT on version 1).
+    # returns dict of row index (OID after the column, like '0.12.1'): {name: value}, or None.
+    #
+    def table(self, columns):
+        return self.cached('table', tableKey(columns), self.walkTable, columns)
+
+    def walkTable(self, columns):
+        rows = {}
+        for index, name, value in self.streamTable(columns):
+            rows.setdefault(index, {})[name] = value
+        if not rows:
+            logger.debug("SNMP table walk on %s failed.", columns)
+        return rows or None
+
+    #
+    # Walks columns like table(), but yields (index, name, value) as every response arrives,
+    # so no more than a PDU of rows is held at a time. The next PDU is only asked for once the
+    # rows of the last one were consumed. Tables in cache.results are yielded from there; with
+    # the cache enabled, rows are also collected to be cached.
+    #
+    def iterTable(self, columns):
+        key = tableKey(columns)
+        hit, rows = cache.results.get(self.host, 'table ' + key)
+        if hit:
+            metrics.stats.hit(self.host, self.group)
+            for index, row in (rows or {}).items():
+                for name, value in row.items():
+                    yield index, name, value
+            return
+        rows = {} if cache.results.enabled() else None
+        for index, name, value in self.streamTable(columns):
+            if rows is not None:
+                rows.setdefault(index, {})[name] = value
+            yield index, name, value
+        if rows is not None and not tracker.failing(self.host) and not self.expired():
+            cache.results.put(self.host, self.group, 'table ' + key, rows or None)
+
+    # Walks a single column like walk(), yielding (index, value) as responses arrive (see iterTable).
+    def iterWalk(self, var):
+        for index, name, value in self.iterTable({'': var}):
+            yield index, value
+
+    def streamTable(self, columns):
+        try:
+            walk = TableWalk(columns)
+        except ValueError:
+            logger.debug("SNMP table walk on %s failed with ValueError.", columns)
+            return
+        repetitions = self.maxRepetitions
+        rows = 0
+        try:
+            while walk.next:
+                names = walk.pending()
+                errorStatus, varbinds = self.bulk([walk.next[x] for x in names], repetitions)
+                if errorStatus == ber.TOOBIG and repetitions > 1:
+                    repetitions = max(1, repetitions // 2)
+                    logger.debug("Response too big, asking for %s repetitions.", repetitions)
+                    continue
+                if errorStatus:
+                    # Version 1 agents answer noSuchName past the end of the MIB
+                    if errorStatus != ber.NOSUCHNAME or self.version != 1:
+                        logger.debug("SNMP table walk on %s ended on error %s.", columns, errorStatus)
+                        self.walkFailed = True
+                    break
+                for row in walk.add(names, varbinds):
+                    rows += 1
+                    yield row
+            if walk.unreadable:
+                logger.warning("Walk of %s on %s ended on OIDs that are not numeric, after %s rows",
+                               ', '.join(columns[x] for x in sorted(walk.unreadable)), self.host, rows)
+        finally:
+            metrics.stats.walk(self.host, self.group, rows)
+
+    # Sends one GETBULK PDU for the next repetitions OIDs after each of oids (tuples), a GETNEXT on
+    # version 1. returns PDU error status and list of (OID tuple, value, True if endOfMibView).
+    def bulk(self, oids, repetitions):
+        varlist = netsnmp.VarList(*[netsnmp.Varbind(ber.formatOid(x)) for x in oids])
+        if self.version == 1:
+            self.request('getnext', varlist)
+        else:
+            self.request('getbulk', varlist, args=(0, repetitions))
+        if self.error[0]:
+            return self.error[0], []
+        return ber.NOERROR, [(self.varbindOid(x), x.val, x.type == 'ENDOFMIBVIEW') for x in varlist]
+
+    # returns OID tuple of a netsnmp varbind returned by a walk, or None if it is not numeric.
+    # Tags netsnmp has no MIB name for come back as iso.3.6.1..., which is read as .1.3.6.1...
+    @staticmethod
+    def varbindOid(varbind):
+        tag = varbind.tag
+        if tag and tag.lstrip('.').startswith('iso.'):
+            tag = '1' + tag.lstrip('.')[3:]
+        try:
+            return ber.parseOid(tag + ('.' + str(varbind.iid) if varbind.iid else ''))
+        except (ValueError, TypeError):
+            return None
+
+    # Gets OIDs of keys (in indict) with a single GET PDU.
+    # returns PDU error status, key of the OID the error is about (or None) and dict of values.
+    def getChunk(self, keys, indict):
+        sent = []
         varlist = netsnmp.VarList()
-        for key in indict:
-            oid = indict[key]
+        for key in keys:
             try:
-                varbind = netsnmp.Varbind(oid)
+                varbind = netsnmp.Varbind(indict[key])
             except TypeError:
-                break
-            # Using a key here that netsnmp library is unlikely to implement in the future.
-            varbind.snmp_dict_key = key
+                logger.debug("%s: OID %s failed with TypeError.", key, indict[key])
+                continue
+            sent.append(key)
             varlist.varbinds.append(varbind)
+        if not sent:
+            return ber.NOERROR, None, {}
 
-        # Magic happens
-        self.session.get(varlist)
+        self.request('get', varlist)
+        errorStatus, errorIndex = self.error
 
-        for varbind in varlist:
+        values = {}
+        for key, varbind in zip(sent, varlist):
+            # noSuchObject and noSuchInstance come back without value
             if varbind.val:
-                outdict[varbind.snmp_dict_key] = varbind.val
+                values[key] = varbind.val
+            else:
+                logger.debug("%s: OID %s has no value (%s)", key, indict[key], varbind.type)
+        errorKey = sent[errorIndex - 1] if 0 < errorIndex <= len(sent) else None
+        return errorStatus, errorKey, values
+
+    # Gets all OIDs in indict with as few GET PDUs as the agent accepts.
+    # returns dict of key: value for the OIDs that had a value.
+    def dictGet(self, indict):
+        key = ' '.join('%s=%s' % x for x in sorted(indict.items()))
+        return self.cached('dictget', key, self.getChunks, indict)
+
+    def getChunks(self, indict):
+        outdict = {}
+        keys = list(indict)
+        chunks = [keys[i:i + self.maxVarbinds] for i in range(0, len(keys), self.maxVarbinds)]
+        while chunks:
+            chunk = chunks.pop()
+            errorStatus, errorKey, values = self.getChunk(chunk, indict)
+            if errorStatus == ber.TOOBIG and len(chunk) > 1:
+                logger.debug("Response to %s OIDs too big, splitting.", len(chunk))
+                half = len(chunk) // 2
+                chunks += [chunk[:half], chunk[half:]]
+            elif errorStatus == ber.NOSUCHNAME and errorKey and len(chunk) > 1:
+                # Version 1 fails the whole PDU because of one OID. Try again without it.
+                chunks.append([x for x in chunk if x != errorKey])
+            else:
+                outdict.update(values)
         return outdict
 
     # Try walking the OID, then getting it.
@@ -98,9 +748,12 @@ class Connection:
         return result
 
     # Takes dict of OIDs as input, returns dict with values.
+    # Everything is tried with batched gets first, only OIDs without value get walked.
     def populateDict(self, indata, keepValuesOnFailure=False):
-        outdata = {}
+        outdata = self.dictGet(indata)
         for key in indata:
+            if key in outdata:
+                continue
             oid = indata[key]
             value = self.walkGet(oid)
             if value:
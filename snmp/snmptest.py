@@ -61,3 +61,7 @@ print not r
 r = c.dictGet(d)
 print r
 print not r
+
+r = c.table({"ifDescr": ".1.3.6.1.2.1.2.2.1.2", "ifName": ".1.3.6.1.2.1.31.1.1.1.1"})
+print r
+print not r
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# SNMPv3 User-based Security Model (RFC 3414) for netsnmp sessions: the engine ID, boots and time
+# of every agent, discovered once and kept. Sessions opened with them skip engine discovery.
+# netsnmp still derives keys from the passwords itself, its Python binding takes no localized keys.
+
+import logging
+import random
+import socket
+import threading
+from binascii import hexlify
+from time import time
+import ber
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Security model of USM in SNMPv3 messages
+securityModel = 3
+# msgFlags: reportable, no authentication, no privacy
+reportableFlag = '\x04'
+
+# Authentication protocols netsnmp sessions take
+authProtocols = ['MD5', 'SHA']
+
+
+class EngineCache:
+    __doc__ = "Engine ID, boots and time of agents by address, discovered once"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # address: (engine ID, boots, engine time, time.time() it was learnt)
+        self.engines = {}
+        # address: lock held while discovering it, so concurrent connections discover it once
+        self.discovering = {}
+
+    # returns (engine ID, boots, engine time now) of the agent at address, calling discover(address)
+    # for (engine ID, boots, engine time) if it is not known yet. None if discovery got no answer.
+    def get(self, address, discover):
+        with self.lock:
+            entry = self.engines.get(address)
+            lock = self.discovering.setdefault(address, threading.Lock())
+        if entry is None:
+            with lock:
+                with self.lock:
+                    entry = self.engines.get(address)
+                if entry is None:
+                    found = discover(address)
+                    if found is None:
+                        return None
+                    entry = tuple(found) + (time(),)
+                    with self.lock:
+                        self.engines[address] = entry
+        engineId, boots, engineTime, learnt = entry
+        # Engine time counts seconds, so it is where it was plus the time since
+        return engineId, boots, engineTime + int(time() - learnt)
+
+    # Drops what is known of the agent at address, like after it was replaced, so it is discovered again.
+    def forget(self, address):
+        with self.lock:
+            self.engines.pop(address, None)
+
+# Shared by all connections
+engines = EngineCache()
+
+
+class User:
+    __doc__ = "SNMPv3 user, authPriv with both passwords, authNoPriv with only authPassword"
+
+    def __init__(self, name, authPassword=None, privPassword=None, authProtocol='SHA', privProtocol='AES'):
+        if authProtocol not in authProtocols:
+            raise ValueError("Unknown authentication protocol %s" % authProtocol)
+        if privPassword and not authPassword:
+            raise ValueError("Privacy needs an authentication password")
+        self.name = name
+        self.authPassword = authPassword
+        self.privPassword = privPassword
+        self.authProtocol = authProtocol
+        self.privProtocol = privProtocol
+        if privPassword:
+            self.level = 'authPriv'
+        elif authPassword:
+            self.level = 'authNoPriv'
+        else:
+            self.level = 'noAuthNoPriv'
+        # Sessions of the same user can be shared (see snmp.SessionPool)
+        self.key = (name, authProtocol, authPassword, privProtocol, privPassword)
+
+    def __repr__(self):
+        return "User(%s, %s)" % (self.name, self.level)
+
+    # returns netsnmp.Session arguments of the user. With engine (engine ID, boots, engine time),
+    # the session starts with the engine known instead of discovering it.
+    def sessionParams(self, engine=None):
+        params = {'SecName': self.name, 'SecLevel': self.level}
+        if self.authPassword:
+            params.update(AuthProto=self.authProtocol, AuthPass=self.authPassword)
+        if self.privPassword:
+            params.update(PrivProto=self.privProtocol, PrivPass=self.privPassword)
+        if engine:
+            engineId, boots, engineTime = engine
+            params.update(SecEngineId=hexlify(engineId), ContextEngineId=hexlify(engineId),
+                          EngineBoots=boots, EngineTime=engineTime)
+        return params
+
+
+#
+# Builds an SNMPv3 engine discovery request (RFC 3414 4): an empty reportable GET without
+# engine ID or user, which agents answer with a report carrying their engine ID, boots and time.
+#
+def encodeDiscovery(messageId):
+    pdu = ber.encodeTLV(ber.GET, ber.encodeInteger(messageId) + ber.encodeInteger(0) + ber.encodeInteger(0) +
+                        ber.encodeTLV(ber.SEQUENCE, bytearray()))
+    scopedPdu = ber.encodeTLV(ber.SEQUENCE, ber.encodeOctets('') + ber.encodeOctets('') + pdu)
+    security = ber.encodeTLV(ber.SEQUENCE, ber.encodeOctets('') + ber.encodeInteger(0) + ber.encodeInteger(0) +
+                             ber.encodeOctets('') + ber.encodeOctets('') + ber.encodeOctets(''))
+    header = ber.encodeTLV(ber.SEQUENCE, ber.encodeInteger(messageId) + ber.encodeInteger(65507) +
+                           ber.encodeOctets(reportableFlag) + ber.encodeInteger(securityModel))
+    return bytes(ber.encodeTLV(ber.SEQUENCE, ber.encodeInteger(3) + header + ber.encodeOctets(security) +
+                               scopedPdu))
+
+
+#
+# Parses the answer to a discovery request. returns (message ID, engine ID, boots, engine time).
+# Raises ber.DecodeError if it is not an SNMPv3 message with USM security parameters.
+#
+def decodeDiscovery(data):
+    data = bytearray(data)
+    try:
+        tag, pos, end = ber.decodeTLV(data, 0)
+        tag, start, pos = ber.decodeTLV(data, pos, end)
+        if tag != ber.INTEGER or ber.decodeInteger(data, start, pos) != 3:
+            raise ber.DecodeError("Not an SNMPv3 message")
+        tag, headerStart, pos = ber.decodeTLV(data, pos, end)
+        tag, start, headerEnd = ber.decodeTLV(data, headerStart, pos)
+        messageId = ber.decodeInteger(data, start, headerEnd)
+        tag, start, pos = ber.decodeTLV(data, pos, end)
+        security = data[start:pos]
+        tag, pos, end = ber.decodeTLV(security, 0)
+        fields = []
+        for i in range(3):
+            tag, start, pos = ber.decodeTLV(security, pos, end)
+            fields.append((start, pos))
+    except (IndexError, ValueError) as e:
+        raise ber.DecodeError("Malformed message: %s" % e)
+    engineId = bytes(security[fields[0][0]:fields[0][1]])
+    if not engineId:
+        raise ber.DecodeError("No engine ID in answer")
+    return (messageId, engineId, ber.decodeInteger(security, *fields[1]),
+            ber.decodeInteger(security, *fields[2]))
+
+
+#
+# Discovers the engine of the agent at address ((host, port) tuple), waiting timeout seconds
+# for an answer, retries more times. returns (engine ID, boots, engine time) or None.
+#
+def discover(address, timeout=1.0, retries=1):
+    messageId = random.randint(1, 0x7fffffff)
+    message = encodeDiscovery(messageId)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for attempt in range(retries + 1):
+            s.sendto(message, address)
+            due = time() + timeout
+            while time() < due:
+                s.settimeout(max(due - time(), 0.001))
+                try:
+                    data = s.recv(65535)
+                except socket.timeout:
+                    break
+                try:
+                    found = decodeDiscovery(data)
+                except ber.DecodeError as e:
+                    logger.debug("Bad discovery answer from %s:%s: %s", address[0], address[1], e)
+                    continue
+                if found[0] == messageId:
+                    return found[1:]
+    except socket.error as e:
+        logger.debug("Could not discover engine of %s:%s: %s", address[0], address[1], e)
+    finally:
+        s.close()
+    return None
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Per-device state kept between runs of getinfo.py and lldp.py:
+# change indicators and results of the last poll, so unchanged devices need not be walked again.
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class StateStore:
+    __doc__ = "Per-device state by hostname and section, kept in a JSON file"
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # hostname: {section: entry}
+        self.devices = {}
+        if filename:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.devices = json.load(f)
+        except IOError:
+            logger.info("No state in %s yet, starting empty" % self.filename)
+        except ValueError:
+            logger.error("No valid JSON detected in %s, starting empty" % self.filename)
+        logger.debug("Loaded state of %s devices", len(self.devices))
+
+    def get(self, hostname, section):
+        with self.lock:
+            return self.devices.get(hostname, {}).get(section)
+
+    def put(self, hostname, section, entry):
+        with self.lock:
+            self.devices.setdefault(hostname, {})[section] = entry
+
+    # Writes state to a temporary file first, so an interrupted save leaves the old state intact.
+    def save(self):
+        if not self.filename:
+            return
+        temporary = self.filename + '.tmp'
+        with self.lock:
+            with open(temporary, 'w') as f:
+                json.dump(self.devices, f)
+        os.rename(temporary, self.filename)
+        logger.debug("Saved state of %s devices", len(self.devices))
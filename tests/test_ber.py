@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Tests of the BER codec of the async engine (snmp/ber.py).
+# Run from the top directory: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+from binascii import hexlify, unhexlify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'snmp'))
+import ber
+
+sysName = (1, 3, 6, 1, 2, 1, 1, 5, 0)
+# snmpget -v2c -c public of sysName.0 with request ID 1
+getSysName = ('3026' '020101' '0406' '7075626c6963' 'a019' '020101' '020100' '020100'
+              '300e' '300c' '06082b06010201010500' '0500')
+
+
+def toHex(data):
+    return hexlify(bytes(data))
+
+
+class OidTest(unittest.TestCase):
+    def testParse(self):
+        self.assertEqual(ber.parseOid('.1.3.6.1.'), (1, 3, 6, 1))
+        self.assertEqual(ber.parseOid('1.3.6.1'), (1, 3, 6, 1))
+        self.assertRaises(ValueError, ber.parseOid, 'ifName')
+        self.assertRaises(ValueError, ber.parseOid, '.1')
+
+    def testFormat(self):
+        self.assertEqual(ber.formatOid((1, 3, 6, 1)), '.1.3.6.1')
+
+    def testEncode(self):
+        self.assertEqual(toHex(ber.encodeOid(sysName)), '06082b06010201010500')
+        # Sub-identifiers of more than 7 bits take several octets
+        self.assertEqual(toHex(ber.encodeOid((1, 0, 8802, 1))), '060428c46201')
+
+    def testRoundTrip(self):
+        for oid in (sysName, (1, 0, 8802, 1, 1, 2, 1, 4, 1, 1, 9, 0, 3, 1), (2, 100, 3), (1, 3, 4294967295)):
+            data = ber.encodeOid(oid)
+            tag, start, end = ber.decodeTLV(data, 0)
+            self.assertEqual(tag, ber.OBJECT_IDENTIFIER)
+            self.assertEqual(ber.decodeOid(data, start, end), oid)
+
+
+class IntegerTest(unittest.TestCase):
+    def testEncode(self):
+        for value, encoded in ((0, '020100'), (127, '02017f'), (128, '02020080'), (256, '02020100'),
+                               (-1, '0201ff'), (-128, '020180'), (-129, '0202ff7f')):
+            self.assertEqual(toHex(ber.encodeInteger(value)), encoded)
+
+    def testUnsigned(self):
+        self.assertEqual(toHex(ber.encodeUnsigned(0, ber.COUNTER32)), '410100')
+        self.assertEqual(toHex(ber.encodeUnsigned(0xffffffff, ber.COUNTER32)), '410500ffffffff')
+
+    def testRoundTrip(self):
+        for value in (0, 1, -1, 127, 128, -128, -129, 65535, 2 ** 31 - 1, -2 ** 31):
+            data = ber.encodeInteger(value)
+            tag, start, end = ber.decodeTLV(data, 0)
+            self.assertEqual(ber.decodeInteger(data, start, end), value)
+        for value in (0, 255, 2 ** 32 - 1, 2 ** 64 - 1):
+            data = ber.encodeUnsigned(value, ber.COUNTER64)
+            tag, start, end = ber.decodeTLV(data, 0)
+            self.assertEqual(ber.decodeInteger(data, start, end, signed=False), value)
+
+
+class LengthTest(unittest.TestCase):
+    def testEncode(self):
+        self.assertEqual(toHex(ber.encodeLength(127)), '7f')
+        self.assertEqual(toHex(ber.encodeLength(200)), '81c8')
+        self.assertEqual(toHex(ber.encodeLength(300)), '82012c')
+
+    def testLong(self):
+        data = ber.encodeOctets('x' * 300)
+        self.assertEqual(ber.decodeTLV(data, 0), (ber.OCTET_STRING, 4, 304))
+
+    def testTruncated(self):
+        self.assertRaises(ber.DecodeError, ber.decodeTLV, bytearray(unhexlify('04')), 0)
+        self.assertRaises(ber.DecodeError, ber.decodeTLV, bytearray(unhexlify('0405616263')), 0)
+        self.assertRaises(ber.DecodeError, ber.decodeTLV, bytearray(unhexlify('0480')), 0)
+
+
+class MessageTest(unittest.TestCase):
+    def testEncode(self):
+        self.assertEqual(hexlify(ber.encodeMessage(2, 'public', ber.GET, 1, [(sysName, ber.NULL, None)])),
+                         getSysName)
+
+    def testDecode(self):
+        self.assertEqual(ber.decodeMessage(unhexlify(getSysName)),
+                         (1, 'public', ber.GET, 1, 0, 0, [(sysName, ber.NULL, None)]))
+
+    def testRoundTrip(self):
+        varbinds = [(sysName, ber.OCTET_STRING, 'switch001'),
+                    ((1, 3, 6, 1, 2, 1, 1, 3, 0), ber.TIMETICKS, 100000),
+                    ((1, 3, 6, 1, 2, 1, 1, 2, 0), ber.OBJECT_IDENTIFIER, (1, 3, 6, 1, 4, 1, 2636)),
+                    ((1, 3, 6, 1, 2, 1, 31, 1, 1, 1, 6, 1), ber.COUNTER64, 2 ** 64 - 1),
+                    ((1, 3, 6, 1, 2, 1, 4, 20, 1, 1, 10, 0, 0, 1), ber.IPADDRESS, '10.0.0.1'),
+                    ((1, 3, 6, 1, 2, 1, 2, 2, 1, 8, 1), ber.INTEGER, -5),
+                    ((1, 3, 6, 1, 2, 1, 2, 2, 1, 8, 2), ber.ENDOFMIBVIEW, None)]
+        message = ber.encodeMessage(1, 'private', ber.RESPONSE, 0x7fffffff, varbinds, ber.TOOBIG, 2)
+        self.assertEqual(ber.decodeMessage(message),
+                         (0, 'private', ber.RESPONSE, 0x7fffffff, ber.TOOBIG, 2, varbinds))
+
+    def testGetBulk(self):
+        # Non-repeaters and max-repetitions go where error status and index are
+        message = ber.encodeMessage(2, 'public', ber.GETBULK, 7, [(sysName, ber.NULL, None)], 0, 20)
+        self.assertEqual(ber.decodeMessage(message)[2:6], (ber.GETBULK, 7, 0, 20))
+
+    def testMalformed(self):
+        data = unhexlify(getSysName)
+        for broken in (data[:-1], data[:10], '\x04\x00', ''):
+            self.assertRaises(ber.DecodeError, ber.decodeMessage, broken)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Tests of device.Device walking LLDP and interface tables through netsnmp sessions, whatever
+# form the tags of the varbinds they return come in.
+# Run from the top directory: python -m unittest discover tests
+
+import json
+import os
+import sys
+import threading
+import unittest
+
+top = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, top)
+try:
+    import netsnmp
+    import snmp
+    import device
+    import registry
+except ImportError:
+    netsnmp = None
+
+ifName = '.1.3.6.1.2.1.31.1.1.1.1'
+ifSpeed = '.1.3.6.1.2.1.2.2.1.5'
+remoteSysName = '.1.0.8802.1.1.2.1.4.1.1.9'
+
+agent = {remoteSysName + '.0.1.1': 'switch002', remoteSysName + '.0.2.1': 'switch003',
+         ifName + '.1': 'ge-0/0/0', ifName + '.2': 'ge-0/0/1',
+         ifSpeed + '.1': '1000000000', ifSpeed + '.2': '10000000000'}
+
+
+# (1, 3, 6, 1) of '.1.3.6.1'
+def key(oid):
+    return tuple(int(x) for x in oid.strip('.').split('.'))
+
+
+class FakeSession:
+    __doc__ = "netsnmp.Session answering from agent, with tags as tag(oid) makes them"
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.ErrorNum = 0
+        self.ErrorInd = 0
+
+    # returns netsnmp.Varbind of oid and value
+    def varbind(self, oid, value, type='OCTETSTR'):
+        tag, iid = self.tag(oid)
+        return netsnmp.Varbind(tag, iid, value, type)
+
+    def after(self, oid):
+        for x in sorted(agent, key=key):
+            if key(x) > key(oid):
+                return x
+        return None
+
+    def get(self, varlist):
+        for v in varlist:
+            v.val = agent.get(v.tag + ('.' + v.iid if v.iid else ''))
+        return tuple(v.val for v in varlist)
+
+    def getbulk(self, nonRepeaters, repetitions, varlist):
+        oids = [v.tag + ('.' + v.iid if v.iid else '') for v in varlist]
+        del varlist.varbinds[:]
+        for i in range(repetitions):
+            for j, oid in enumerate(oids):
+                following = self.after(oid)
+                if following:
+                    varlist.varbinds.append(self.varbind(following, agent[following]))
+                    oids[j] = following
+                else:
+                    varlist.varbinds.append(self.varbind(oid, None, 'ENDOFMIBVIEW'))
+        return tuple(v.val for v in varlist)
+
+    def walk(self, varlist):
+        base = key(varlist[0].tag)
+        del varlist.varbinds[:]
+        for oid in sorted(agent, key=key):
+            if key(oid)[:len(base)] == base:
+                varlist.varbinds.append(self.varbind(oid, agent[oid]))
+        return tuple(v.val for v in varlist)
+
+
+# Tags as sessions opened with UseNumeric return them: the last number split off as iid
+def numeric(oid):
+    tag, iid = oid.rsplit('.', 1)
+    return tag, iid
+
+
+# Tags as sessions without MIBs for them return them otherwise
+def iso(oid):
+    tag, iid = oid.rsplit('.', 1)
+    return 'iso' + tag[2:], iid
+
+
+class FakePool:
+    __doc__ = "snmp.SessionPool of FakeSessions"
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    def get(self, host, version, community, timeout=1.0, retries=0, engine=None):
+        return FakeSession(self.tag), threading.Lock(), (timeout, retries)
+
+
+@unittest.skipIf(netsnmp is None, "needs netsnmp")
+class SymbolicTagTest(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(top, 'oid.json')) as f:
+            self.oid = json.load(f)
+        self.module = sys.modules['snmp.snmp']
+        self.sessions = self.module.sessions
+
+    def tearDown(self):
+        self.module.sessions = self.sessions
+
+    def poll(self, tag):
+        self.module.sessions = FakePool(tag)
+        d = device.Device('127.0.0.1')
+        d.snmpConfig(self.oid)
+        return d
+
+    def check(self, tag):
+        d = self.poll(tag)
+        neighbours = d.getNeighbours()
+        self.assertEqual(sorted(neighbours.values()), ['switch002', 'switch003'])
+        self.assertEqual(sorted(d.getInterfaces()), ['1', '2'])
+        info = d.getNeighbourInterfaceInfo(neighbours)
+        self.assertEqual(sorted((x['name'], x['speed'], x['neighbour']) for x in info),
+                         [('ge-0/0/0', 1000, 'switch002'), ('ge-0/0/1', 10000, 'switch003')])
+
+    def testNumeric(self):
+        self.check(numeric)
+
+    def testIso(self):
+        self.check(iso)
+
+    def testWalkKeys(self):
+        d = self.poll(numeric)
+        self.assertEqual(d.snmp.walk(ifName), {ifName + '.1': 'ge-0/0/0', ifName + '.2': 'ge-0/0/1'})
+
+
+@unittest.skipIf(netsnmp is None, "needs netsnmp")
+class InstanceTest(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(top, 'oid.json')) as f:
+            oid = json.load(f)
+        self.device = device.Device('127.0.0.1')
+        self.device.oid = oid
+        self.device.registry = registry.compiled(oid)
+
+    def testNumeric(self):
+        self.assertEqual(self.device.instance(remoteSysName + '.0.3.1', 'lldp', 'remotesysname')[-2], 3)
+
+    def testNotUnderColumn(self):
+        # The LocalPortNum is still second to last
+        self.assertEqual(self.device.instance('iso.0.8802.1.1.2.1.4.1.1.9.0.3.1', 'lldp', 'remotesysname')[-2], '3')
+        self.assertEqual(self.device.instance('lldpRemSysName.0.3.1', 'lldp', 'remotesysname'),
+                         ('lldpRemSysName', '0', '3', '1'))
+
+
+@unittest.skipIf(netsnmp is None, "needs netsnmp")
+class SessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.module = sys.modules['snmp.snmp']
+        self.netsnmp = self.module.netsnmp
+        self.opened = []
+
+        class Recorder:
+            @staticmethod
+            def Session(**params):
+                self.opened.append(params)
+                return params
+        self.module.netsnmp = Recorder
+
+    def tearDown(self):
+        self.module.netsnmp = self.netsnmp
+
+    def testNumeric(self):
+        snmp.SessionPool().get('127.0.0.1', 2, 'public')
+        self.assertEqual(self.opened[0].get('UseNumeric'), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
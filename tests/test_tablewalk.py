@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Tests of snmp.TableWalk and the OIDs Connection.varbindOid reads from netsnmp varbinds.
+# Run from the top directory: python -m unittest discover tests
+
+import logging
+import os
+import sys
+import unittest
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    import snmp
+    from snmp import ber
+except ImportError:
+    snmp = None
+
+Varbind = namedtuple('Varbind', 'tag iid')
+
+ifName = '.1.3.6.1.2.1.31.1.1.1.1'
+ifSpeed = '.1.3.6.1.2.1.2.2.1.5'
+
+
+# (1, 3, 6, 1) + index
+def oid(column, index):
+    return ber.parseOid(column) + tuple(index)
+
+
+class Records(logging.Handler):
+    __doc__ = "Keeps the log records it gets"
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class StubConnection(snmp.Connection if snmp else object):
+    __doc__ = "Connection answering bulk() with the responses it was given, one per call"
+
+    def __init__(self, responses):
+        self.host = 'stub'
+        self.group = None
+        self.responses = list(responses)
+        self.asked = []
+
+    def bulk(self, oids, repetitions):
+        self.asked.append(oids)
+        return self.responses.pop(0) if self.responses else (ber.NOERROR, [])
+
+
+@unittest.skipIf(snmp is None, "needs netsnmp")
+class VarbindOidTest(unittest.TestCase):
+    def testNumeric(self):
+        self.assertEqual(snmp.Connection.varbindOid(Varbind('.1.3.6.1.2.1.1.5', '0')), (1, 3, 6, 1, 2, 1, 1, 5, 0))
+        self.assertEqual(snmp.Connection.varbindOid(Varbind('.1.3.6.1.2.1.1.5.0', '')), (1, 3, 6, 1, 2, 1, 1, 5, 0))
+
+    def testIso(self):
+        self.assertEqual(snmp.Connection.varbindOid(Varbind('iso.0.8802.1.1.2.1.4.1.1.9', '0.3.1')),
+                         (1, 0, 8802, 1, 1, 2, 1, 4, 1, 1, 9, 0, 3, 1))
+
+    def testSymbolic(self):
+        self.assertEqual(snmp.Connection.varbindOid(Varbind('ifName', '1')), None)
+        self.assertEqual(snmp.Connection.varbindOid(Varbind(None, None)), None)
+
+
+@unittest.skipIf(snmp is None, "needs netsnmp")
+class TableWalkTest(unittest.TestCase):
+    def setUp(self):
+        self.walk = snmp.TableWalk({'name': ifName, 'speed': ifSpeed})
+
+    def testRows(self):
+        names = self.walk.pending()
+        self.assertEqual(names, ['name', 'speed'])
+        rows = self.walk.add(names, [(oid(ifName, [1]), 'ge-0/0/0', False), (oid(ifSpeed, [1]), '1000', False),
+                                     (oid(ifName, [2]), 'ge-0/0/1', False), (oid(ifSpeed, [2]), '1000', False)])
+        self.assertEqual(rows, [('1', 'name', 'ge-0/0/0'), ('1', 'speed', '1000'),
+                                ('2', 'name', 'ge-0/0/1'), ('2', 'speed', '1000')])
+        self.assertEqual(self.walk.next, {'name': oid(ifName, [2]), 'speed': oid(ifSpeed, [2])})
+
+    def testColumnEnds(self):
+        names = self.walk.pending()
+        # name runs into the next column, speed has one more row and then the MIB ends
+        rows = self.walk.add(names, [(oid(ifName, [1]), 'ge-0/0/0', False), (oid(ifSpeed, [1]), '1000', False),
+                                     (ber.parseOid('.1.3.6.1.2.1.31.1.1.1.2.1'), '0', False),
+                                     (oid(ifSpeed, [2]), '100', False)])
+        self.assertEqual(rows, [('1', 'name', 'ge-0/0/0'), ('1', 'speed', '1000'), ('2', 'speed', '100')])
+        self.assertEqual(self.walk.pending(), ['speed'])
+        self.assertEqual(self.walk.add(['speed'], [(oid(ifSpeed, [2]), None, True)]), [])
+        self.assertEqual(self.walk.pending(), [])
+        self.assertEqual(self.walk.unreadable, set())
+
+    def testBackwards(self):
+        self.walk.add(['name', 'speed'], [(oid(ifName, [5]), 'a', False), (oid(ifSpeed, [5]), '1', False)])
+        rows = self.walk.add(['name', 'speed'], [(oid(ifName, [3]), 'b', False), (oid(ifSpeed, [6]), '2', False)])
+        self.assertEqual(rows, [('6', 'speed', '2')])
+        self.assertEqual(self.walk.pending(), ['speed'])
+
+    def testTruncated(self):
+        # Agents may return fewer varbinds than asked for. The walk goes on from the last ones.
+        rows = self.walk.add(['name', 'speed'], [(oid(ifName, [1]), 'a', False), (oid(ifSpeed, [1]), '1', False),
+                                                 (oid(ifName, [2]), 'b', False)])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(self.walk.next, {'name': oid(ifName, [2]), 'speed': oid(ifSpeed, [1])})
+        # Nothing at all ends the walk
+        self.assertEqual(self.walk.add(['name', 'speed'], []), [])
+        self.assertEqual(self.walk.pending(), [])
+
+    def testUnreadable(self):
+        rows = self.walk.add(['name', 'speed'], [(None, 'a', False), (oid(ifSpeed, [1]), '1', False)])
+        self.assertEqual(rows, [('1', 'speed', '1')])
+        self.assertEqual(self.walk.pending(), ['speed'])
+        self.assertEqual(self.walk.unreadable, set(['name']))
+
+    def testNotNumeric(self):
+        self.assertRaises(ValueError, snmp.TableWalk, {'name': 'ifName'})
+
+
+@unittest.skipIf(snmp is None, "needs netsnmp")
+class StreamTableTest(unittest.TestCase):
+    def setUp(self):
+        self.records = Records()
+        logging.getLogger('snmp.snmp').addHandler(self.records)
+
+    def tearDown(self):
+        logging.getLogger('snmp.snmp').removeHandler(self.records)
+
+    def warnings(self):
+        return [x for x in self.records.records if x.levelno == logging.WARNING]
+
+    def testTruncated(self):
+        c = StubConnection([(ber.NOERROR, [(oid(ifName, [1]), 'a', False), (oid(ifSpeed, [1]), '1', False),
+                                           (oid(ifName, [2]), 'b', False)]),
+                            (ber.NOERROR, [(oid(ifName, [3]), 'c', False), (oid(ifSpeed, [2]), '2', False)])])
+        rows = list(c.streamTable({'name': ifName, 'speed': ifSpeed}))
+        self.assertEqual(sorted(rows), [('1', 'name', 'a'), ('1', 'speed', '1'), ('2', 'name', 'b'),
+                                        ('2', 'speed', '2'), ('3', 'name', 'c')])
+        self.assertEqual(c.asked[1], [oid(ifName, [2]), oid(ifSpeed, [1])])
+        self.assertEqual(self.warnings(), [])
+
+    def testTooBig(self):
+        c = StubConnection([(ber.TOOBIG, []), (ber.NOERROR, [(oid(ifName, [1]), 'a', False)])])
+        c.maxRepetitions = 20
+        self.assertEqual(list(c.streamTable({'name': ifName})), [('1', 'name', 'a')])
+        self.assertEqual(len(c.asked), 3)
+
+    def testError(self):
+        c = StubConnection([(ber.NOERROR, [(oid(ifName, [1]), 'a', False)]), (ber.GENERR, [])])
+        self.assertFalse(c.walkFailed)
+        self.assertEqual(list(c.streamTable({'name': ifName})), [('1', 'name', 'a')])
+        self.assertTrue(c.walkFailed)
+
+    def testUnreadable(self):
+        c = StubConnection([(ber.NOERROR, [(None, 'a', False)])])
+        self.assertEqual(list(c.streamTable({'name': ifName})), [])
+        self.assertEqual(len(self.warnings()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Tests of the SNMPv3 USM users and engine discovery (snmp/usm.py).
+# Run from the top directory: python -m unittest discover tests
+
+import os
+import socket
+import sys
+import threading
+import unittest
+from binascii import unhexlify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'snmp'))
+import ber
+import usm
+
+password = 'maplesyrup'
+engineId = unhexlify('000000000000000000000002')
+
+usmStatsUnknownEngineIDs = (1, 3, 6, 1, 6, 3, 15, 1, 1, 4, 0)
+
+
+# returns the report an agent with engine (engine ID, boots, engine time) answers discovery messageId with.
+def report(messageId, engine):
+    engineId, boots, engineTime = engine
+    pdu = ber.encodeTLV(ber.REPORT, ber.encodeInteger(messageId) + ber.encodeInteger(0) + ber.encodeInteger(0) +
+                        ber.encodeTLV(ber.SEQUENCE, ber.encodeVarbind(usmStatsUnknownEngineIDs, ber.COUNTER32, 1)))
+    scopedPdu = ber.encodeTLV(ber.SEQUENCE, ber.encodeOctets(engineId) + ber.encodeOctets('') + pdu)
+    security = ber.encodeTLV(ber.SEQUENCE, ber.encodeOctets(engineId) + ber.encodeInteger(boots) +
+                             ber.encodeInteger(engineTime) + ber.encodeOctets('') + ber.encodeOctets('') +
+                             ber.encodeOctets(''))
+    header = ber.encodeTLV(ber.SEQUENCE, ber.encodeInteger(messageId) + ber.encodeInteger(65507) +
+                           ber.encodeOctets('\x00') + ber.encodeInteger(usm.securityModel))
+    return bytes(ber.encodeTLV(ber.SEQUENCE, ber.encodeInteger(3) + header + ber.encodeOctets(security) +
+                               scopedPdu))
+
+
+# returns message ID of SNMPv3 message data
+def messageId(data):
+    data = bytearray(data)
+    tag, pos, end = ber.decodeTLV(data, 0)
+    tag, start, pos = ber.decodeTLV(data, pos, end)
+    tag, start, pos = ber.decodeTLV(data, pos, end)
+    tag, start, end = ber.decodeTLV(data, start, pos)
+    return ber.decodeInteger(data, start, end)
+
+
+class EngineCacheTest(unittest.TestCase):
+    def testDiscoveredOnce(self):
+        asked = []
+
+        def discover(address):
+            asked.append(address)
+            return engineId, 5, 1000
+        engines = usm.EngineCache()
+        found = engines.get(('127.0.0.1', 161), discover)
+        self.assertEqual(found[:2], (engineId, 5))
+        self.assertTrue(1000 <= found[2] <= 1001)
+        engines.get(('127.0.0.1', 161), discover)
+        self.assertEqual(len(asked), 1)
+        engines.forget(('127.0.0.1', 161))
+        engines.get(('127.0.0.1', 161), discover)
+        self.assertEqual(len(asked), 2)
+
+    def testNoAnswer(self):
+        engines = usm.EngineCache()
+        self.assertEqual(engines.get(('127.0.0.1', 161), lambda address: None), None)
+        # Not answering is not remembered
+        self.assertEqual(engines.get(('127.0.0.1', 161), lambda address: (engineId, 1, 2))[0], engineId)
+
+
+class UserTest(unittest.TestCase):
+    def testLevels(self):
+        self.assertEqual(usm.User('u').level, 'noAuthNoPriv')
+        self.assertEqual(usm.User('u', password).level, 'authNoPriv')
+        self.assertEqual(usm.User('u', password, password).level, 'authPriv')
+        self.assertRaises(ValueError, usm.User, 'u', None, password)
+        self.assertRaises(ValueError, usm.User, 'u', password, authProtocol='SHA512')
+
+    def testSessionParams(self):
+        user = usm.User('u', password, 'other', authProtocol='MD5', privProtocol='DES')
+        params = user.sessionParams()
+        self.assertEqual(params, {'SecName': 'u', 'SecLevel': 'authPriv', 'AuthProto': 'MD5', 'AuthPass': password,
+                                  'PrivProto': 'DES', 'PrivPass': 'other'})
+        params = user.sessionParams((engineId, 5, 1000))
+        self.assertEqual(params['SecEngineId'], '000000000000000000000002')
+        self.assertEqual(params['ContextEngineId'], '000000000000000000000002')
+        self.assertEqual((params['EngineBoots'], params['EngineTime']), (5, 1000))
+
+
+class DiscoveryCodecTest(unittest.TestCase):
+    def testEncode(self):
+        data = bytearray(usm.encodeDiscovery(1234))
+        self.assertEqual(messageId(data), 1234)
+        tag, pos, end = ber.decodeTLV(data, 0)
+        tag, start, pos = ber.decodeTLV(data, pos, end)
+        self.assertEqual(ber.decodeInteger(data, start, pos), 3)
+        tag, start, pos = ber.decodeTLV(data, pos, end)
+        fields = []
+        while start < pos:
+            tag, valueStart, start = ber.decodeTLV(data, start, pos)
+            fields.append(bytes(data[valueStart:start]))
+        # msgMaxSize, reportable flag and USM security model
+        self.assertEqual(fields[2], usm.reportableFlag)
+        self.assertEqual(ber.decodeInteger(bytearray(fields[3]), 0, len(fields[3])), usm.securityModel)
+
+    def testDecode(self):
+        self.assertEqual(usm.decodeDiscovery(report(1234, (engineId, 5, 1000))), (1234, engineId, 5, 1000))
+
+    def testMalformed(self):
+        self.assertRaises(ber.DecodeError, usm.decodeDiscovery, report(1, ('', 5, 1000)))
+        self.assertRaises(ber.DecodeError, usm.decodeDiscovery,
+                          ber.encodeMessage(2, 'public', ber.RESPONSE, 1, []))
+        self.assertRaises(ber.DecodeError, usm.decodeDiscovery, report(1, (engineId, 5, 1000))[:-30])
+        self.assertRaises(ber.DecodeError, usm.decodeDiscovery, 'garbage')
+
+
+class DiscoverTest(unittest.TestCase):
+    __doc__ = "usm.discover against an agent on the loopback answering garbage and stale reports first"
+
+    def setUp(self):
+        self.agent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.agent.bind(('127.0.0.1', 0))
+        self.address = self.agent.getsockname()
+        self.asked = 0
+        self.answering = True
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.agent.close()
+
+    def serve(self):
+        while True:
+            try:
+                data, peer = self.agent.recvfrom(65535)
+            except socket.error:
+                return
+            self.asked += 1
+            if self.answering:
+                self.agent.sendto('garbage', peer)
+                self.agent.sendto(report(messageId(data) + 1, ('stale', 1, 1)), peer)
+                self.agent.sendto(report(messageId(data), (engineId, 5, 1000)), peer)
+
+    def testDiscover(self):
+        self.assertEqual(usm.discover(self.address, 1.0, 1), (engineId, 5, 1000))
+        self.assertEqual(self.asked, 1)
+
+    def testNoAnswer(self):
+        self.answering = False
+        self.assertEqual(usm.discover(self.address, 0.1, 2), None)
+        self.assertEqual(self.asked, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
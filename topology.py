@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# Compact in-memory network topology, loadable from getinfo.py output.
+# Hostnames and interface names are interned to integer ids and links are kept in
+# array backed adjacency lists, so queries do not walk nested dicts of strings.
+
+import logging
+from array import array
+from collections import deque
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Stored in speed arrays for links of unknown speed
+unknownSpeed = -1
+
+
+class Interner:
+    __doc__ = "Maps strings to consecutive integer ids and back"
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def get(self, name):
+        return self.ids.get(name)
+
+    def name(self, i):
+        return self.names[i]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Device(object):
+    __doc__ = "Device in a topology. ports is None for devices only known as someone's neighbour."
+    __slots__ = ('id', 'sysname', 'ports')
+
+    def __init__(self, id, sysname=None):
+        self.id = id
+        self.sysname = sysname
+        self.ports = None
+
+
+class Port(object):
+    __doc__ = "Interface of a device, with the device seen on the other end"
+    __slots__ = ('device', 'name', 'number', 'speed', 'neighbour')
+
+    def __init__(self, device, name, number, speed, neighbour):
+        self.device = device
+        self.name = name
+        self.number = number
+        self.speed = speed
+        self.neighbour = neighbour
+
+
+class Topology:
+    __doc__ = "Devices and links between them, by integer id"
+
+    def __init__(self):
+        self.hostnames = Interner()
+        self.portnames = Interner()
+        # Indexed by device id
+        self.devices = []
+        # Neighbour device ids of each device, and the speed of each of those links (Mbit/s)
+        self.adjacency = []
+        self.speeds = []
+        self.ports = []
+
+    #
+    # returns Topology of getinfo.py output (dict of hostname: device info).
+    #
+    @classmethod
+    def fromDeviceInfo(cls, devicelist):
+        topology = cls()
+        for name, info in (devicelist or {}).items():
+            d = topology.addDevice(name, info.get('sysname'))
+            topology.devices[d].ports = topology.devices[d].ports or array('l')
+            for interface in info.get('if') or []:
+                topology.addPort(d, interface.get('name'), interface.get('number'),
+                                 interface.get('speed'), interface.get('neighbour'))
+        logger.debug("Loaded %s devices, %s ports", len(topology.devices), len(topology.ports))
+        return topology
+
+    #
+    # returns id of device name, adding it if new.
+    #
+    def addDevice(self, name, sysname=None):
+        d = self.hostnames.intern(name)
+        if d == len(self.devices):
+            self.devices.append(Device(d, sysname))
+            self.adjacency.append(array('l'))
+            self.speeds.append(array('l'))
+        elif sysname:
+            self.devices[d].sysname = sysname
+        return d
+
+    #
+    # Links devices a and b (ids). A link is kept once per device pair, with the highest speed reported.
+    #
+    def addLink(self, a, b, speed=None):
+        if a == b:
+            return
+        speed = unknownSpeed if speed is None else int(speed)
+        try:
+            i = self.adjacency[a].index(b)
+        except ValueError:
+            for x, y in ((a, b), (b, a)):
+                self.adjacency[x].append(y)
+                self.speeds[x].append(speed)
+            return
+        if speed > self.speeds[a][i]:
+            self.speeds[a][i] = speed
+            self.speeds[b][self.adjacency[b].index(a)] = speed
+
+    #
+    # Adds interface of device id d, linking d to neighbour (a name) if there is one. returns port id.
+    #
+    def addPort(self, d, name, number=None, speed=None, neighbour=None):
+        n = None
+        if neighbour:
+            n = self.addDevice(neighbour)
+            self.addLink(d, n, speed)
+        p = len(self.ports)
+        self.ports.append(Port(d, self.portnames.intern(name), number, speed, n))
+        if self.devices[d].ports is None:
+            self.devices[d].ports = array('l')
+        self.devices[d].ports.append(p)
+        return p
+
+    def id(self, name):
+        return self.hostnames.get(name)
+
+    def name(self, d):
+        return self.hostnames.name(d)
+
+    # returns sysname of device id d if known, else its name.
+    def label(self, d):
+        return self.devices[d].sysname or self.name(d)
+
+    # True if we have data on device id d, not just other devices naming it as neighbour.
+    def polled(self, d):
+        return self.devices[d].ports is not None
+
+    #
+    # returns list of (interface name, neighbour name or None, speed) of device name.
+    #
+    def interfaces(self, name):
+        d = self.id(name)
+        if d is None or not self.polled(d):
+            return []
+        result = []
+        for p in self.devices[d].ports:
+            port = self.ports[p]
+            neighbour = None if port.neighbour is None else self.name(port.neighbour)
+            result.append((self.portnames.name(port.name), neighbour, port.speed))
+        return result
+
+    #
+    # Breadth-first traversal from device ids starts. yields (device id, hops, parent id).
+    # Stops at maxHops, and with polledOnly does not continue through devices we have no data on.
+    #
+    def traverse(self, starts, maxHops=None, polledOnly=False):
+        seen = set()
+        queue = deque()
+        for d in starts:
+            if d is not None and d not in seen:
+                seen.add(d)
+                queue.append((d, 0, None))
+        while queue:
+            d, hops, parent = queue.popleft()
+            yield d, hops, parent
+            if (maxHops is not None and hops >= maxHops) or (polledOnly and not self.polled(d)):
+                continue
+            for n in self.adjacency[d]:
+                if n not in seen:
+                    seen.add(n)
+                    queue.append((n, hops + 1, d))
+
+    #
+    # returns list of neighbour names of device name.
+    #
+    def neighbours(self, name):
+        d = self.id(name)
+        if d is None:
+            return []
+        return [self.name(n) for n in self.adjacency[d]]
+
+    #
+    # returns set of device names at most hops links away from name, name included.
+    #
+    def reachable(self, name, hops):
+        return set(self.name(d) for d, h, parent in self.traverse([self.id(name)], hops))
+
+    #
+    # returns list of device names on a path with fewest hops from a to b, or None.
+    #
+    def shortestPath(self, a, b):
+        source, target = self.id(a), self.id(b)
+        if source is None or target is None:
+            return None
+        parents = {}
+        for d, hops, parent in self.traverse([source]):
+            parents[d] = parent
+            if d == target:
+                path = []
+                while d is not None:
+                    path.append(self.name(d))
+                    d = parents[d]
+                return path[::-1]
+        return None
+
+    #
+    # returns speed of device pair a, b link, or None if not linked or of unknown speed.
+    #
+    def linkSpeed(self, a, b):
+        a, b = self.id(a), self.id(b)
+        if a is None or b is None:
+            return None
+        try:
+            speed = self.speeds[a][self.adjacency[a].index(b)]
+        except ValueError:
+            return None
+        return None if speed == unknownSpeed else speed
+
+    #
+    # returns lowest link speed along path (list of device names), ignoring links of unknown speed.
+    # None if no link on the path has a known speed.
+    #
+    def bottleneck(self, path):
+        speeds = [self.linkSpeed(a, b) for a, b in zip(path, path[1:])]
+        speeds = [s for s in speeds if s is not None]
+        return min(speeds) if speeds else None
+
+    #
+    # returns list of connected components, each a list of device names.
+    #
+    def components(self):
+        seen = set()
+        components = []
+        for d in range(len(self.devices)):
+            if d in seen:
+                continue
+            component = [x for x, hops, parent in self.traverse([d])]
+            seen.update(component)
+            components.append([self.name(x) for x in component])
+        return components
+
+    #
+    # yields (device name, device name, speed or None) for every link once,
+    # among devices reachable from roots (names) through devices we have data on.
+    #
+    def links(self, roots):
+        reached = set()
+        for d, hops, parent in self.traverse([self.id(r) for r in roots], polledOnly=True):
+            reached.add(d)
+            if not self.polled(d):
+                continue
+            for n, speed in zip(self.adjacency[d], self.speeds[d]):
+                if n not in reached or not self.polled(n):
+                    yield self.label(d), self.label(n), None if speed == unknownSpeed else speed
+
+    #
+    # returns breadth-first spanning tree from root as nested dicts of {trunk: name, branches: [...]},
+    # the tree format of lldp.py.
+    #
+    def tree(self, root, trunk="id", branches="children"):
+        nodes = {}
+        for d, hops, parent in self.traverse([self.id(root)]):
+            nodes[d] = {trunk: self.name(d)}
+            if parent is not None:
+                nodes[parent].setdefault(branches, []).append(nodes[d])
+        r = self.id(root)
+        return nodes[r] if r is not None else {trunk: root}